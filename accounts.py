@@ -0,0 +1,66 @@
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Balances and positions of the traders, indexed by trader id, in typed arrays that grow
+# when a new trader id is seen: one 8 byte slot per number instead of a Python int per
+# account. Balances are doubles because prices do not have to be whole numbers.
+# With numpy installed the aggregates work on views of the arrays without copying them;
+# such a view must not be kept, an array cannot grow while one exists.
+
+
+class AccountStore():
+    def __init__(self, initial_balance=1000000, capacity=128):
+        self.initial_balance = initial_balance
+        self.balance = array("d", [initial_balance]) * capacity
+        self.position = array("q", [0]) * capacity
+        self.count = 0 # accounts in use: trader ids 0 .. count-1
+
+    def ensure(self, trader_id):
+        if trader_id < 0:
+            raise ValueError("Trader ID Must Not Be Negative!")
+        if trader_id >= self.count:
+            capacity = len(self.balance)
+            if trader_id >= capacity:
+                # grow geometrically, so that adding accounts one by one stays amortized O(1)
+                extra = max(capacity, trader_id + 1 - capacity)
+                self.balance.extend(array("d", [self.initial_balance]) * extra)
+                self.position.extend(array("q", [0]) * extra)
+            self.count = trader_id + 1
+
+    def apply_fill(self, trader_id, balance_delta, position_delta):
+        if not 0 <= trader_id < self.count:
+            # ensure rejects a negative id, the arrays would take it from their end
+            self.ensure(trader_id)
+        # the position first, its array only takes integers
+        self.position[trader_id] += position_delta
+        self.balance[trader_id] += balance_delta
+
+    def get(self, trader_id):
+        # (balance, position), a trader that never traded has the initial balance
+        if 0 <= trader_id < self.count:
+            return self.balance[trader_id], self.position[trader_id]
+        return self.initial_balance, 0
+
+    def snapshot(self):
+        # copies of the arrays of the accounts in use
+        return self.balance[:self.count], self.position[:self.count]
+
+    def balances_view(self):
+        return np.frombuffer(self.balance, dtype=np.float64)[:self.count]
+
+    def positions_view(self):
+        return np.frombuffer(self.position, dtype=np.int64)[:self.count]
+
+    def sum_of_balances(self):
+        if np is not None:
+            return float(self.balances_view().sum())
+        return sum(self.balance[:self.count])
+
+    def sum_of_positions(self):
+        if np is not None:
+            return int(self.positions_view().sum())
+        return sum(self.position[:self.count])
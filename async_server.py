@@ -0,0 +1,146 @@
+import asyncio
+import logging
+from framing import *
+from connections import DISCONNECT, BLOCK
+
+# asyncio version of ThreadedTCPServer. One event loop accepts the connections and reads
+# the frames of all the traders, and a single matching task takes the decoded requests
+# from a queue and passes them to the Exchange, so there is no thread per trader and the
+# requests never wait for each other's locks. The Exchange is used exactly as in the
+# threaded server: the connections registered in trader_connections only need a send
+# method, here it writes to the asyncio transport.
+
+
+logger = logging.getLogger("exchange.asyncio")
+
+
+class AsyncTraderConnection():
+    buffer_limit = 1 << 20 # bytes waiting in the transport of one trader
+
+    def __init__(self, writer, framing=FIXED, codec=JSON_CODEC, slow_client_policy=DISCONNECT, congested=None):
+        self.writer = writer
+        self.framing = framing
+        self.codec = codec
+        self.slow_client_policy = slow_client_policy
+        self.congested = congested # the server's set of connections to drain, for BLOCK
+        self.closed = False
+
+    def send(self, msg):
+        # called from the matching task, i.e. from the event loop thread;
+        # the transport buffers the data and sends it when the socket is writable
+        if self.closed:
+            return
+        transport = self.writer.transport
+        transport.write(frame(msg, self.framing))
+        if transport.get_write_buffer_size() > self.buffer_limit:
+            if self.slow_client_policy == BLOCK:
+                self.congested.add(self)
+            else:
+                self.close()
+
+    def close(self):
+        self.closed = True
+        self.writer.transport.abort()
+
+
+async def read_frame(reader, framing=FIXED):
+    if framing == LENGTH_PREFIXED:
+        header = await reader.readexactly(length_header.size)
+        return await reader.readexactly(length_header.unpack(header)[0])
+    return (await reader.readexactly(msg_len)).rstrip(b" ")
+
+
+class AsyncExchangeServer():
+    # has the parts of the socketserver interface that server.py uses:
+    # server_address, serve_forever, shutdown and the context manager
+    expiry_interval = 0.1 # seconds between the expiries of the orders, see Exchange.expire_orders
+    def __init__(self, exchange, trader_connections, server_address, trading_delay=5, slow_client_policy=DISCONNECT):
+        self.exchange = exchange
+        self.trader_connections = trader_connections
+        self.server_address = server_address
+        self.trading_delay = trading_delay # like the threaded handler, wait before trading
+        self.slow_client_policy = slow_client_policy
+        self.congested = set()
+        self.loop = None
+        self.stopped = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    async def handle_connection(self, reader, writer):
+        try:
+            tr_id, framing, codec, reply = parse_handshake((await read_frame(reader)).decode("utf-8"))
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            writer.close()
+            return
+        connection = AsyncTraderConnection(writer, framing, codec, self.slow_client_policy, self.congested)
+        self.trader_connections[tr_id] = connection
+        logger.info("Got connection from %s  id = %s", writer.get_extra_info("peername")[0], tr_id)
+        writer.write(frame(reply))
+        await asyncio.sleep(self.trading_delay)
+        queue = self.queue
+        decode_request = self.exchange.decode_request
+        try:
+            while True:
+                data = await read_frame(reader, framing)
+                try:
+                    request = decode_request(data, codec)
+                except Exception:
+                    # a malformed frame is skipped, the connection goes on
+                    logger.exception("Failed to decode %s", data)
+                    continue
+                await queue.put(request)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            connection.close()
+
+    async def match(self):
+        queue = self.queue
+        handle_trader_request = self.exchange.handle_trader_request
+        congested = self.congested
+        while True:
+            request = await queue.get()
+            try:
+                handle_trader_request(request)
+            except Exception:
+                # a bad request must not stop the matching for everybody
+                logger.exception("Failed to handle %s", request)
+            if congested:
+                # BLOCK: matching waits until the slow traders have read their messages
+                for connection in list(congested):
+                    try:
+                        await connection.writer.drain()
+                    except ConnectionError:
+                        connection.close()
+                congested.clear()
+
+    async def expire(self):
+        # on the event loop, like the matching
+        while True:
+            await asyncio.sleep(self.expiry_interval)
+            try:
+                self.exchange.expire_orders()
+            except Exception:
+                logger.exception("Failed to expire the orders")
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        self.queue = asyncio.Queue()
+        host, port = self.server_address
+        server = await asyncio.start_server(self.handle_connection, host, port, reuse_address=True)
+        matcher = asyncio.create_task(self.match())
+        expirer = asyncio.create_task(self.expire())
+        async with server:
+            await self.stopped.wait()
+        matcher.cancel()
+        expirer.cancel()
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+    def shutdown(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stopped.set)
@@ -0,0 +1,236 @@
+import argparse
+import gc
+import json
+import platform
+import random
+import time
+import tracemalloc
+from orders import *
+from server import MatchingEngine
+
+# Microbenchmark of MatchingEngine, in process and without the network.
+# Every case is a book depth and a mix of actions: the book is first filled with depth
+# resting limit orders, then a seeded flow of orders, cancels and amends is run against
+# it. The flows are generated before the timing starts, so the same seed always gives
+# the same flow and only the engine is measured.
+#
+#   python bench_engine.py --output results.json
+#   python bench_engine.py --baseline results.json     (after changing the engine)
+
+MID = 1000 # the prices are around this
+
+# weights of limit, market, ioc, cancel and amend
+MIXES = {
+    "passive": (60, 0, 0, 30, 10),
+    "balanced": (50, 10, 10, 20, 10),
+    "aggressive": (30, 30, 30, 10, 0),
+}
+ACTIONS = ("limit", "market", "ioc", "cancel", "amend")
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def limit_price(rnd, side):
+    # mostly behind the best prices, sometimes crossing them
+    offset = rnd.randint(-2, 20)
+    return MID - offset if side == OrderSide.BUY else MID + offset
+
+
+def prefill(depth, rnd, traders):
+    orders = []
+    for i in range(depth):
+        side = OrderSide.BUY if i % 2 else OrderSide.SELL
+        offset = rnd.randint(1, 50)
+        price = MID - offset if side == OrderSide.BUY else MID + offset
+        orders.append(LimitOrder(rnd.randrange(traders), "AAPL", rnd.randint(1, 100), price, side, i, i))
+    return orders
+
+
+def order_flow(n, mix, rnd, traders, first_order_id):
+    # list of (action, arguments); cancels and amends are for orders placed earlier in
+    # the flow, which may have been filled in the meantime
+    flow = []
+    placed = []
+    order_id = first_order_id
+    actions = rnd.choices(ACTIONS, weights=MIXES[mix], k=n)
+    for action in actions:
+        if action in ("cancel", "amend") and placed:
+            # every order is cancelled or amended at most once
+            i = rnd.randrange(len(placed))
+            placed[i], placed[-1] = placed[-1], placed[i]
+            trader_id, oid = placed.pop()
+            if action == "cancel":
+                flow.append((action, (trader_id, oid)))
+            else:
+                flow.append((action, (trader_id, rnd.randint(1, 50), oid)))
+            continue
+        trader_id = rnd.randrange(traders)
+        side = OrderSide.BUY if rnd.random() < 0.5 else OrderSide.SELL
+        quantity = rnd.randint(1, 100)
+        order_id += 1
+        if action == "market":
+            o = MarketOrder(trader_id, "AAPL", quantity, side, order_id, order_id)
+        elif action == "ioc":
+            price = MID + rnd.randint(0, 5) if side == OrderSide.BUY else MID - rnd.randint(0, 5)
+            o = IOCOrder(trader_id, "AAPL", quantity, price, side, order_id, order_id)
+        else:
+            o = LimitOrder(trader_id, "AAPL", quantity, limit_price(rnd, side), side, order_id, order_id)
+            placed.append((trader_id, order_id))
+        flow.append(("place", (o,)))
+    return flow
+
+
+def make_case(depth, mix, ops, seed, traders):
+    rnd = random.Random("%s-%s-%s" % (seed, depth, mix))
+    return prefill(depth, rnd, traders), order_flow(ops, mix, rnd, traders, depth)
+
+
+def copy_orders(orders):
+    # handle_order changes the quantities, so every run gets fresh orders
+    copies = []
+    for o in orders:
+        if o.type == OrderType.LIMIT:
+            copies.append(LimitOrder(o.id, o.symbol, o.quantity, o.price, o.side, o.time, o.order_id))
+        elif o.type == OrderType.MARKET:
+            copies.append(MarketOrder(o.id, o.symbol, o.quantity, o.side, o.time, o.order_id))
+        else:
+            copies.append(IOCOrder(o.id, o.symbol, o.quantity, o.price, o.side, o.time, o.order_id))
+    return copies
+
+
+def copy_flow(flow):
+    placed = copy_orders([args[0] for action, args in flow if action == "place"])
+    placed.reverse()
+    return [(action, (placed.pop(),) if action == "place" else args) for action, args in flow]
+
+
+def run_flow(engine, flow, latencies=None):
+    # returns the number of fills and of rejected cancels and amends; latencies maps the
+    # actions (place, cancel, amend) to the lists the times of their calls are added to
+    handlers = {"place": engine.handle_order, "cancel": engine.cancel_order, "amend": engine.amend_quantity}
+    fills = 0
+    rejected = 0
+    clock = time.perf_counter_ns
+    for action, args in flow:
+        start = clock()
+        try:
+            result = handlers[action](*args)
+        except (NoOrderWithThisIDInOrderBook, NewQuantityNotSmaller):
+            result = None
+            rejected += 1
+        if latencies is not None:
+            latencies[action].append(clock() - start)
+        if result:
+            fills += len(result)
+    return fills, rejected
+
+
+def filled_engine(resting):
+    engine = MatchingEngine()
+    for o in copy_orders(resting):
+        engine.handle_order(o)
+    return engine
+
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def latency_summary(ordered):
+    return dict([("p%s" % p, percentile(ordered, p)) for p in PERCENTILES] + [("max", ordered[-1])])
+
+
+def bench_case(depth, mix, ops, seed, traders):
+    resting, flow = make_case(depth, mix, ops, seed, traders)
+
+    # throughput, without measuring every action
+    engine, run = filled_engine(resting), copy_flow(flow)
+    gc.collect()
+    start = time.perf_counter()
+    fills, rejected = run_flow(engine, run)
+    elapsed = time.perf_counter() - start
+
+    # latency of every action
+    engine, run = filled_engine(resting), copy_flow(flow)
+    by_action = {"place": [], "cancel": [], "amend": []}
+    gc.collect()
+    run_flow(engine, run, by_action)
+    latencies = sorted(t for times in by_action.values() for t in times)
+    for times in by_action.values():
+        times.sort()
+
+    # peak memory of the book and the flow, tracemalloc slows everything down so it has its own run
+    run = copy_flow(flow)
+    gc.collect()
+    tracemalloc.start()
+    engine = filled_engine(resting)
+    run_flow(engine, run)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        "depth": depth,
+        "mix": mix,
+        "ops": ops,
+        "fills": fills,
+        "rejected": rejected,
+        "resting_after": len(engine.orders),
+        "ops_per_sec": ops / elapsed,
+        "latency_ns": latency_summary(latencies),
+        "latency_ns_by_action": dict((action, latency_summary(times)) for action, times in by_action.items()
+                                     if times),
+        "peak_memory_bytes": peak,
+    }
+
+
+def compare(results, baseline):
+    # ratios to the baseline: above 1 is faster, or more memory
+    cases = dict(((r["depth"], r["mix"]), r) for r in baseline["results"])
+    print("\ncompared with the baseline (%s):" % baseline.get("python", "?"))
+    for r in results:
+        b = cases.get((r["depth"], r["mix"]))
+        if b is None:
+            continue
+        print("%8d %-10s  ops/s x%.2f  p50 x%.2f  p99 x%.2f  memory x%.2f" % (
+            r["depth"], r["mix"], r["ops_per_sec"] / b["ops_per_sec"],
+            b["latency_ns"]["p50"] / r["latency_ns"]["p50"], b["latency_ns"]["p99"] / r["latency_ns"]["p99"],
+            r["peak_memory_bytes"] / b["peak_memory_bytes"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark of the matching engine")
+    parser.add_argument("--ops", type=int, default=50000, help="actions in every flow")
+    parser.add_argument("--depths", default="0,1000,100000", help="resting orders before the flow starts")
+    parser.add_argument("--mixes", default=",".join(MIXES), help="some of: " + ", ".join(MIXES))
+    parser.add_argument("--traders", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON file of an earlier run to compare with")
+    args = parser.parse_args()
+
+    results = []
+    print("   depth mix             ops/s    p50 us    p99 us  p99.9 us    peak MB")
+    for depth in [int(d) for d in args.depths.split(",")]:
+        for mix in args.mixes.split(","):
+            r = bench_case(depth, mix, args.ops, args.seed, args.traders)
+            results.append(r)
+            latency = r["latency_ns"]
+            print("%8d %-10s %10.0f %9.2f %9.2f %9.2f %10.1f" % (
+                depth, mix, r["ops_per_sec"], latency["p50"] / 1e3, latency["p99"] / 1e3,
+                latency["p99.9"] / 1e3, r["peak_memory_bytes"] / 1e6))
+            for action, latency in r["latency_ns_by_action"].items():
+                print("%19s %-6s %9s %9.2f %9.2f %9.2f" % (
+                    "", action, "", latency["p50"] / 1e3, latency["p99"] / 1e3, latency["p99.9"] / 1e3))
+
+    report = {"python": platform.python_version(), "time": time.time(), "seed": args.seed, "ops": args.ops,
+              "traders": args.traders, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
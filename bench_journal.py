@@ -0,0 +1,88 @@
+import argparse
+import random
+import shutil
+import tempfile
+import time
+from orders import *
+from server import Exchange
+import journal
+
+# Benchmark of the journal: how fast the requests can be appended and written (with and
+# without fsync), and how long the recovery of an exchange takes from the journal alone
+# and from a snapshot plus the journal after it.
+
+
+def requests(n, seed):
+    rnd = random.Random(seed)
+    flow = []
+    for i in range(n):
+        trader_id = rnd.randrange(1000)
+        order_id = rnd.randrange(10)
+        side = OrderSide.BUY if rnd.random() < 0.5 else OrderSide.SELL
+        r = rnd.random()
+        if r < 0.6:
+            o = LimitOrder(trader_id, "AAPL", rnd.randint(1, 100), 1000 + rnd.randint(-20, 20), side, i, order_id)
+            flow.append((ActionType.PLACE, trader_id, o))
+        elif r < 0.7:
+            flow.append((ActionType.PLACE, trader_id, MarketOrder(trader_id, "AAPL", rnd.randint(1, 100), side, i, order_id)))
+        elif r < 0.9:
+            flow.append((ActionType.CANCEL, trader_id, order_id))
+        else:
+            flow.append((ActionType.AMEND, trader_id, rnd.randint(1, 50), order_id))
+    return flow
+
+
+def bench_writes(flow, fsync):
+    directory = tempfile.mkdtemp()
+    try:
+        writer = journal.JournalWriter(directory, fsync=fsync)
+        writer.start()
+        start = time.perf_counter()
+        for request in flow:
+            writer.append(request)
+        appended = time.perf_counter() - start
+        writer.stop()
+        written = time.perf_counter() - start
+        print("fsync=%-5s append %9.0f records/s, written %9.0f records/s in %d batches" % (
+            fsync, len(flow) / appended, len(flow) / written, writer.batches))
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_recovery(flow, snapshot_at):
+    directory = tempfile.mkdtemp()
+    try:
+        exchange = Exchange()
+        writer = journal.JournalWriter(directory, fsync=False)
+        writer.start()
+        snapshotter = journal.Snapshotter(exchange, writer)
+        for i, request in enumerate(flow):
+            writer.append(request)
+            journal.apply(exchange, request)
+            if i + 1 == snapshot_at:
+                snapshotter.snapshot()
+        writer.stop()
+        start = time.perf_counter()
+        journal.recover(Exchange(), directory)
+        elapsed = time.perf_counter() - start
+        replayed = len(flow) - snapshot_at
+        print("snapshot after %8d requests, %8d replayed: recovery %.3f s" % (snapshot_at, replayed, elapsed))
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark of the journal and the recovery")
+    parser.add_argument("--requests", type=int, default=200000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    flow = requests(args.requests, args.seed)
+    for fsync in (True, False):
+        bench_writes(flow, fsync)
+    # the orders are changed by the matching, so every recovery run gets its own copy
+    for snapshot_at in (0, args.requests // 2, args.requests):
+        bench_recovery(requests(args.requests, args.seed), snapshot_at)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import argparse
+import gc
+import random
+import time
+import tracemalloc
+from orders import *
+from server import MatchingEngine
+
+# Memory benchmark of the matching engine:
+#   bytes per resting order    the order object, and its place in the price levels and the index
+#   bytes per fill             the fill records returned by handle_order
+#   peak bytes per trade       the most memory allocated at once while the trades were matched
+#   fills per second           matching speed, measured with tracemalloc off
+# Run "python bench_memory.py --orders 200000" for a bigger book.
+
+
+def resting_orders(n, seed):
+    # limit orders that do not cross: bids below 100, asks above
+    rnd = random.Random(seed)
+    orders = []
+    for i in range(n):
+        if i % 2:
+            orders.append(LimitOrder(i, "AAPL", rnd.randint(1, 100), 100 + rnd.randint(1, 50), OrderSide.SELL, i))
+        else:
+            orders.append(LimitOrder(i, "AAPL", rnd.randint(1, 100), 100 - rnd.randint(1, 50), OrderSide.BUY, i))
+    return orders
+
+
+def aggressive_orders(n, seed, first_id):
+    # market orders, each one sweeps a few resting orders
+    rnd = random.Random(seed)
+    side = (OrderSide.BUY, OrderSide.SELL)
+    return [MarketOrder(first_id + i, "AAPL", rnd.randint(50, 300), side[i % 2], first_id + i) for i in range(n)]
+
+
+def book(n, seed):
+    engine = MatchingEngine()
+    for o in resting_orders(n, seed):
+        engine.handle_order(o)
+    return engine
+
+
+def measure_resting(n, seed):
+    orders = resting_orders(n, seed)
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    engine = MatchingEngine()
+    for o in orders:
+        engine.handle_order(o)
+    engine_bytes = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    del orders
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    orders = resting_orders(n, seed)
+    order_bytes = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    return engine_bytes / n, order_bytes / n
+
+
+def measure_trades(n, trades, seed):
+    engine = book(n, seed)
+    aggressive = aggressive_orders(trades, seed, n)
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    fills = [engine.handle_order(o) for o in aggressive]
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    count = sum(len(f) for f in fills)
+    del fills
+    # the fills are returned to the caller, so what is still allocated is their memory
+    # (plus the lists they are in); the matching itself frees what it does not return
+    return count, (current - start) / max(count, 1), (peak - start) / trades
+
+
+def measure_speed(n, trades, seed):
+    engine = book(n, seed)
+    aggressive = aggressive_orders(trades, seed, n)
+    gc.collect()
+    start = time.perf_counter()
+    count = 0
+    for o in aggressive:
+        count += len(engine.handle_order(o))
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="memory use of the resting orders and the fills")
+    parser.add_argument("--orders", type=int, default=100000, help="resting orders in the book")
+    parser.add_argument("--trades", type=int, default=10000, help="market orders matched against them")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    engine_bytes, order_bytes = measure_resting(args.orders, args.seed)
+    print("resting orders:    %d" % args.orders)
+    print("bytes per order:   %.1f for the order object, %.1f for the book and the index" % (order_bytes, engine_bytes))
+    count, fill_bytes, peak_bytes = measure_trades(args.orders, args.trades, args.seed)
+    print("fills:             %d from %d market orders" % (count, args.trades))
+    print("bytes per fill:    %.1f" % fill_bytes)
+    print("peak per trade:    %.1f bytes" % peak_bytes)
+    print("fills per second:  %.0f" % measure_speed(args.orders, args.trades, args.seed))
+
+
+if __name__ == "__main__":
+    main()
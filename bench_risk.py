@@ -0,0 +1,52 @@
+import argparse
+import time
+from orders import *
+from server import Exchange
+from risk import RiskManager, RiskLimits
+import journal
+from bench_journal import requests
+
+# Overhead of the pre-trade risk checks: the same seeded flow of orders, amends and
+# cancels is applied to an Exchange without risk checks, with limits that every order
+# passes (all the checks run) and with tight limits that reject some of the orders. The
+# best of a few runs is taken, the difference per request is the cost of the checks.
+
+CASES = {
+    "none": None,
+    "passing": RiskLimits(max_quantity=10 ** 6, max_notional=10 ** 12, max_exposure=10 ** 15,
+                          max_position=10 ** 9, cash=True),
+    "tight": RiskLimits(max_quantity=80, max_notional=60000, max_exposure=150000, max_position=300, cash=True),
+}
+
+
+def run(limits, n, seed):
+    exchange = Exchange()
+    if limits is not None:
+        exchange.risk = RiskManager(limits)
+    flow = requests(n, seed)
+    start = time.perf_counter()
+    for request in flow:
+        journal.apply(exchange, request)
+    return time.perf_counter() - start, exchange
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark of the pre-trade risk checks")
+    parser.add_argument("--requests", type=int, default=200000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    base = None
+    for name, limits in CASES.items():
+        elapsed, exchange = min((run(limits, args.requests, args.seed) for _ in range(args.repeat)),
+                                key=lambda r: r[0])
+        ns = elapsed / args.requests * 1e9
+        if base is None:
+            base = ns
+        rejects = sum(exchange.risk.rejects.values()) if exchange.risk is not None else 0
+        print("%-8s %9.0f requests/s %7.0f ns/request %+6.0f ns  %d rejected" % (
+            name, args.requests / elapsed, ns, ns - base, rejects))
+
+
+if __name__ == "__main__":
+    main()
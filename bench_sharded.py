@@ -0,0 +1,82 @@
+import argparse
+import multiprocessing
+import os
+import random
+import time
+from orders import *
+from framing import BINARY_CODEC
+import binary_protocol
+from sharded import REQUEST, TRADER, run_shard, shard_of
+
+# Throughput of the shards of sharded.py with 1, 2, 4 ... shards, without the gateway and
+# the network: a seeded flow of orders spread over many symbols is encoded beforehand,
+# split by symbol like the gateway does and sent to the worker processes in chunks; the
+# time is measured until every shard has sent back the responses of all its chunks.
+# With the flow spread over enough symbols the throughput grows with the number of cores.
+
+
+def order_flow(n, symbols, seed):
+    rnd = random.Random(seed)
+    flow = []
+    for i in range(n):
+        trader_id = rnd.randrange(1000)
+        side = OrderSide.BUY if rnd.random() < 0.5 else OrderSide.SELL
+        symbol = "S%d" % rnd.randrange(symbols)
+        if rnd.random() < 0.8:
+            o = LimitOrder(trader_id, symbol, rnd.randint(1, 100), 1000 + rnd.randint(-10, 10), side, i, i)
+        else:
+            o = MarketOrder(trader_id, symbol, rnd.randint(1, 100), side, i, i)
+        flow.append((symbol, binary_protocol.encode_request((ActionType.PLACE, trader_id, o))))
+    return flow
+
+
+def bench(flow, shards, chunk):
+    context = multiprocessing.get_context("spawn")
+    requests = [context.Queue() for _ in range(shards)]
+    replies = context.Queue()
+    workers = [context.Process(target=run_shard, args=(shard, requests[shard], replies), daemon=True)
+               for shard in range(shards)]
+    for worker in workers:
+        worker.start()
+    # the responses are binary, like for the load generator
+    for q in requests:
+        q.put([(TRADER, trader_id, BINARY_CODEC) for trader_id in range(1000)])
+    for _ in range(shards):
+        replies.get()
+    parts = [[] for _ in range(shards)]
+    for symbol, data in flow:
+        parts[shard_of(symbol, shards)].append((REQUEST, 0, data))
+    chunks = 0
+    start = time.perf_counter()
+    for shard, part in enumerate(parts):
+        for i in range(0, len(part), chunk):
+            requests[shard].put(part[i:i + chunk])
+            chunks += 1
+    responses = 0
+    for _ in range(chunks):
+        responses += len(replies.get()[1])
+    elapsed = time.perf_counter() - start
+    for q in requests:
+        q.put(None)
+    for worker in workers:
+        worker.join()
+    print("%2d shards: %9.0f orders/s, %d responses" % (shards, len(flow) / elapsed, responses))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark of the shards of the sharded exchange")
+    parser.add_argument("--orders", type=int, default=200000)
+    parser.add_argument("--symbols", type=int, default=100)
+    parser.add_argument("--max-shards", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk", type=int, default=1000, help="requests sent to a shard in one message")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    flow = order_flow(args.orders, args.symbols, args.seed)
+    shards = 1
+    while shards <= args.max_shards:
+        bench(flow, shards, args.chunk)
+        shards *= 2
+
+
+if __name__ == "__main__":
+    main()
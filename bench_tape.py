@@ -0,0 +1,77 @@
+import argparse
+import random
+import shutil
+import tempfile
+import time
+from orders import *
+from server import Exchange
+from trade_tape import TradeTape, np
+import journal
+from bench_journal import requests
+
+# Cost of the trade tape on the matching path, and speed of its queries: the same seeded
+# flow is applied to an Exchange without and with a tape (the best of a few runs), then
+# the tape is filled up to --trades trades and the queries are timed over all of them.
+
+
+def run(n, seed, directory=None):
+    exchange = Exchange()
+    if directory is not None:
+        exchange.tape = TradeTape(directory)
+    flow = requests(n, seed)
+    start = time.perf_counter()
+    for request in flow:
+        journal.apply(exchange, request)
+    elapsed = time.perf_counter() - start
+    if exchange.tape is not None:
+        exchange.tape.close()
+    return elapsed
+
+
+def timed(name, f, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("%-16s %8.2f ms" % (name, best * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark of the trade tape")
+    parser.add_argument("--requests", type=int, default=200000)
+    parser.add_argument("--trades", type=int, default=2000000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    directory = tempfile.mkdtemp()
+    try:
+        base = min(run(args.requests, args.seed) for _ in range(args.repeat))
+        taped = min(run(args.requests, args.seed, tempfile.mkdtemp(dir=directory)) for _ in range(args.repeat))
+        print("without tape %7.0f ns/request, with tape %7.0f ns/request" % (
+            base / args.requests * 1e9, taped / args.requests * 1e9))
+        tape = TradeTape(tempfile.mkdtemp(dir=directory))
+        rnd = random.Random(args.seed)
+        start = time.perf_counter()
+        t = 1.7e9
+        for i in range(args.trades):
+            t += rnd.random() * 0.01
+            tape.append(t, 1000 + rnd.randint(-10, 10), rnd.randint(1, 100), rnd.randrange(1000),
+                        rnd.randrange(1000), OrderSide.BUY.value if i & 1 else OrderSide.SELL.value,
+                        "S%d" % (i % 10))
+        print("%d trades appended in %.2f s" % (args.trades, time.perf_counter() - start))
+        if np is not None:
+            timed("vwap", lambda: tape.vwap())
+            timed("vwap of S1", lambda: tape.vwap("S1"))
+            timed("1 minute bars", lambda: tape.ohlcv(60))
+            timed("trader volume", lambda: tape.trader_volume())
+        else:
+            print("the queries need numpy")
+        tape.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+import struct
+from orders import *
+
+# Fixed layout binary encoding of the requests and responses, an alternative to the JSON
+# dictionaries. Every message starts with the action type byte, the fields are packed
+# little-endian and the symbol, where there is one, takes the rest of the frame, so
+# this encoding needs the length-prefixed framing.
+# The order type byte of a limit order carries its time in force in the high 4 bits; for
+# DAY and GTD the expire time (a double, 0 in the request of a DAY order) comes after the
+# fixed fields, before the symbol.
+#
+# requests:
+#   PLACE    action, trader id, order id, order type, side, quantity, price (0 for market), time, symbol
+#   AMEND    action, trader id, order id, quantity
+#   CANCEL   action, trader id, order id
+#   BALANCE  action, trader id
+#   BATCH    action, trader id, number of requests, then every request prefixed with its length
+# responses:
+#   PLACE    action, trader id, order id, order type (0 for fills), side, is filled, order present,
+#            is limit, quantity, price (0 for market), time, symbol
+#   AMEND    action, order id, successfully, quantity
+#   CANCEL   action, order id, successfully
+#   BALANCE  action, balance, position, book position, realized P&L, unrealized P&L
+#   BATCH    action, number of responses, then every response prefixed with its length
+
+place_request = struct.Struct("<BIIBBqdd")
+amend_request = struct.Struct("<BIIq")
+cancel_request = struct.Struct("<BII")
+balance_request = struct.Struct("<BI")
+
+place_response = struct.Struct("<BIIBBBBBqdd")
+amend_response = struct.Struct("<BIBq")
+cancel_response = struct.Struct("<BIB")
+balance_response = struct.Struct("<Bdqqdd")
+
+batch_request = struct.Struct("<BIH")
+batch_response = struct.Struct("<BH")
+item_length = struct.Struct("<H") # of every request or response in a batch
+expire_time = struct.Struct("<d")
+
+# enum lookups by value without calling the Enum constructors
+order_types = (None, OrderType.LIMIT, OrderType.MARKET, OrderType.IOC)
+order_sides = (None, OrderSide.BUY, OrderSide.SELL)
+times_in_force = (TimeInForce.GTC, TimeInForce.DAY, TimeInForce.GTD)
+limit_type = OrderType.LIMIT
+gtc = TimeInForce.GTC
+
+PLACE = ActionType.PLACE.value
+AMEND = ActionType.AMEND.value
+CANCEL = ActionType.CANCEL.value
+BALANCE = ActionType.BALANCE.value
+BATCH = ActionType.BATCH.value
+LIMIT = OrderType.LIMIT.value
+MARKET = OrderType.MARKET.value
+IOC = OrderType.IOC.value
+
+
+def encode_order_type(o):
+    # the order type byte and, for DAY and GTD, the expire time
+    if o.type is limit_type and o.time_in_force is not gtc:
+        return LIMIT | o.time_in_force.value << 4, expire_time.pack(o.expires)
+    return o.type.value, b""
+
+
+def encode_request(t):
+    actionType = t[0]
+    if actionType == ActionType.PLACE:
+        o = t[2]
+        price = 0 if o.type == OrderType.MARKET else o.price
+        orderType, expires = encode_order_type(o)
+        return place_request.pack(PLACE, t[1], o.order_id, orderType, o.side.value, o.quantity, price, o.time) \
+            + expires + o.symbol.encode("utf-8")
+    elif actionType == ActionType.AMEND:
+        return amend_request.pack(AMEND, t[1], t[3], t[2])
+    elif actionType == ActionType.CANCEL:
+        return cancel_request.pack(CANCEL, t[1], t[2])
+    elif actionType == ActionType.BALANCE:
+        return balance_request.pack(BALANCE, t[1])
+    elif actionType == ActionType.BATCH:
+        return pack_items(batch_request.pack(BATCH, t[1], len(t[2])), [encode_request(r) for r in t[2]])
+    raise UndefinedTraderAction("Undefined Trader Action!")
+
+
+def decode_request(data):
+    # returns the same tuples as Exchange.convert_dic_from_trader_to_tuple_request
+    actionType = data[0]
+    if actionType == PLACE:
+        _, trader_id, order_id, orderType, side, quantity, price, time = place_request.unpack_from(data)
+        position = place_request.size
+        if orderType >> 4:
+            time_in_force = times_in_force[orderType >> 4]
+            orderType &= 15
+            expires = expire_time.unpack_from(data, position)[0]
+            position += expire_time.size
+        else:
+            time_in_force = TimeInForce.GTC
+            expires = 0
+        symbol = data[position:].decode("utf-8")
+        if orderType == LIMIT:
+            o = LimitOrder(trader_id, symbol, quantity, price, order_sides[side], time, order_id, time_in_force, expires)
+        elif orderType == MARKET:
+            o = MarketOrder(trader_id, symbol, quantity, order_sides[side], time, order_id)
+        elif orderType == IOC:
+            o = IOCOrder(trader_id, symbol, quantity, price, order_sides[side], time, order_id)
+        else:
+            raise UndefinedOrderType("Undefined Order Type!")
+        return (ActionType.PLACE, trader_id, o)
+    elif actionType == AMEND:
+        _, trader_id, order_id, quantity = amend_request.unpack(data)
+        return (ActionType.AMEND, trader_id, check_quantity(quantity), order_id)
+    elif actionType == CANCEL:
+        _, trader_id, order_id = cancel_request.unpack(data)
+        return (ActionType.CANCEL, trader_id, order_id)
+    elif actionType == BALANCE:
+        return (ActionType.BALANCE, balance_request.unpack(data)[1])
+    elif actionType == BATCH:
+        _, trader_id, count = batch_request.unpack_from(data)
+        return (ActionType.BATCH, trader_id,
+                [of_trader(decode_request(item), trader_id) for item in unpack_items(data, batch_request.size, count)])
+    raise UndefinedTraderAction("Undefined Trader Action!")
+
+
+def of_trader(request, trader_id):
+    # a request of a batch is made on behalf of the trader of the batch, whatever trader
+    # id it has, like in the JSON batches
+    if request[0] == ActionType.PLACE:
+        request[2].id = trader_id
+    return (request[0], trader_id) + request[2:]
+
+
+def encode_response(t):
+    # t is a response tuple of the Exchange, see Exchange.convert_tuple_from_exchange_to_dic
+    actionType = t[0]
+    if actionType == ActionType.PLACE:
+        o = t[1]
+        if isinstance(o, FilledOrder):
+            return place_response.pack(PLACE, o.id, o.order_id, 0, o.side.value, 1, t[2], o.limit,
+                                       o.quantity, o.price, o.time) + o.symbol.encode("utf-8")
+        price = 0 if o.type == OrderType.MARKET else o.price
+        orderType, expires = encode_order_type(o)
+        return place_response.pack(PLACE, o.id, o.order_id, orderType, o.side.value, 0, t[2], 0,
+                                   o.quantity, price, o.time) + expires + o.symbol.encode("utf-8")
+    elif actionType == ActionType.AMEND:
+        return amend_response.pack(AMEND, t[3], t[1], t[2])
+    elif actionType == ActionType.CANCEL:
+        return cancel_response.pack(CANCEL, t[2], t[1])
+    elif actionType == ActionType.BALANCE:
+        return balance_response.pack(BALANCE, *t[1])
+    elif actionType == ActionType.BATCH:
+        return pack_items(batch_response.pack(BATCH, len(t[1])), [encode_response(r) for r in t[1]])
+    raise UndefinedResponse("Undefined Response!")
+
+
+def decode_response(data):
+    # returns the same tuples as Trader.convert_dic_from_exchange_to_tuple
+    actionType = data[0]
+    if actionType == PLACE:
+        _, trader_id, order_id, orderType, side, isFilled, isPresent, isLimit, quantity, price, time = \
+            place_response.unpack_from(data)
+        position = place_response.size
+        if orderType >> 4:
+            time_in_force = times_in_force[orderType >> 4]
+            orderType &= 15
+            expires = expire_time.unpack_from(data, position)[0]
+            position += expire_time.size
+        else:
+            time_in_force = TimeInForce.GTC
+            expires = 0
+        symbol = data[position:].decode("utf-8")
+        side = order_sides[side]
+        if isFilled:
+            o = FilledOrder(trader_id, symbol, quantity, price, side, time, bool(isLimit), order_id)
+        elif orderType == LIMIT:
+            o = LimitOrder(trader_id, symbol, quantity, price, side, time, order_id, time_in_force, expires)
+        elif orderType == MARKET:
+            o = MarketOrder(trader_id, symbol, quantity, side, time, order_id)
+        elif orderType == IOC:
+            o = IOCOrder(trader_id, symbol, quantity, price, side, time, order_id)
+        else:
+            raise UndefinedOrderType("Undefined Order Type!")
+        return (ActionType.PLACE, o, bool(isPresent))
+    elif actionType == AMEND:
+        _, order_id, successfully, quantity = amend_response.unpack(data)
+        return (ActionType.AMEND, bool(successfully), quantity, order_id)
+    elif actionType == CANCEL:
+        _, order_id, successfully = cancel_response.unpack(data)
+        return (ActionType.CANCEL, bool(successfully), order_id)
+    elif actionType == BALANCE:
+        return (ActionType.BALANCE, balance_response.unpack(data)[1:])
+    elif actionType == BATCH:
+        _, count = batch_response.unpack_from(data)
+        return (ActionType.BATCH, [decode_response(item) for item in unpack_items(data, batch_response.size, count)])
+    raise UndefinedResponse("Undefined Response Received!")
+
+
+def pack_items(header, items):
+    parts = [header]
+    for item in items:
+        parts.append(item_length.pack(len(item)))
+        parts.append(item)
+    return b"".join(parts)
+
+
+def unpack_items(data, position, count):
+    items = []
+    for _ in range(count):
+        length = item_length.unpack_from(data, position)[0]
+        position += item_length.size
+        items.append(data[position:position + length])
+        position += length
+    return items
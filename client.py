@@ -7,54 +7,78 @@ from server import *
 import json
 import random
 import select
+import argparse
+import logging
+import asyncio
+import collections
+import binary_protocol
+from async_server import read_frame
 
 
 HOST, PORT = "127.0.0.1", 9999
+logger = logging.getLogger("trader")
 
 class Trader(Thread):
-    def __init__(self,lock, id):
+    # the limit orders of random_action are GTD, the exchange cancels them after this many
+    # seconds if they are still in the book
+    order_lifetime = 10
+
+    def __init__(self,lock, id, framing=LENGTH_PREFIXED, codec=JSON_CODEC):
         super().__init__()
         self.id = id
         self.lock = lock
+        self.framing = framing
+        self.codec = codec
         self.book_position = 0
         self.balance_track = [1000000]
         self.owned_positions = [1000000]
 
-    def place_limit_order(self, quantity=None, price=None, side=None):
-        return (ActionType.PLACE,self.id,LimitOrder(self.id,"AAPL",quantity,price,side,time.time()))
+    def place_limit_order(self, quantity=None, price=None, side=None, order_id=0, time_in_force=TimeInForce.GTC, expires=0):
+        return (ActionType.PLACE,self.id,LimitOrder(self.id,"AAPL",quantity,price,side,time.time(),order_id,time_in_force,expires))
 
-    def place_market_order(self, quantity=None, side=None):
-        return (ActionType.PLACE,self.id,MarketOrder(self.id,"AAPL",quantity,side,time.time()))
+    def place_market_order(self, quantity=None, side=None, order_id=0):
+        return (ActionType.PLACE,self.id,MarketOrder(self.id,"AAPL",quantity,side,time.time(),order_id))
 
-    def place_ioc_order(self, quantity=None, price=None, side=None):
-        return (ActionType.PLACE,self.id,IOCOrder(self.id,"AAPL",quantity,price,side,time.time()))
+    def place_ioc_order(self, quantity=None, price=None, side=None, order_id=0):
+        return (ActionType.PLACE,self.id,IOCOrder(self.id,"AAPL",quantity,price,side,time.time(),order_id))
 
-    def amend_quantity(self, quantity=None):
-        return (ActionType.AMEND,self.id,quantity)
+    def amend_quantity(self, quantity=None, order_id=0):
+        return (ActionType.AMEND,self.id,quantity,order_id)
 
-    def cancel_order(self):
-        return (ActionType.CANCEL,self.id)
+    def cancel_order(self, order_id=0):
+        return (ActionType.CANCEL,self.id,order_id)
 
     def balance_and_position(self):
         return (ActionType.BALANCE,self.id)
 
+    def batch(self, actions):
+        # actions made by the methods above, sent in one message
+        return (ActionType.BATCH,self.id,actions)
+
     def convert_tuple_to_dic_action(self, t):
         dic = {"ActionType":t[0].value,"TraderID":t[1]}
         if t[0]==ActionType.PLACE:
             o = t[2]
             dic["OrderType"]=o.type.value
+            dic["OrderID"] = o.order_id
             dic["Symbol"] = o.symbol
             dic["Quantity"] = o.quantity
             dic["Side"] = o.side.value
             dic["Time"] = o.time
             if not isinstance(o,MarketOrder):
                 dic["Price"] = o.price
+            if isinstance(o,LimitOrder) and o.time_in_force!=TimeInForce.GTC:
+                dic["TimeInForce"] = o.time_in_force.value
+                dic["ExpireTime"] = o.expires
         elif t[0]==ActionType.AMEND:
             dic["Quantity"] = t[2]
+            dic["OrderID"] = t[3]
         elif t[0]==ActionType.CANCEL:
-            pass
+            dic["OrderID"] = t[2]
         elif t[0]==ActionType.BALANCE:
             pass
+        elif t[0]==ActionType.BATCH:
+            dic["Actions"] = [self.convert_tuple_to_dic_action(a) for a in t[2]]
 
 
         return dic
@@ -64,26 +88,42 @@ class Trader(Thread):
         if actionType==ActionType.PLACE:
             isPresent = bool(dic["OrderPresent"])
             trader_id = dic["TraderID"]
+            order_id = dic.get("OrderID", 0)
             if dic["IsFilledOrder"]:
-                o = FilledOrder(trader_id,dic["Symbol"],dic["Quantity"],dic["Price"],OrderSide(dic["Side"]),dic["Time"])
+                o = FilledOrder(trader_id,dic["Symbol"],dic["Quantity"],dic["Price"],OrderSide(dic["Side"]),dic["Time"],bool(dic["IsLimit"]),order_id)
             else:
                 orderType = OrderType(dic["OrderType"])
                 if orderType == OrderType.LIMIT:
-                    o = LimitOrder(trader_id, dic["Symbol"], dic["Quantity"], dic["Price"], OrderSide(dic["Side"]), dic["Time"])
+                    o = LimitOrder(trader_id, dic["Symbol"], dic["Quantity"], dic["Price"], OrderSide(dic["Side"]), dic["Time"], order_id,
+                                   TimeInForce(dic.get("TimeInForce", 0)), dic.get("ExpireTime", 0))
                 elif orderType == OrderType.MARKET:
-                    o = MarketOrder(trader_id, dic["Symbol"], dic["Quantity"], OrderSide(dic["Side"]), dic["Time"])
+                    o = MarketOrder(trader_id, dic["Symbol"], dic["Quantity"], OrderSide(dic["Side"]), dic["Time"], order_id)
                 elif orderType == OrderType.IOC:
-                    o = IOCOrder(trader_id, dic["Symbol"], dic["Price"], dic["Quantity"], OrderSide(dic["Side"]), dic["Time"])
+                    o = IOCOrder(trader_id, dic["Symbol"], dic["Quantity"], dic["Price"], OrderSide(dic["Side"]), dic["Time"], order_id)
             return (actionType, o,isPresent)
         elif actionType == ActionType.AMEND:
-            return (actionType, bool(dic["Successfully"]), dic["Quantity"])
+            return (actionType, bool(dic["Successfully"]), dic["Quantity"], dic.get("OrderID", 0))
         elif actionType == ActionType.CANCEL:
-            return (actionType, bool(dic["Successfully"]))
+            return (actionType, bool(dic["Successfully"]), dic.get("OrderID", 0))
         elif actionType == ActionType.BALANCE:
-            return (actionType,(dic["Balance"],dic["Position"],dic["BookPosition"]))
+            # the exchanges without P&L do not send it
+            return (actionType,(dic["Balance"],dic["Position"],dic["BookPosition"],
+                                dic.get("RealizedPnL", 0.0),dic.get("UnrealizedPnL", 0.0)))
+        elif actionType == ActionType.BATCH:
+            return (actionType,[self.convert_dic_from_exchange_to_tuple(d) for d in dic["Responses"]])
         else:
             raise UndefinedTraderAction
 
+    def encode_action(self, t):
+        if self.codec == BINARY_CODEC:
+            return binary_protocol.encode_request(t)
+        return json.dumps(self.convert_tuple_to_dic_action(t))
+
+    def decode_response(self, data):
+        if self.codec == BINARY_CODEC:
+            return binary_protocol.decode_response(data)
+        return self.convert_dic_from_exchange_to_tuple(json.loads(data))
+
     def process_response(self, response):
         # Implement this function
         # You need to process each order according to the type (by enum) given by the 'response' variable
@@ -117,6 +157,9 @@ class Trader(Thread):
             cancelled_successfully = response[1]
             if cancelled_successfully:
                 self.book_position = 0
+        elif actionType==ActionType.BATCH:
+            for r in response[1]:
+                self.process_response(r)
         else: # actionType==ActionType.BALANCE:
             # it's weird that we have two ways to update balance and book position
             # I will not use this method (updating by values from the matching engine) to avoid confusion
@@ -156,7 +199,8 @@ class Trader(Thread):
                 price = 1000# + random.randint(-10,10)
                 if orderType == OrderType.LIMIT:
                     #self.book_position = quantity
-                    return self.place_limit_order(quantity, price, side)
+                    return self.place_limit_order(quantity, price, side, time_in_force=TimeInForce.GTD,
+                                                  expires=time.time() + self.order_lifetime)
                 elif orderType == OrderType.MARKET:
                     return self.place_market_order(quantity, side)
                 else:  # orderType==OrderType.IOC
@@ -166,7 +210,8 @@ class Trader(Thread):
                 price = 1000# + random.randint(-10,10)# random.uniform(10/quantity,1000000/quantity)
                 if orderType==OrderType.LIMIT:
                     #self.book_position = quantity
-                    return self.place_limit_order(quantity, price, side)
+                    return self.place_limit_order(quantity, price, side, time_in_force=TimeInForce.GTD,
+                                                  expires=time.time() + self.order_lifetime)
                 elif orderType==OrderType.MARKET:
                     return self.place_market_order(quantity,side)
                 else: # orderType==OrderType.IOC
@@ -190,11 +235,14 @@ class Trader(Thread):
         sock.bind(("127.0.0.{}".format(self.id+2), 9999))
         # Connect to server and send data
         sock.connect((HOST, PORT))
-        send_fixed_len(sock,str(self.id))
-        received = recv_fixed_len(sock)
-        self.lock.acquire()
-        print("my id was accepted by the server. It's {}".format(received))
-        self.lock.release()
+        # the handshake is always sent with fixed length framing
+        reader = FrameReader(sock)
+        send_fixed_len(sock,handshake_request(self.id, self.framing, self.codec))
+        received = reader.recv()
+        # the exchange tells which framing and codec it accepted
+        self.framing, self.codec = parse_handshake_reply(received)
+        reader.framing = self.framing
+        logger.info("my id was accepted by the server. It's %s", received)
         i = 0
         time.sleep(5)
         sock.settimeout(1)
@@ -203,36 +251,235 @@ class Trader(Thread):
             if self.balance_track[-1]>0:
                 ra = self.random_action()
                 if ra is not None:
-                    to_send = json.dumps(self.convert_tuple_to_dic_action(ra))
-                    send_fixed_len(sock,to_send)
-                    self.lock.acquire()
-                    print("Trader with id = {} Sent:     {}".format(self.id, to_send))
-                    self.lock.release()
+                    to_send = self.encode_action(ra)
+                    send_msg(sock,to_send,self.framing)
+                    logger.debug("Trader with id = %s Sent:     %s", self.id, to_send)
             while True:
                 try:
-                    received = recv_fixed_len(sock)
+                    received = reader.read_frame()
                 except socket.timeout as e:
                     err = e.args[0]
                     if err == 'timed out':
                         break
-                self.lock.acquire()
-                print("Trader with id = {} Received: {}".format(self.id, received))
-                self.lock.release()
-                self.process_response(self.convert_dic_from_exchange_to_tuple(json.loads(received)))
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Trader with id = %s Received: %s", self.id,
+                                 received.decode("utf-8") if self.codec == JSON_CODEC else received)
+                self.process_response(self.decode_response(received))
                 i += 1
             time.sleep(1)
-        self.lock.acquire()
-        print("trader with id =  {} is closing the connection".format(self.id))
-        self.lock.release()
+        logger.info("trader with id =  %s is closing the connection", self.id)
         sock.close()
 
 
+class LoadGenerator():
+    # Capacity test of the exchange: a lot of simulated traders on one asyncio event loop,
+    # each with its own connection (no bind to 127.0.0.{id+2}, so there is no limit of 250).
+    # The requests arrive open loop, at random (Poisson) times at the given total rate,
+    # whatever the responses do. The round trip of a request is measured from the time it
+    # should have been sent, so a client that falls behind does not hide the latency, to
+    # the first response for it: the responses are matched to the requests by
+    # (action type, order id), in the order they were sent when there are several for the
+    # same order (amends of one order), the BALANCE ones by their order per trader.
+    actions = (ActionType.PLACE, ActionType.AMEND, ActionType.CANCEL, ActionType.BALANCE)
+    # weights of limit, market and ioc orders, amends, cancels and balance requests
+    mix = (40, 10, 10, 10, 20, 10)
+    percentiles = (50, 90, 99, 99.9)
+    connect_concurrency = 50 # the threaded server only has a short listen queue
+
+    def __init__(self, traders=1000, rate=1000, duration=10, base_id=0, framing=LENGTH_PREFIXED,
+                 codec=BINARY_CODEC, trading_delay=5, seed=None, symbols=1):
+        self.trader_ids = list(range(base_id, base_id + traders))
+        # the orders are spread over this many symbols, for the sharded exchange
+        self.symbols = ["AAPL"] if symbols == 1 else ["S%d" % i for i in range(symbols)]
+        self.rate = rate
+        self.duration = duration
+        self.framing = framing
+        self.codec = codec
+        self.trading_delay = trading_delay # the exchange waits this long after a connection
+        self.rnd = random.Random(seed)
+        # only used for its encoding and decoding of the messages
+        self.coder = Trader(None, 0, framing, codec)
+        self.writers = {}
+        self.next_order_id = dict.fromkeys(self.trader_ids, 0)
+        self.resting = dict((trader_id, []) for trader_id in self.trader_ids) # order ids that may rest
+        # (action, order id) -> deque of the times of the requests without a response yet
+        self.pending = dict((trader_id, {}) for trader_id in self.trader_ids)
+        self.pending_balance = dict((trader_id, collections.deque()) for trader_id in self.trader_ids)
+        self.sent = dict.fromkeys(self.actions, 0)
+        self.latencies = dict((action, []) for action in self.actions)
+        self.responses = 0
+
+    async def connect(self, trader_id, limit):
+        async with limit:
+            reader, writer = await asyncio.open_connection(HOST, PORT)
+            writer.write(frame(handshake_request(trader_id, self.framing, self.codec)))
+            framing, codec = parse_handshake_reply((await read_frame(reader)).decode("utf-8"))
+        if (framing, codec) != (self.framing, self.codec):
+            raise ValueError("The exchange accepted {} {} instead of {} {}".format(
+                framing, codec, self.framing, self.codec))
+        self.writers[trader_id] = writer
+        return reader
+
+    async def read_responses(self, trader_id, reader):
+        pending = self.pending[trader_id]
+        pending_balance = self.pending_balance[trader_id]
+        latencies = self.latencies
+        decode_response = self.coder.decode_response
+        clock = time.perf_counter
+        try:
+            while True:
+                response = decode_response(await read_frame(reader, self.framing))
+                now = clock()
+                self.responses += 1
+                actionType = response[0]
+                if actionType == ActionType.PLACE:
+                    key = (actionType, response[1].order_id)
+                elif actionType == ActionType.BALANCE:
+                    if pending_balance:
+                        latencies[actionType].append(now - pending_balance.popleft())
+                    continue
+                else:
+                    key = (actionType, response[-1])
+                # the fills of resting orders come later, their round trip is already counted
+                starts = pending.get(key)
+                if starts:
+                    latencies[actionType].append(now - starts.popleft())
+                    if not starts:
+                        del pending[key]
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    def next_request(self, trader_id):
+        rnd = self.rnd
+        resting = self.resting[trader_id]
+        kind = rnd.choices(range(6), weights=self.mix)[0]
+        if kind in (3, 4) and resting:
+            i = rnd.randrange(len(resting))
+            resting[i], resting[-1] = resting[-1], resting[i]
+            if kind == 3:
+                order_id = resting[-1]
+                return (ActionType.AMEND, trader_id, rnd.randint(1, 50), order_id), order_id
+            order_id = resting.pop()
+            return (ActionType.CANCEL, trader_id, order_id), order_id
+        if kind == 5:
+            return (ActionType.BALANCE, trader_id), None
+        self.next_order_id[trader_id] += 1
+        order_id = self.next_order_id[trader_id]
+        side = OrderSide.BUY if rnd.random() < 0.5 else OrderSide.SELL
+        quantity = rnd.randint(1, 100)
+        # around 1000, so that some of the orders cross
+        price = 1000 + rnd.randint(-10, 10)
+        symbol = rnd.choice(self.symbols)
+        if kind == 1:
+            o = MarketOrder(trader_id, symbol, quantity, side, time.time(), order_id)
+        elif kind == 2:
+            o = IOCOrder(trader_id, symbol, quantity, price, side, time.time(), order_id)
+        else:
+            o = LimitOrder(trader_id, symbol, quantity, price, side, time.time(), order_id)
+            resting.append(order_id)
+        return (ActionType.PLACE, trader_id, o), order_id
+
+    async def send_requests(self):
+        rnd = self.rnd
+        clock = time.perf_counter
+        start = clock()
+        due = start
+        end = start + self.duration
+        while True:
+            due += rnd.expovariate(self.rate)
+            if due >= end:
+                break
+            delay = due - clock()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            trader_id = rnd.choice(self.trader_ids)
+            request, order_id = self.next_request(trader_id)
+            actionType = request[0]
+            if actionType == ActionType.BALANCE:
+                self.pending_balance[trader_id].append(due)
+            else:
+                pending = self.pending[trader_id]
+                key = (actionType, order_id)
+                if key not in pending:
+                    pending[key] = collections.deque()
+                pending[key].append(due)
+            self.sent[actionType] += 1
+            self.writers[trader_id].write(frame(self.coder.encode_action(request), self.framing))
+        return clock() - start
+
+    async def run(self, drain=2):
+        limit = asyncio.Semaphore(self.connect_concurrency)
+        readers = await asyncio.gather(*[self.connect(trader_id, limit) for trader_id in self.trader_ids])
+        logger.info("%s traders connected, trading starts in %s s", len(readers), self.trading_delay)
+        await asyncio.sleep(self.trading_delay)
+        tasks = [asyncio.create_task(self.read_responses(trader_id, reader))
+                 for trader_id, reader in zip(self.trader_ids, readers)]
+        elapsed = await self.send_requests()
+        # the responses to the last requests
+        await asyncio.sleep(drain)
+        for writer in self.writers.values():
+            writer.close()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        results = {"traders": len(self.trader_ids), "rate": self.rate, "duration": elapsed,
+                   "responses": self.responses, "actions": {}}
+        for action in self.actions:
+            latencies = sorted(self.latencies[action])
+            r = {"sent": self.sent[action], "completed": len(latencies), "per_sec": len(latencies) / elapsed}
+            if latencies:
+                for p in self.percentiles:
+                    r["p%s_ms" % p] = latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] * 1e3
+                r["max_ms"] = latencies[-1] * 1e3
+            results["actions"][action.name] = r
+        return results
+
+
+def print_load_results(results):
+    print("{} traders, {:.0f} requests/s offered for {:.1f} s, {} responses".format(
+        results["traders"], results["rate"], results["duration"], results["responses"]))
+    print("action       sent  completed    per s   p50 ms   p90 ms   p99 ms p99.9 ms   max ms")
+    for name, r in results["actions"].items():
+        line = "{:<8} {:>8} {:>10} {:>8.0f}".format(name, r["sent"], r["completed"], r["per_sec"])
+        if r["completed"]:
+            line += "".join(" {:>8.2f}".format(r[k]) for k in ("p50_ms", "p90_ms", "p99_ms", "p99.9_ms", "max_ms"))
+        print(line)
+
+
 
 
 if __name__=="__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--framing", choices=FRAMINGS, default=LENGTH_PREFIXED,
+                        help="\"fixed\" pads every message to 1024 bytes like the old clients")
+    parser.add_argument("--codec", choices=CODECS, default=JSON_CODEC,
+                        help="\"binary\" needs the length-prefixed framing")
+    parser.add_argument("--load", action="store_true",
+                        help="capacity test: simulate --traders traders sending --rate requests per second")
+    parser.add_argument("--traders", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=1000, help="requests per second of all the traders")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to send requests for")
+    parser.add_argument("--base-id", type=int, default=0, help="id of the first simulated trader")
+    parser.add_argument("--symbols", type=int, default=1, help="number of symbols the orders of --load are spread over")
+    parser.add_argument("--output", help="also write the results of --load to this JSON file")
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    setup_logging(args.log, args.log_file)
+    if args.load:
+        generator = LoadGenerator(args.traders, args.rate, args.duration, args.base_id, args.framing, args.codec,
+                                  symbols=args.symbols)
+        results = asyncio.run(generator.run())
+        print_load_results(results)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+        sys.exit()
     lock = threading.Lock()
     n_tr = 100
-    traders = [Trader(lock,i) for i in range(n_tr)]
+    traders = [Trader(lock,i,args.framing,args.codec) for i in range(n_tr)]
     for t in traders:
         t.start()
     for t in traders:
@@ -0,0 +1,84 @@
+import queue
+import socket
+import threading
+from framing import *
+
+# Outbound side of the trader connections of the threaded server.
+# The exchange only puts the encoded responses on the queue of the connection, and a
+# writer thread per connection sends them, so a slow or stuck trader socket never
+# holds up matching for everybody else.
+#
+# What happens when a trader does not read its messages and its queue fills up:
+# DISCONNECT  the connection is closed and the messages for it are dropped
+# BLOCK       the exchange waits until there is room again (like the old direct sends)
+DISCONNECT = "disconnect"
+BLOCK = "block"
+SLOW_CLIENT_POLICIES = (DISCONNECT, BLOCK)
+
+
+class TraderConnection():
+    queue_size = 10000 # messages waiting to be sent to one trader
+    slow_client_policy = DISCONNECT
+    max_batch = 256 # messages sent with one sendall
+
+    def __init__(self, sock, framing=FIXED, codec=JSON_CODEC):
+        self.sock = sock
+        # the responses are sent as soon as they are there, without Nagle's algorithm
+        # holding them back for the delayed ACK of the previous ones (asyncio does the same)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.framing = framing
+        self.codec = codec
+        self.outbound = queue.Queue(self.queue_size)
+        self.closed = False
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def send(self, msg):
+        # can be called from the threads of several symbols, the queue keeps their order
+        if self.closed:
+            return
+        try:
+            self.outbound.put_nowait(msg)
+        except queue.Full:
+            if self.slow_client_policy == BLOCK:
+                self.outbound.put(msg)
+            else:
+                self.close()
+
+    def write_loop(self):
+        outbound = self.outbound
+        framing = self.framing
+        while not self.closed:
+            msg = outbound.get()
+            if msg is None:
+                break
+            # whatever else is already waiting goes out with the same sendall
+            batch = [frame(msg, framing)]
+            try:
+                while len(batch) < self.max_batch:
+                    msg = outbound.get_nowait()
+                    if msg is None:
+                        break
+                    batch.append(frame(msg, framing))
+            except queue.Empty:
+                pass
+            try:
+                self.sock.sendall(b"".join(batch))
+            except OSError:
+                self.close()
+            if msg is None:
+                break
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            # this also ends the reading loop of the request handler
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.outbound.put_nowait(None) # wakes up the writer thread
+        except queue.Full:
+            pass
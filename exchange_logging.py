@@ -0,0 +1,40 @@
+import logging
+import logging.handlers
+import queue
+import sys
+
+# Logging for the exchange and the traders.
+# Every record is put on a queue by a QueueHandler and written by the background thread
+# of a QueueListener, so the matching and the trader threads never wait for the terminal
+# or the disk. The dumps of every message sent and received are logged at DEBUG, which
+# is only enabled in the debug mode; the production mode logs INFO and above.
+DEBUG_MODE = "debug"
+PRODUCTION_MODE = "production"
+LOG_MODES = (DEBUG_MODE, PRODUCTION_MODE)
+
+log_format = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+def setup_logging(mode=PRODUCTION_MODE, log_file=None, max_bytes=50 * 1024 * 1024, backup_count=5):
+    # returns the started QueueListener, stop it to flush the queue on exit
+    if log_file:
+        sink = logging.handlers.RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count)
+    else:
+        sink = logging.StreamHandler(sys.stdout)
+    sink.setFormatter(logging.Formatter(log_format))
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, sink)
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(logging.DEBUG if mode == DEBUG_MODE else logging.INFO)
+    listener.start()
+    return listener
+
+
+def add_logging_arguments(parser):
+    parser.add_argument("--log", choices=LOG_MODES, default=PRODUCTION_MODE,
+                        help="\"debug\" also logs every message sent and received")
+    parser.add_argument("--log-file", default=None,
+                        help="write the log to this rotating file instead of the terminal")
@@ -0,0 +1,113 @@
+import struct
+
+# Framing of the messages sent between the traders and the exchange.
+# FIXED is the original format: every message is padded with spaces to msg_len bytes.
+# LENGTH_PREFIXED sends a 4 byte big-endian length followed by the message itself.
+# The handshake (the trader id) is always sent FIXED, so that old clients keep working,
+# and the trader asks for LENGTH_PREFIXED in it, see handshake_request.
+FIXED = "fixed"
+LENGTH_PREFIXED = "length"
+FRAMINGS = (FIXED, LENGTH_PREFIXED)
+
+# The messages themselves are JSON dictionaries or use the binary encoding of
+# binary_protocol.py, which is only available with LENGTH_PREFIXED framing.
+JSON_CODEC = "json"
+BINARY_CODEC = "binary"
+CODECS = (JSON_CODEC, BINARY_CODEC)
+
+
+class ConnectionClosed(Exception):
+    pass
+
+
+# I always send messages 1024 bytes long
+msg_len = 1024
+def my_send(data):
+    return bytes(data+" ".join([""]*(msg_len-len(data)+1)),"utf-8")
+def send_fixed_len(sock,msg):
+    return sock.sendall(my_send(msg))
+def recv_fixed_len(sock):
+    return FrameReader(sock).recv()
+
+
+length_header = struct.Struct(">I")
+
+def frame(msg, framing=FIXED):
+    if isinstance(msg, str):
+        msg = msg.encode("utf-8")
+    if framing == LENGTH_PREFIXED:
+        return length_header.pack(len(msg)) + msg
+    return msg.ljust(msg_len)
+
+def send_msg(sock, msg, framing=FIXED):
+    return sock.sendall(frame(msg, framing))
+
+
+class FrameReader():
+    # Buffers whatever the socket returns, so that a frame split over several recv calls
+    # and several frames returned by one recv call are both handled.
+    # A socket timeout leaves the buffer untouched, the next call continues the frame.
+    def __init__(self, sock, framing=FIXED):
+        self.sock = sock
+        self.framing = framing
+        self.buffer = bytearray()
+
+    def buffered_frame(self):
+        # the next frame if it has been received completely, otherwise None
+        buf = self.buffer
+        if self.framing == LENGTH_PREFIXED:
+            if len(buf) < length_header.size:
+                return None
+            end = length_header.size + length_header.unpack_from(buf)[0]
+            if len(buf) < end:
+                return None
+            data = bytes(buf[length_header.size:end])
+        else:
+            end = msg_len
+            if len(buf) < end:
+                return None
+            data = bytes(buf[:end]).rstrip(b" ")
+        del buf[:end]
+        return data
+
+    def read_frame(self):
+        while True:
+            data = self.buffered_frame()
+            if data is not None:
+                return data
+            chunk = self.sock.recv(65536 if self.framing == LENGTH_PREFIXED else msg_len - len(self.buffer))
+            if not chunk:
+                raise ConnectionClosed("Connection Closed By The Peer!")
+            self.buffer += chunk
+
+    def recv(self):
+        return self.read_frame().decode("utf-8")
+
+
+def handshake_request(trader_id, framing=FIXED, codec=JSON_CODEC):
+    # old clients only send their id
+    if framing == FIXED and codec == JSON_CODEC:
+        return str(trader_id)
+    return "{} {} {}".format(trader_id, framing, codec)
+
+def parse_handshake(msg):
+    # returns (trader_id, framing, codec, reply to send back)
+    # the reply tells the trader which framing and codec were accepted
+    fields = msg.split()
+    trader_id = int(fields[0])
+    if trader_id < 0:
+        raise ValueError("Trader ID Must Not Be Negative!")
+    if len(fields) < 2:
+        return trader_id, FIXED, JSON_CODEC, str(trader_id)
+    framing = fields[1] if fields[1] in FRAMINGS else FIXED
+    codec = fields[2] if len(fields) > 2 and fields[2] in CODECS else JSON_CODEC
+    if framing == FIXED:
+        codec = JSON_CODEC
+    return trader_id, framing, codec, "{} {} {}".format(trader_id, framing, codec)
+
+def parse_handshake_reply(msg):
+    # returns (framing, codec) accepted by the exchange
+    fields = msg.split()
+    if len(fields) < 3:
+        return FIXED, JSON_CODEC
+    return fields[1], fields[2]
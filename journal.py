@@ -0,0 +1,282 @@
+import glob
+import logging
+import os
+import pickle
+import queue
+import struct
+import threading
+import time
+import zlib
+from contextlib import ExitStack
+from orders import *
+from accounts import AccountStore
+from pnl import PnLEngine
+import binary_protocol
+
+# Write-ahead journal of the requests that change the state of the exchange (PLACE, AMEND
+# and CANCEL), and snapshots of the books and the accounts, so that the state survives a
+# restart of the server.
+#
+# The requests are encoded with binary_protocol and appended by the thread that handles
+# them, while it holds the lock of the symbol, so their order in the journal is the order
+# in which they were matched. Appending only puts the record on a queue: a writer thread
+# writes whatever has piled up with one write and one fsync (group commit). The responses
+# are not held back until then, so what was handled in the last moments before a crash
+# can be missing from the journal.
+#
+# Files in the journal directory:
+#   journal-<first sequence number>.log   records: length, sequence number, crc32, request
+#   snapshot-<sequence number>.pickle     the state after that request
+# When a snapshot has been written a new journal file is started, and the older journal
+# files and snapshots are deleted. Recovery loads the latest snapshot and replays the
+# records after it.
+
+logger = logging.getLogger("exchange.journal")
+
+record_header = struct.Struct("<IQI") # length of the request, sequence number, crc32 of the request
+
+
+def journal_path(directory, first_sequence):
+    return os.path.join(directory, "journal-{:020d}.log".format(first_sequence))
+
+
+def snapshot_path(directory, sequence):
+    return os.path.join(directory, "snapshot-{:020d}.pickle".format(sequence))
+
+
+def file_sequence(path):
+    return int(os.path.basename(path).split("-")[1].split(".")[0])
+
+
+def journal_files(directory):
+    return sorted(glob.glob(os.path.join(directory, "journal-*.log")), key=file_sequence)
+
+
+def snapshot_files(directory):
+    return sorted(glob.glob(os.path.join(directory, "snapshot-*.pickle")), key=file_sequence)
+
+
+class JournalWriter(threading.Thread):
+    max_batch = 4096 # records written with one write
+
+    def __init__(self, directory, last_sequence=0, fsync=True):
+        super().__init__(daemon=True)
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.sequence = last_sequence # of the last record appended
+        self.fsync = fsync
+        self.records = queue.SimpleQueue()
+        self.lock = threading.Lock() # keeps the records on the queue in the order of their numbers
+        self.file = open(journal_path(directory, last_sequence + 1), "ab")
+        self.written = 0 # records on the disk
+        self.batches = 0
+
+    def append(self, request):
+        data = binary_protocol.encode_request(request)
+        with self.lock:
+            self.sequence += 1
+            self.records.put(record_header.pack(len(data), self.sequence, zlib.crc32(data)) + data)
+        return self.sequence
+
+    def rotate(self):
+        # starts a new journal file with the next record; returns the sequence number of the
+        # last record of the old files, and an event set once they have been written
+        done = threading.Event()
+        with self.lock:
+            self.records.put((self.sequence + 1, done))
+            return self.sequence, done
+
+    def run(self):
+        records = self.records
+        while True:
+            batch = [records.get()]
+            while len(batch) < self.max_batch and isinstance(batch[-1], bytes):
+                try:
+                    batch.append(records.get_nowait())
+                except queue.Empty:
+                    break
+            last = batch[-1]
+            if not isinstance(last, bytes):
+                batch.pop()
+            if batch:
+                self.file.write(b"".join(batch))
+                self.file.flush()
+                if self.fsync:
+                    os.fsync(self.file.fileno())
+                self.written += len(batch)
+                self.batches += 1
+            if last is None:
+                self.file.close()
+                return
+            if isinstance(last, tuple):
+                first_sequence, done = last
+                self.file.close()
+                self.file = open(journal_path(self.directory, first_sequence), "ab")
+                done.set()
+
+    def stop(self):
+        # writes what is still on the queue and closes the file
+        self.records.put(None)
+        self.join()
+
+
+def read_records(path):
+    # yields (sequence number, encoded request, position after the record), reading the
+    # file record by record; stops at a record that was not completely written, which is
+    # where the server stopped
+    with open(path, "rb") as f:
+        position = 0
+        while True:
+            header = f.read(record_header.size)
+            if not header:
+                return
+            if len(header) == record_header.size:
+                length, sequence, crc = record_header.unpack(header)
+                payload = f.read(length)
+                if len(payload) == length and zlib.crc32(payload) == crc:
+                    position += record_header.size + length
+                    yield sequence, payload, position
+                    continue
+            logger.warning("Journal %s ends with an incomplete record at byte %s", path, position)
+            return
+
+
+def read_journal(path):
+    # yields (sequence number, request tuple)
+    for sequence, payload, position in read_records(path):
+        yield sequence, binary_protocol.decode_request(payload)
+
+
+def apply(exchange, request):
+    # changes the state of the exchange like handle_trader_request, but without the
+    # responses; returns them
+    actionType = request[0]
+    if actionType == ActionType.PLACE:
+        return exchange.place_new_order(request[2])
+    elif actionType == ActionType.AMEND:
+        return exchange.amend_quantity(request[1], request[2], request[3])
+    elif actionType == ActionType.CANCEL:
+        return exchange.cancel_order(request[1], request[2])
+    raise UndefinedTraderAction("Undefined Trader Action!")
+
+
+def take_snapshot(exchange, journal=None):
+    # the state of the exchange after the last request appended to the journal. All the
+    # symbols are locked while the state is copied, so the trading stops for that time.
+    with ExitStack() as stack:
+        if exchange.matching_lock is not None:
+            stack.enter_context(exchange.matching_lock)
+        stack.enter_context(exchange.engines_lock)
+        for symbol in sorted(exchange.symbol_locks):
+            stack.enter_context(exchange.symbol_locks[symbol])
+        stack.enter_context(exchange.accounts_lock)
+        accounts = exchange.accounts
+        balance, position = accounts.snapshot()
+        pnl = exchange.pnl.snapshot()
+        books = {}
+        for symbol, engine in exchange.matching_engines.items():
+            books[symbol] = [(o.id, o.order_id, o.quantity, o.price, o.side.value, o.time,
+                              o.time_in_force.value, o.expires)
+                             for book in (engine.bid_book, engine.ask_book) for o in book]
+        sequence, rotated = journal.rotate() if journal is not None else (0, None)
+    state = {"sequence": sequence, "time": time.time(), "initial_balance": accounts.initial_balance,
+             "balance": balance, "position": position, "pnl": pnl, "books": books}
+    return state, rotated
+
+
+def write_snapshot(directory, state):
+    path = snapshot_path(directory, state["sequence"])
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as f:
+        pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+    return path
+
+
+def prune(directory, sequence):
+    # deletes the journal files and snapshots made unnecessary by the snapshot after sequence
+    for path in journal_files(directory):
+        if file_sequence(path) <= sequence:
+            os.remove(path)
+    for path in snapshot_files(directory):
+        if file_sequence(path) < sequence:
+            os.remove(path)
+
+
+def restore_snapshot(exchange, state):
+    accounts = AccountStore(state["initial_balance"])
+    accounts.ensure(len(state["balance"]) - 1)
+    accounts.balance[:len(state["balance"])] = state["balance"]
+    accounts.position[:len(state["position"])] = state["position"]
+    exchange.accounts = accounts
+    # the snapshots written before the P&L have none, it starts again from there
+    if "pnl" in state:
+        exchange.pnl = PnLEngine.restore(state["pnl"])
+    for symbol, orders in state["books"].items():
+        engine = exchange.get_matching_engine(symbol)
+        for trader_id, order_id, quantity, price, side, t, *expiry in orders:
+            # the snapshots written before the time in force have no expiry
+            time_in_force, expires = expiry or (0, 0)
+            o = LimitOrder(trader_id, symbol, quantity, price, OrderSide(side), t, order_id,
+                           TimeInForce(time_in_force), expires)
+            engine.insert_limit_order(o)
+            exchange.trader_orders.setdefault(trader_id, {})[order_id] = symbol
+            if exchange.risk is not None:
+                exchange.risk.rest(o)
+
+
+def recover(exchange, directory):
+    # loads the latest snapshot into a new exchange and replays the journal after it;
+    # returns the sequence number of the last request recovered
+    sequence = 0
+    snapshots = snapshot_files(directory) if os.path.isdir(directory) else []
+    if snapshots:
+        with open(snapshots[-1], "rb") as f:
+            state = pickle.load(f)
+        restore_snapshot(exchange, state)
+        sequence = state["sequence"]
+    replayed = 0
+    for path in journal_files(directory) if os.path.isdir(directory) else []:
+        end = 0
+        for record_sequence, payload, end in read_records(path):
+            if record_sequence <= sequence:
+                continue
+            apply(exchange, binary_protocol.decode_request(payload))
+            sequence = record_sequence
+            replayed += 1
+        if end < os.path.getsize(path):
+            # the writer appends to this file again when its first record is the next one,
+            # the records after a torn one would never be read
+            logger.warning("Truncating %s to its %s bytes of complete records", path, end)
+            os.truncate(path, end)
+    logger.info("Recovered the exchange from %s: %s, %s requests replayed from the journal",
+                directory, os.path.basename(snapshots[-1]) if snapshots else "no snapshot", replayed)
+    return sequence
+
+
+class Snapshotter(threading.Thread):
+    # writes a snapshot every interval seconds
+    def __init__(self, exchange, journal, interval=60):
+        super().__init__(daemon=True)
+        self.exchange = exchange
+        self.journal = journal
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def snapshot(self):
+        state, rotated = take_snapshot(self.exchange, self.journal)
+        path = write_snapshot(self.journal.directory, state)
+        # the records before the snapshot must be on the disk before their files can go
+        rotated.wait()
+        prune(self.journal.directory, state["sequence"])
+        logger.info("Wrote snapshot %s", path)
+        return path
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.snapshot()
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,224 @@
+import json
+import logging
+import queue
+import socketserver
+import threading
+from orders import *
+from framing import *
+from connections import TraderConnection, DISCONNECT
+
+# Market data feed: the trades and the changes of the price levels (L2) of every symbol,
+# sent to the subscribers connected to a port of their own.
+#
+# The Exchange calls orders_matched and levels_changed while it holds the lock of the
+# symbol, so they only read the levels that changed and put a small tuple on the queue
+# of the publisher. The publisher thread encodes every message once and gives it to the
+# queues of all the subscribers, each one with its own writer thread (the
+# TraderConnection of the traders), so neither a lot of subscribers nor a slow one holds
+# up the matching; a subscriber that does not keep up is disconnected.
+#
+# Messages (JSON, length-prefixed frames). Every symbol has its own sequence numbers,
+# shared by its trades, deltas and snapshots:
+#   {"Type": "Trade", "Symbol", "Seq", "Price", "Quantity", "AggressorSide", "Time"}
+#   {"Type": "L2", "Symbol", "Seq", "Bids": [[price, quantity], ...], "Asks": [...]}
+#        the new total quantities of the levels that changed, 0 when a level is gone
+#   {"Type": "Snapshot", "Symbol", "Seq", "Bids": [...], "Asks": [...]}
+#        all the levels, best first; sent to a new subscriber and every snapshot_interval
+#        seconds. A subscriber can get messages with a Seq up to the one of the snapshot
+#        after it, they are already in the snapshot and must be skipped.
+
+logger = logging.getLogger("exchange.market_data")
+
+TRADE = "Trade"
+L2 = "L2"
+SNAPSHOT = "Snapshot"
+
+
+class SubscriberConnection(TraderConnection):
+    slow_client_policy = DISCONNECT # market data is never worth stopping the exchange for
+
+
+class MarketDataPublisher(threading.Thread):
+    def __init__(self, exchange, snapshot_interval=10):
+        super().__init__(daemon=True)
+        self.exchange = exchange
+        self.snapshot_interval = snapshot_interval
+        self.events = queue.SimpleQueue()
+        self.sequences = {} # symbol -> last sequence number, only changed under the symbol lock
+        self.subscribers = set() # only used by the publisher thread
+        self.stopped = threading.Event()
+
+    # called by the Exchange, with the lock of the symbol held
+
+    def next_sequence(self, symbol):
+        sequence = self.sequences.get(symbol, 0) + 1
+        self.sequences[symbol] = sequence
+        return sequence
+
+    def orders_matched(self, symbol, engine, order, filled_orders):
+        # filled_orders are pairs of fills: the resting order, then order
+        put = self.events.put
+        for i in range(0, len(filled_orders), 2):
+            o = filled_orders[i]
+            put((TRADE, symbol, self.next_sequence(symbol), o.price, o.quantity, order.side.value, o.time))
+        changed = set((o.side, o.price) for o in filled_orders[0::2])
+        if (order.id, order.order_id) in engine.orders:
+            changed.add((order.side, order.price))
+        if changed:
+            self.levels_changed(symbol, engine, changed)
+
+    def levels_changed(self, symbol, engine, changed):
+        # changed: (side, price) of the levels
+        bids = []
+        asks = []
+        for side, price in changed:
+            if side == OrderSide.BUY:
+                bids.append((price, engine.bid_book.level_quantity(price)))
+            else:
+                asks.append((price, engine.ask_book.level_quantity(price)))
+        self.events.put((L2, symbol, self.next_sequence(symbol), bids, asks))
+
+    def snapshot(self, symbol, engine, subscriber=None):
+        # for one subscriber, or for all of them
+        self.events.put((SNAPSHOT, symbol, self.sequences.get(symbol, 0), engine.bid_book.depth(),
+                         engine.ask_book.depth(), subscriber))
+
+    # the publisher thread
+
+    def encode(self, event):
+        kind = event[0]
+        if kind == TRADE:
+            _, symbol, sequence, price, quantity, side, t = event
+            dic = {"Type": kind, "Symbol": symbol, "Seq": sequence, "Price": price, "Quantity": quantity,
+                   "AggressorSide": side, "Time": t}
+        else:
+            dic = {"Type": kind, "Symbol": event[1], "Seq": event[2], "Bids": event[3], "Asks": event[4]}
+        return json.dumps(dic)
+
+    def run(self):
+        events = self.events
+        timer = threading.Thread(target=self.snapshot_loop, daemon=True)
+        timer.start()
+        while True:
+            event = events.get()
+            if event is None:
+                return
+            kind = event[0]
+            if kind == "subscribe":
+                self.subscribers.add(event[1])
+                continue
+            if kind == "unsubscribe":
+                self.subscribers.discard(event[1])
+                continue
+            msg = self.encode(event)
+            if kind == SNAPSHOT and event[5] is not None:
+                event[5].send(msg)
+                continue
+            closed = None
+            for subscriber in self.subscribers:
+                if subscriber.closed:
+                    closed = closed or []
+                    closed.append(subscriber)
+                else:
+                    subscriber.send(msg)
+            if closed:
+                self.subscribers.difference_update(closed)
+
+    def snapshot_all(self, subscriber=None):
+        exchange = self.exchange
+        for symbol, engine in list(exchange.matching_engines.items()):
+            with exchange.matching_lock or exchange.symbol_locks[symbol]:
+                self.snapshot(symbol, engine, subscriber)
+
+    def snapshot_loop(self):
+        while not self.stopped.wait(self.snapshot_interval):
+            self.snapshot_all()
+
+    def subscribe(self, connection):
+        # the snapshots are put on the queue after the subscription, so the subscriber gets
+        # every message after them
+        self.events.put(("subscribe", connection))
+        self.snapshot_all(connection)
+
+    def unsubscribe(self, connection):
+        self.events.put(("unsubscribe", connection))
+
+    def stop(self):
+        self.stopped.set()
+        self.events.put(None)
+
+
+class MarketDataRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        publisher = self.server.publisher
+        connection = SubscriberConnection(self.request, LENGTH_PREFIXED, JSON_CODEC)
+        logger.info("Market data subscriber connected from %s", self.client_address[0])
+        publisher.subscribe(connection)
+        try:
+            # the subscribers do not send anything, this only waits until they leave
+            while self.request.recv(1024):
+                pass
+        except OSError:
+            pass
+        connection.close()
+        publisher.unsubscribe(connection)
+
+
+class MarketDataServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 100
+
+    def __init__(self, server_address, publisher):
+        super().__init__(server_address, MarketDataRequestHandler)
+        self.publisher = publisher
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class BookView():
+    # the L2 books of a subscriber, kept up to date from the messages of the feed
+    def __init__(self):
+        self.books = {} # symbol -> ({bid price: quantity}, {ask price: quantity})
+        self.sequences = {}
+        self.last_trades = {}
+
+    def apply(self, msg):
+        # returns False for a message that was already in a snapshot, or that came before
+        # the first snapshot of its symbol
+        symbol = msg["Symbol"]
+        kind = msg["Type"]
+        if kind == SNAPSHOT:
+            self.books[symbol] = (dict(msg["Bids"]), dict(msg["Asks"]))
+            self.sequences[symbol] = msg["Seq"]
+            return True
+        sequence = self.sequences.get(symbol)
+        if sequence is None:
+            if msg["Seq"] != 1:
+                return False
+            # a symbol that started trading after the subscription
+            self.books[symbol] = ({}, {})
+            sequence = 0
+        if msg["Seq"] <= sequence:
+            return False
+        if msg["Seq"] != sequence + 1:
+            logger.warning("Market data of %s skipped from %s to %s", symbol, sequence, msg["Seq"])
+        self.sequences[symbol] = msg["Seq"]
+        if kind == TRADE:
+            self.last_trades[symbol] = msg
+        else:
+            for levels, changes in zip(self.books[symbol], (msg["Bids"], msg["Asks"])):
+                for price, quantity in changes:
+                    if quantity:
+                        levels[price] = quantity
+                    else:
+                        levels.pop(price, None)
+        return True
+
+    def best(self, symbol):
+        # (best bid, best ask), None for an empty side
+        bids, asks = self.books.get(symbol, ({}, {}))
+        return (max(bids) if bids else None), (min(asks) if asks else None)
@@ -0,0 +1,140 @@
+import bisect
+import threading
+import time
+
+# Counters and latency histograms of the exchange, exported in the Prometheus text format
+# (served at /metrics by the StatusServer, see reporting.py).
+# Nothing in here is called unless the metrics are enabled: Exchange.enable_metrics
+# replaces the methods it measures by timed versions, so with the metrics off the
+# matching path is exactly the same code as without them.
+
+# upper bounds in seconds, from 1 us to 1 s
+LATENCY_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3,
+                   1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                          for k, v in labels.items()) + "}"
+
+
+class Counter():
+    def __init__(self, labels=None):
+        self.labels = labels or {}
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def samples(self, name):
+        return ["{}{} {}".format(name, format_labels(self.labels), self.value)]
+
+
+class Histogram():
+    def __init__(self, labels=None, buckets=LATENCY_BUCKETS):
+        self.labels = labels or {}
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one is +Inf
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def samples(self, name):
+        with self.lock:
+            counts = self.counts[:]
+            total = self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            labels = dict(self.labels, le=bound)
+            lines.append("{}_bucket{} {}".format(name, format_labels(labels), cumulative))
+        lines.append("{}_sum{} {}".format(name, format_labels(self.labels), total))
+        lines.append("{}_count{} {}".format(name, format_labels(self.labels), cumulative))
+        return lines
+
+
+class Gauge():
+    # the value is only computed when the metrics are scraped;
+    # function returns a list of (labels, value)
+    def __init__(self, function):
+        self.function = function
+
+    def samples(self, name):
+        return ["{}{} {}".format(name, format_labels(labels), value) for labels, value in self.function()]
+
+
+class Metrics():
+    def __init__(self):
+        self.families = {} # name -> [type, help, metrics]
+        self.lock = threading.Lock()
+
+    def add(self, kind, name, help, metric):
+        with self.lock:
+            family = self.families.setdefault(name, [kind, help, []])
+            family[2].append(metric)
+        return metric
+
+    def counter(self, name, help, **labels):
+        return self.add("counter", name, help, Counter(labels))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, **labels):
+        return self.add("histogram", name, help, Histogram(labels, buckets))
+
+    def gauge(self, name, help, function):
+        return self.add("gauge", name, help, Gauge(function))
+
+    def render(self):
+        lines = []
+        with self.lock:
+            families = [(name, family[0], family[1], family[2][:]) for name, family in self.families.items()]
+        for name, kind, help, metrics in families:
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for metric in metrics:
+                lines.extend(metric.samples(name))
+        return "\n".join(lines) + "\n"
+
+    def prometheus(self):
+        # a route of the StatusServer
+        return CONTENT_TYPE, self.render()
+
+
+def timed(function, histogram, clock=time.perf_counter):
+    # function, with the time of every call observed by histogram
+    observe = histogram.observe
+    def timed_function(*args, **kwargs):
+        start = clock()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            observe(clock() - start)
+    return timed_function
+
+
+class TimedLock():
+    # a lock that observes how long it took to acquire it
+    def __init__(self, lock, histogram, clock=time.perf_counter):
+        self.lock = lock
+        self.observe = histogram.observe
+        self.clock = clock
+
+    def __enter__(self):
+        start = self.clock()
+        self.lock.acquire()
+        self.observe(self.clock() - start)
+        return self
+
+    def __exit__(self, *args):
+        self.lock.release()
@@ -0,0 +1,210 @@
+# Price-level order book used by the MatchingEngine.
+# Every side keeps its price levels in a sorted list of keys with the best level at the
+# end, so that filling or cancelling at the top of the book is an O(1) pop and a new
+# level is found with a binary search. Every level is a FIFO deque of orders.
+
+from array import array
+from bisect import bisect_left
+from collections import deque
+
+
+class PriceLevel():
+    __slots__ = ("price", "orders", "quantity", "count", "cancelled")
+
+    def __init__(self, price):
+        self.price = price
+        self.orders = deque()
+        self.quantity = 0 # total quantity of the live orders on this level
+        self.count = 0 # number of live orders on this level
+        # orders cancelled from the middle of the deque are only marked here (by id())
+        # and thrown away when they reach the front, so that a cancel is O(1)
+        self.cancelled = set()
+
+    def append(self, order):
+        orders = self.orders
+        if orders and orders[-1].time > order.time:
+            # the time stamps come from the traders, so keep the level sorted by time
+            i = len(orders)
+            while i and orders[i - 1].time > order.time:
+                i -= 1
+            orders.insert(i, order)
+        else:
+            orders.append(order)
+        self.quantity += order.quantity
+        self.count += 1
+
+    def head(self):
+        orders = self.orders
+        if self.cancelled:
+            cancelled = self.cancelled
+            while id(orders[0]) in cancelled:
+                cancelled.discard(id(orders.popleft()))
+        return orders[0]
+
+    def pop_head(self):
+        o = self.head()
+        self.orders.popleft()
+        self.quantity -= o.quantity
+        self.count -= 1
+        return o
+
+    def remove(self, order):
+        if self.head() is order:
+            self.orders.popleft()
+        else:
+            self.cancelled.add(id(order))
+        self.quantity -= order.quantity
+        self.count -= 1
+
+    def __iter__(self):
+        cancelled = self.cancelled
+        for o in self.orders:
+            if id(o) not in cancelled:
+                yield o
+
+
+class BookSide():
+    def __init__(self, is_bid):
+        self.is_bid = is_bid
+        # keys are ascending and the best price is the last one:
+        # the key is the price on the bid side and minus the price on the ask side
+        self.keys = []
+        # total quantity of every level, at the same index as its key, so that the depth
+        # queries below only read these two arrays
+        self.quantities = array("q")
+        self.levels = {}
+        self.best = None # cached best PriceLevel, None when this side is empty
+        self.count = 0
+
+    def key(self, price):
+        return price if self.is_bid else -price
+
+    def index(self, level):
+        # index of level in keys and quantities
+        if level is self.best:
+            return len(self.keys) - 1
+        return bisect_left(self.keys, self.key(level.price))
+
+    def insert(self, order):
+        # the array of the quantities is updated first everywhere below, so that a quantity it
+        # does not take leaves the book as it was
+        level = self.levels.get(order.price)
+        if level is None:
+            level = PriceLevel(order.price)
+            k = self.key(order.price)
+            keys = self.keys
+            if not keys or k > keys[-1]:
+                self.quantities.append(order.quantity)
+                keys.append(k)
+                self.best = level
+            else:
+                i = bisect_left(keys, k)
+                self.quantities.insert(i, order.quantity)
+                keys.insert(i, k)
+            self.levels[order.price] = level
+        else:
+            self.quantities[self.index(level)] += order.quantity
+        level.append(order)
+        self.count += 1
+        return level
+
+    def fill(self, level, order, quantity):
+        # order is the head of level and it is filled by quantity
+        if quantity < order.quantity:
+            self.quantities[self.index(level)] -= quantity
+            order.quantity -= quantity
+            level.quantity -= quantity
+        else:
+            if level.count > 1:
+                self.quantities[self.index(level)] -= order.quantity
+            level.pop_head()
+            self.count -= 1
+            if not level.count:
+                self.drop_level(level)
+
+    def amend(self, order, level, quantity):
+        # order rests on level, its quantity is reduced to quantity
+        reduction = order.quantity - quantity
+        self.quantities[self.index(level)] -= reduction
+        order.quantity = quantity
+        level.quantity -= reduction
+
+    def remove(self, order, level):
+        if level.count > 1:
+            self.quantities[self.index(level)] -= order.quantity
+        level.remove(order)
+        self.count -= 1
+        if not level.count:
+            self.drop_level(level)
+
+    def drop_level(self, level):
+        del self.levels[level.price]
+        keys = self.keys
+        if level is self.best:
+            keys.pop()
+            self.quantities.pop()
+            self.best = self.levels[self.price(keys[-1])] if keys else None
+        else:
+            i = bisect_left(keys, self.key(level.price))
+            del keys[i]
+            del self.quantities[i]
+
+    def price(self, key):
+        return key if self.is_bid else -key
+
+    # Depth queries. They read the arrays of the levels from the best one and stop as soon
+    # as they have their answer, so they take O(levels used) and do not touch the orders.
+    # The caller holds the lock of the symbol.
+
+    def level_quantity(self, price):
+        level = self.levels.get(price)
+        return 0 if level is None else level.quantity
+
+    def top(self):
+        # (best price, its total quantity), None when this side is empty
+        if not self.keys:
+            return None
+        return self.price(self.keys[-1]), self.quantities[-1]
+
+    def depth(self, n=None):
+        # (price, total quantity) of the best n levels (all of them for None), best first
+        start = 0 if n is None else max(len(self.keys) - n, 0)
+        keys = self.keys[start:]
+        quantities = self.quantities[start:]
+        price = self.price
+        return [(price(k), q) for k, q in zip(reversed(keys), reversed(quantities))]
+
+    def volume(self, n=None):
+        # total quantity of the best n levels
+        if n is None:
+            return sum(self.quantities)
+        return sum(self.quantities[max(len(self.quantities) - n, 0):])
+
+    def volume_to(self, price):
+        # total quantity at price and the better prices
+        return sum(self.quantities[bisect_left(self.keys, self.key(price)):])
+
+    def sweep(self, quantity):
+        # what an order for quantity matching at any price would get from this side:
+        # (quantity filled, total price paid); the fills are quantity-weighted, so
+        # paid / filled is their average price
+        keys = self.keys
+        quantities = self.quantities
+        filled = 0
+        paid = 0.0
+        i = len(keys) - 1
+        while filled < quantity and i >= 0:
+            q = min(quantities[i], quantity - filled)
+            filled += q
+            paid += q * self.price(keys[i])
+            i -= 1
+        return filled, paid
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        # live orders in price-time priority
+        levels = self.levels
+        for k in reversed(self.keys):
+            yield from levels[self.price(k)]
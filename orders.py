@@ -0,0 +1,163 @@
+from enum import Enum
+from abc import ABC
+
+
+class OrderType(Enum):
+    LIMIT = 1
+    MARKET = 2
+    IOC = 3
+
+
+class OrderSide(Enum):
+    BUY = 1
+    SELL = 2
+
+
+class TimeInForce(Enum):
+    GTC = 0 # good till cancelled
+    DAY = 1 # expires at the end of the session of the exchange
+    GTD = 2 # good till the expire time of the order
+
+
+class NonPositiveQuantity(Exception):
+    pass
+
+
+class InvalidQuantity(Exception):
+    pass
+
+
+class InvalidTraderID(Exception):
+    pass
+
+
+class NonPositivePrice(Exception):
+    pass
+
+
+class InvalidSide(Exception):
+    pass
+
+
+class UndefinedOrderType(Exception):
+    pass
+
+
+class UndefinedOrderSide(Exception):
+    pass
+
+
+class NewQuantityNotSmaller(Exception):
+    pass
+
+
+
+class UndefinedTraderAction(Exception):
+    pass
+
+
+class UndefinedResponse(Exception):
+    pass
+
+
+class ActionType(Enum):
+    PLACE=1
+    AMEND=2
+    CANCEL=3
+    BALANCE=4
+    BATCH=5 # several of the actions above in one message
+
+
+class Order(ABC):
+    # id is the id of the trader the order belongs to, order_id tells apart the orders
+    # of one trader (traders that only have one order at a time can leave it at 0)
+    # The orders have __slots__ instead of a __dict__ each, there can be a lot of them in the books.
+    __slots__ = ("id", "order_id", "symbol", "quantity", "side", "time")
+
+    def __init__(self, id, symbol, quantity, side, time, order_id=0):
+        self.id = id
+        self.order_id = order_id
+        self.symbol = symbol
+        if quantity > 0:
+            self.quantity = quantity
+        else:
+            raise NonPositiveQuantity("Quantity Must Be Positive!")
+        if side in [OrderSide.BUY, OrderSide.SELL]:
+            self.side = side
+        else:
+            raise InvalidSide(
+                "Side Must Be Either \"Buy\" or \"OrderSide.SELL\"!")
+        self.time = time
+
+
+class LimitOrder(Order):
+    # expires is the time the order leaves the book at, 0 for never; the exchange sets it
+    # for a DAY order
+    __slots__ = ("price", "time_in_force", "expires")
+    type = OrderType.LIMIT
+
+    def __init__(self, id, symbol, quantity, price, side, time, order_id=0, time_in_force=TimeInForce.GTC, expires=0):
+        super().__init__(id, symbol, quantity, side, time, order_id)
+        if price > 0:
+            self.price = price
+        else:
+            raise NonPositivePrice("Price Must Be Positive!")
+        self.time_in_force = time_in_force
+        self.expires = expires
+
+
+
+class MarketOrder(Order):
+    __slots__ = ()
+    type = OrderType.MARKET
+
+
+class IOCOrder(Order):
+    __slots__ = ("price",)
+    type = OrderType.IOC
+
+    def __init__(self, id, symbol, quantity, price, side, time, order_id=0):
+        super().__init__(id, symbol, quantity, side, time, order_id)
+        if price > 0:
+            self.price = price
+        else:
+            raise NonPositivePrice("Price Must Be Positive!")
+
+class FilledOrder(Order):
+    # A fill record. The fills are made by the matching engine from orders that have already
+    # been checked (or decoded from its responses), so unlike the other orders there is no
+    # validation here; one is created for each side of every trade.
+    __slots__ = ("price", "limit")
+
+    def __init__(self, id, symbol, quantity, price, side, time, limit=False, order_id=0):
+        self.id = id
+        self.order_id = order_id
+        self.symbol = symbol
+        self.quantity = quantity
+        self.side = side
+        self.time = time
+        self.price = price
+        self.limit = limit
+
+
+
+class NoOrderWithThisIDInOrderBook(Exception):
+    pass
+
+
+def check_quantity(quantity):
+    # for the quantities of the requests of the traders: the books and the accounts keep
+    # them in arrays of integers, so they are checked before they get there
+    if type(quantity) is not int:
+        raise InvalidQuantity("Quantity Must Be An Integer!")
+    if quantity <= 0:
+        raise NonPositiveQuantity("Quantity Must Be Positive!")
+    return quantity
+
+
+def check_trader_id(trader_id):
+    # the trader ids index the arrays of the accounts, the risk checks and the P&L, where a
+    # negative one would silently be taken from their end
+    if type(trader_id) is not int or trader_id < 0:
+        raise InvalidTraderID("Trader ID Must Be A Non-Negative Integer!")
+    return trader_id
@@ -0,0 +1,151 @@
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Profit and loss of the traders, kept up to date fill by fill by Exchange.apply_fills
+# under the accounts lock. For every symbol a trader has a position and the cost of it
+# (position times the average price it was opened at, negative for a short position); a
+# fill that adds to the position adds to the cost, one that reduces it realizes the
+# difference between its price and the average cost. A fill is O(1) whatever the number
+# of traders and symbols.
+#
+# The unrealized P&L of every trader is kept in one array, at the prices the symbols were
+# last marked at. A trade only records the new last price of its symbol; marking to market
+# (mark_to_market) moves the unrealized P&L of all the traders holding the symbols whose
+# price moved at once, as position times price change over the arrays (with numpy), and is
+# done by the balance reporter. Until then get adds the moves of the symbols not marked
+# yet for the one trader, so it is exact without scanning the accounts.
+#
+# Equity (initial balance, realized and unrealized P&L) is the balance plus the value of
+# the positions at the last prices.
+
+
+class SymbolPositions():
+    def __init__(self, price, capacity=128):
+        self.position = array("q", [0]) * capacity
+        self.cost = array("d", [0]) * capacity
+        self.last_price = price
+        self.marked_price = price # the price PnLEngine.unrealized is at
+
+    def ensure(self, trader_id):
+        capacity = len(self.position)
+        if trader_id >= capacity:
+            extra = max(capacity, trader_id + 1 - capacity)
+            self.position.extend(array("q", [0]) * extra)
+            self.cost.extend(array("d", [0]) * extra)
+
+
+class PnLEngine():
+    def __init__(self, capacity=128):
+        self.symbols = {} # symbol -> SymbolPositions
+        self.realized = array("d", [0]) * capacity
+        self.unrealized = array("d", [0]) * capacity
+        self.count = 0 # trader ids 0 .. count-1 have had fills
+        self.moved = set() # symbols whose last price is not the marked one
+
+    def ensure(self, trader_id):
+        if trader_id < 0:
+            raise ValueError("Trader ID Must Not Be Negative!")
+        if trader_id >= self.count:
+            capacity = len(self.realized)
+            if trader_id >= capacity:
+                extra = max(capacity, trader_id + 1 - capacity)
+                self.realized.extend(array("d", [0]) * extra)
+                self.unrealized.extend(array("d", [0]) * extra)
+            self.count = trader_id + 1
+
+    def fill(self, trader_id, symbol, quantity, price):
+        # quantity is positive for a buy and negative for a sell
+        positions = self.symbols.get(symbol)
+        if positions is None:
+            positions = self.symbols[symbol] = SymbolPositions(price, len(self.realized))
+        if not 0 <= trader_id < self.count:
+            self.ensure(trader_id)
+        if trader_id >= len(positions.position):
+            positions.ensure(trader_id)
+        old = positions.position[trader_id]
+        cost = positions.cost[trader_id]
+        new = old + quantity
+        if old == 0 or (old > 0) == (quantity > 0):
+            new_cost = cost + quantity * price
+        else:
+            average = cost / old
+            if (new > 0) == (old > 0) or new == 0:
+                # reduced or closed at price, the rest keeps its average cost
+                self.realized[trader_id] += (price - average) * -quantity
+                new_cost = average * new
+            else:
+                # closed and opened the other way at price
+                self.realized[trader_id] += (price - average) * old
+                new_cost = new * price
+        positions.position[trader_id] = new
+        positions.cost[trader_id] = new_cost
+        marked = positions.marked_price
+        self.unrealized[trader_id] += (new - old) * marked - (new_cost - cost)
+        positions.last_price = price
+        if price != marked:
+            self.moved.add(symbol)
+
+    def mark_to_market(self):
+        # moves the unrealized P&L of all the traders to the last prices
+        for symbol in self.moved:
+            positions = self.symbols[symbol]
+            change = positions.last_price - positions.marked_price
+            n = min(self.count, len(positions.position))
+            if np is not None:
+                unrealized = np.frombuffer(self.unrealized, dtype=np.float64)[:n]
+                unrealized += np.frombuffer(positions.position, dtype=np.int64)[:n] * change
+                del unrealized
+            else:
+                unrealized, position = self.unrealized, positions.position
+                for trader_id in range(n):
+                    if position[trader_id]:
+                        unrealized[trader_id] += position[trader_id] * change
+            positions.marked_price = positions.last_price
+        self.moved.clear()
+
+    def get(self, trader_id):
+        # (realized, unrealized) P&L of a trader at the last prices
+        if not 0 <= trader_id < self.count:
+            return 0.0, 0.0
+        unrealized = self.unrealized[trader_id]
+        for symbol in self.moved:
+            positions = self.symbols[symbol]
+            if trader_id < len(positions.position):
+                unrealized += positions.position[trader_id] * (positions.last_price - positions.marked_price)
+        return self.realized[trader_id], unrealized
+
+    def position(self, trader_id, symbol):
+        # (position, average cost) of a trader in a symbol
+        positions = self.symbols.get(symbol)
+        if positions is None or trader_id >= len(positions.position) or not positions.position[trader_id]:
+            return 0, 0.0
+        return positions.position[trader_id], positions.cost[trader_id] / positions.position[trader_id]
+
+    def last_price(self, symbol):
+        positions = self.symbols.get(symbol)
+        return positions.last_price if positions is not None else None
+
+    def snapshot(self):
+        # copies of the arrays, marked to market first; for the reports and the journal
+        self.mark_to_market()
+        return {"realized": self.realized[:self.count], "unrealized": self.unrealized[:self.count],
+                "symbols": dict((symbol, (p.last_price, p.position[:self.count], p.cost[:self.count]))
+                                for symbol, p in self.symbols.items())}
+
+    @classmethod
+    def restore(cls, state):
+        pnl = cls()
+        if state["realized"]:
+            pnl.ensure(len(state["realized"]) - 1)
+        n = pnl.count
+        pnl.realized[:n] = state["realized"]
+        pnl.unrealized[:n] = state["unrealized"]
+        for symbol, (price, position, cost) in state["symbols"].items():
+            positions = pnl.symbols[symbol] = SymbolPositions(price, len(pnl.realized))
+            positions.position[:len(position)] = position
+            positions.cost[:len(cost)] = cost
+        return pnl
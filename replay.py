@@ -0,0 +1,186 @@
+import argparse
+import csv
+import os
+import pickle
+import time
+from orders import *
+from server import Exchange
+from risk import RiskManager
+from trade_tape import TradeTape
+import journal
+
+try:
+    import pyarrow.parquet as parquet
+except ImportError:
+    parquet = None
+
+# Replays recorded order flow straight into an Exchange, without sockets: a journal (a
+# journal directory or one of its files), or a CSV or Parquet file with the columns of
+# the JSON requests (ActionType, TraderID, OrderID, OrderType, Symbol, Quantity, Price,
+# Side, Time, TimeInForce, ExpireTime; the enums as numbers). The requests are applied as fast as possible, or
+# paced by their Time fields with --pace. The trades, the books at the end and the final
+# balances can be written to CSV files, and the trades to a trade tape.
+#
+# The fills get the time of the order that caused them instead of the time of the
+# replay, so the same input always gives the same output.
+#
+#   python replay.py journal_dir --trades trades.csv --book book.csv --balances balances.csv
+
+columns = {"ActionType": int, "TraderID": int, "OrderID": int, "OrderType": int, "Symbol": str,
+           "Quantity": int, "Price": float, "Side": int, "Time": float, "TimeInForce": int, "ExpireTime": float}
+
+
+def read_rows(rows, exchange):
+    convert = exchange.convert_dic_from_trader_to_tuple_request
+    for row in rows:
+        dic = dict((k, columns[k](v)) for k, v in row.items() if k in columns and v not in ("", None))
+        yield convert(dic)
+
+
+def read_csv(path, exchange):
+    with open(path, newline="") as f:
+        yield from read_rows(csv.DictReader(f), exchange)
+
+
+def read_parquet(path, exchange):
+    if parquet is None:
+        raise ImportError("pyarrow is needed to read Parquet files")
+    yield from read_rows(parquet.read_table(path).to_pylist(), exchange)
+
+
+def read_journals(path, after=0):
+    paths = journal.journal_files(path) if os.path.isdir(path) else [path]
+    for p in paths:
+        for sequence, request in journal.read_journal(p):
+            if sequence > after:
+                yield request
+
+
+def replay(exchange, requests, pace=None, on_fill=None, tape=None, expire=False):
+    # pace is the speed relative to the recorded times (1 for real time), None for as fast
+    # as possible; on_fill(fill) is called for every fill, and the trades are appended to
+    # tape, with their times. With expire the GTD and DAY orders are expired by the times
+    # of the orders, for flow without the cancels of the expiries (a journal has them).
+    # Returns the number of requests.
+    apply = journal.apply
+    count = 0
+    first_time = None
+    clock = time.perf_counter
+    start = clock()
+    order_time = 0
+    for request in requests:
+        actionType = request[0]
+        if actionType == ActionType.BALANCE:
+            continue
+        if actionType == ActionType.PLACE:
+            order_time = request[2].time
+            if expire:
+                exchange.expire_orders(order_time)
+            if pace:
+                if first_time is None:
+                    first_time = order_time
+                delay = (order_time - first_time) / pace - (clock() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            results = apply(exchange, request)
+            if on_fill is not None or tape is not None:
+                fills = [response[1] for trader_id, response in results if isinstance(response[1], FilledOrder)]
+                for o in fills:
+                    o.time = order_time
+                    if on_fill is not None:
+                        on_fill(o)
+                if tape is not None:
+                    tape.record(fills)
+        else:
+            apply(exchange, request)
+        count += 1
+    return count
+
+
+def write_book(exchange, path):
+    with open(path, "w", newline="") as f:
+        out = csv.writer(f)
+        out.writerow(["Symbol", "Side", "Price", "Quantity", "TraderID", "OrderID", "Time"])
+        for symbol in sorted(exchange.matching_engines):
+            engine = exchange.matching_engines[symbol]
+            for book in (engine.bid_book, engine.ask_book):
+                for o in book:
+                    out.writerow([symbol, o.side.value, o.price, o.quantity, o.id, o.order_id, o.time])
+
+
+def write_balances(exchange, path):
+    balance, position = exchange.accounts.snapshot()
+    pnl = exchange.pnl
+    with open(path, "w", newline="") as f:
+        out = csv.writer(f)
+        out.writerow(["TraderID", "Balance", "Position", "RealizedPnL", "UnrealizedPnL"])
+        for trader_id in range(len(balance)):
+            out.writerow([trader_id, balance[trader_id], position[trader_id], *pnl.get(trader_id)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replay recorded order flow into the exchange")
+    parser.add_argument("path", help="journal directory or file, .csv or .parquet file")
+    parser.add_argument("--pace", type=float, default=None,
+                        help="follow the recorded times, at this speed (1 is real time)")
+    parser.add_argument("--snapshot", action="store_true",
+                        help="start from the latest snapshot of the journal directory")
+    parser.add_argument("--trades", help="write the fills to this CSV file")
+    parser.add_argument("--book", help="write the books at the end to this CSV file")
+    parser.add_argument("--balances", help="write the final balances to this CSV file")
+    parser.add_argument("--risk-limits", help="the risk limits the flow was recorded with, see risk.py")
+    parser.add_argument("--tape", help="append the trades to the trade tape in this directory, see trade_tape.py")
+    args = parser.parse_args()
+
+    exchange = Exchange()
+    if args.risk_limits:
+        exchange.risk = RiskManager.from_file(args.risk_limits)
+    tape = TradeTape(args.tape) if args.tape else None
+    path = args.path
+    after = 0
+    expire = path.endswith(".csv") or path.endswith(".parquet")
+    if path.endswith(".csv"):
+        requests = read_csv(path, exchange)
+    elif path.endswith(".parquet"):
+        requests = read_parquet(path, exchange)
+    else:
+        if args.snapshot:
+            snapshots = journal.snapshot_files(path)
+            if snapshots:
+                with open(snapshots[-1], "rb") as f:
+                    state = pickle.load(f)
+                journal.restore_snapshot(exchange, state)
+                after = state["sequence"]
+        requests = read_journals(path, after)
+
+    trades_file = None
+    trades = None
+    if args.trades:
+        trades_file = open(args.trades, "w", newline="")
+        trades = csv.writer(trades_file)
+        trades.writerow(["TraderID", "OrderID", "Symbol", "Side", "Quantity", "Price", "Time", "IsLimit"])
+    fills = 0
+    def on_fill(o):
+        nonlocal fills
+        fills += 1
+        if trades is not None:
+            trades.writerow([o.id, o.order_id, o.symbol, o.side.value, o.quantity, o.price, o.time, int(o.limit)])
+
+    start = time.perf_counter()
+    count = replay(exchange, requests, args.pace, on_fill, tape, expire)
+    elapsed = time.perf_counter() - start
+    if trades_file is not None:
+        trades_file.close()
+    if tape is not None:
+        tape.close()
+    print("%d requests replayed in %.3f s (%.0f requests/s), %d trades" % (
+        count, elapsed, count / elapsed if elapsed else 0, fills // 2))
+    if args.book:
+        write_book(exchange, args.book)
+    if args.balances:
+        write_balances(exchange, args.balances)
+    print("sum of balances = %s" % exchange.accounts.sum_of_balances())
+
+
+if __name__ == "__main__":
+    main()
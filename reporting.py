@@ -0,0 +1,89 @@
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger("exchange.report")
+
+
+class BalanceReporter(threading.Thread):
+    # Every interval seconds takes a snapshot of the accounts and logs it. The accounts
+    # lock is only held while the arrays are copied, everything else (the sum, the
+    # formatting and the logging) happens after it has been released, so the report
+    # does not stop the trading.
+    max_logged_accounts = 100 # with more accounts only their sum is logged
+    def __init__(self, exchange, interval=5):
+        super().__init__(daemon=True)
+        self.exchange = exchange
+        self.interval = interval
+        self.latest = None
+        self.stopped = threading.Event()
+
+    def snapshot(self):
+        exchange = self.exchange
+        with exchange.accounts_lock:
+            balance, position = exchange.accounts.snapshot()
+            # marks the positions to the last prices
+            pnl = exchange.pnl.snapshot()
+        return {"Time": time.time(), "SumOfBalances": sum(balance), "Balance": balance.tolist(),
+                "Position": position.tolist(), "SumOfRealizedPnL": sum(pnl["realized"]),
+                "SumOfUnrealizedPnL": sum(pnl["unrealized"]), "RealizedPnL": pnl["realized"].tolist(),
+                "UnrealizedPnL": pnl["unrealized"].tolist()}
+
+    def report(self, snapshot):
+        logger.info("Sum of balances of all traders at the moment = %s", snapshot["SumOfBalances"])
+        logger.info("Realized P&L = %s, unrealized P&L at the last prices = %s",
+                    snapshot["SumOfRealizedPnL"], snapshot["SumOfUnrealizedPnL"])
+        if len(snapshot["Balance"]) <= self.max_logged_accounts:
+            logger.info("Their balances are: (%s)", ", ".join([str(b) for b in snapshot["Balance"]]))
+        else:
+            logger.info("Number of accounts = %s", len(snapshot["Balance"]))
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.latest = self.snapshot()
+            self.report(self.latest)
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+
+    def balances_json(self):
+        # the latest snapshot, or a new one before the first report
+        return "application/json", json.dumps(self.latest or self.snapshot())
+
+
+class StatusRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        route = self.server.routes.get(self.path.split("?")[0])
+        if route is None:
+            self.send_error(404)
+            return
+        content_type, body = route()
+        body = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("status endpoint: " + format, *args)
+
+
+class StatusServer(ThreadingHTTPServer):
+    # Local HTTP endpoint for the monitoring of the exchange. routes maps a path to a
+    # function returning (content type, body); the functions are called on the
+    # threads of this server, never on the matching path.
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, routes=None):
+        super().__init__(server_address, StatusRequestHandler)
+        self.routes = dict(routes or {})
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
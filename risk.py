@@ -0,0 +1,177 @@
+import json
+from array import array
+from orders import *
+
+# Pre-trade risk checks, made by Exchange.place_new_order before an order is matched.
+# Every trader has limits (the default ones unless it has its own):
+#   max_quantity   quantity of one order
+#   max_notional   quantity times price of one order; for a market order the price is
+#                  the average price it would get from the book as it is
+#   max_exposure   notional of all the orders of the trader resting in the books, with
+#                  this one
+#   max_position   position of the trader if all its resting orders of the same side and
+#                  this one were filled, in both directions
+#   cash           a buy order, with the buy orders resting in the books, must not cost
+#                  more than the balance of the trader
+# None (or False for cash) means no limit. An order that breaks a limit is rejected like
+# an order with an order id that is already in use, OrderPresent is set in the response.
+#
+# The exposure of the traders is kept up to date as the orders change, in typed arrays
+# indexed by trader id like the accounts, so a check is a few array lookups whatever the
+# number of orders in the books: an order that passes is counted at its whole notional
+# until it has been matched, then only the part resting in the book stays, and it is
+# taken off again by its fills, amends and cancel. All of it happens under the accounts
+# lock of the Exchange.
+#
+# The limits can be read from a JSON file:
+#   {"default": {"max_quantity": 1000, "cash": true}, "traders": {"7": {"max_position": 100}}}
+
+QUANTITY = "max_quantity"
+NOTIONAL = "max_notional"
+EXPOSURE = "max_exposure"
+POSITION = "max_position"
+CASH = "cash"
+
+# looked up once, getting a member from an Enum class is slow
+BUY = OrderSide.BUY
+MARKET = OrderType.MARKET
+
+
+class RiskLimitBreached(Exception):
+    pass
+
+
+class RiskLimits():
+    __slots__ = ("max_quantity", "max_notional", "max_exposure", "max_position", "cash")
+
+    def __init__(self, max_quantity=None, max_notional=None, max_exposure=None, max_position=None, cash=False):
+        self.max_quantity = max_quantity
+        self.max_notional = max_notional
+        self.max_exposure = max_exposure
+        self.max_position = max_position
+        self.cash = cash
+
+
+class RiskManager():
+    def __init__(self, default=None, limits=None, capacity=128):
+        self.default = default or RiskLimits()
+        self.limits = dict(limits or {}) # trader id -> RiskLimits
+        # notional and quantity of the orders of every trader in the books, by side
+        self.buy_notional = array("d", [0]) * capacity
+        self.sell_notional = array("d", [0]) * capacity
+        self.buy_quantity = array("q", [0]) * capacity
+        self.sell_quantity = array("q", [0]) * capacity
+        self.count = 0
+        self.rejects = dict.fromkeys((QUANTITY, NOTIONAL, EXPOSURE, POSITION, CASH), 0)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as f:
+            config = json.load(f)
+        return cls(RiskLimits(**config.get("default", {})),
+                   dict((int(trader_id), RiskLimits(**limits)) for trader_id, limits in config.get("traders", {}).items()))
+
+    def ensure(self, trader_id):
+        if trader_id < 0:
+            raise ValueError("Trader ID Must Not Be Negative!")
+        if trader_id >= self.count:
+            capacity = len(self.buy_notional)
+            if trader_id >= capacity:
+                extra = max(capacity, trader_id + 1 - capacity)
+                self.buy_notional.extend(array("d", [0]) * extra)
+                self.sell_notional.extend(array("d", [0]) * extra)
+                self.buy_quantity.extend(array("q", [0]) * extra)
+                self.sell_quantity.extend(array("q", [0]) * extra)
+            self.count = trader_id + 1
+
+    def reject(self, limit):
+        self.rejects[limit] += 1
+        raise RiskLimitBreached(limit)
+
+    def reserve(self, order, engine, accounts):
+        # checks order against the limits of its trader and counts it in the exposure;
+        # returns (notional, quantity) counted, for matched. engine is the matching engine
+        # of the symbol, not matched yet
+        trader_id = order.id
+        limits = self.limits.get(trader_id, self.default)
+        quantity = order.quantity
+        if limits.max_quantity is not None and quantity > limits.max_quantity:
+            self.reject(QUANTITY)
+        if order.type is MARKET:
+            # it cannot get more than the other side of the book has
+            price, quantity = engine.sweep_vwap(order.side, quantity)
+            notional = price * quantity if quantity else 0.0
+        else:
+            notional = quantity * order.price
+        if limits.max_notional is not None and notional > limits.max_notional:
+            self.reject(NOTIONAL)
+        if not 0 <= trader_id < self.count:
+            self.ensure(trader_id)
+        is_buy = order.side is BUY
+        buy_notional = self.buy_notional[trader_id]
+        if limits.max_exposure is not None and \
+                buy_notional + self.sell_notional[trader_id] + notional > limits.max_exposure:
+            self.reject(EXPOSURE)
+        if limits.max_position is not None or limits.cash:
+            balance, position = accounts.get(trader_id)
+            if limits.max_position is not None:
+                if is_buy:
+                    worst = position + self.buy_quantity[trader_id] + quantity
+                else:
+                    worst = self.sell_quantity[trader_id] + quantity - position
+                if worst > limits.max_position:
+                    self.reject(POSITION)
+            if limits.cash and is_buy and buy_notional + notional > balance:
+                self.reject(CASH)
+        if is_buy:
+            self.buy_notional[trader_id] = buy_notional + notional
+            self.buy_quantity[trader_id] += quantity
+        else:
+            self.sell_notional[trader_id] += notional
+            self.sell_quantity[trader_id] += quantity
+        return notional, quantity
+
+    def release(self, trader_id, side, notional, quantity):
+        if side is BUY:
+            self.buy_notional[trader_id] -= notional
+            self.buy_quantity[trader_id] -= quantity
+        else:
+            self.sell_notional[trader_id] -= notional
+            self.sell_quantity[trader_id] -= quantity
+
+    def matched(self, order, filled_orders, reserved, resting):
+        # after the matching of an order that passed reserve: only its resting quantity
+        # stays in the exposure, and the resting orders it filled (every first fill of a
+        # pair, at the price of the resting order) leave it
+        notional, quantity = reserved
+        if resting:
+            notional -= resting * order.price
+            quantity -= resting
+        self.release(order.id, order.side, notional, quantity)
+        buy_notional, sell_notional = self.buy_notional, self.sell_notional
+        buy_quantity, sell_quantity = self.buy_quantity, self.sell_quantity
+        for i in range(0, len(filled_orders), 2):
+            o = filled_orders[i]
+            if o.side is BUY:
+                buy_notional[o.id] -= o.quantity * o.price
+                buy_quantity[o.id] -= o.quantity
+            else:
+                sell_notional[o.id] -= o.quantity * o.price
+                sell_quantity[o.id] -= o.quantity
+
+    def rest(self, order):
+        # a resting order that did not come through reserve, from a snapshot
+        self.ensure(order.id)
+        if order.side is BUY:
+            self.buy_notional[order.id] += order.quantity * order.price
+            self.buy_quantity[order.id] += order.quantity
+        else:
+            self.sell_notional[order.id] += order.quantity * order.price
+            self.sell_quantity[order.id] += order.quantity
+
+    def exposure(self, trader_id):
+        # (buy notional, sell notional, buy quantity, sell quantity) of the resting orders
+        if 0 <= trader_id < self.count:
+            return (self.buy_notional[trader_id], self.sell_notional[trader_id],
+                    self.buy_quantity[trader_id], self.sell_quantity[trader_id])
+        return 0.0, 0.0, 0, 0
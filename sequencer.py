@@ -0,0 +1,97 @@
+import logging
+import threading
+import time
+from collections import deque
+
+# Sequencer mode of the threaded server: the handler threads of the traders only read and
+# decode the requests and put them on the inbound queue, and one matching thread takes
+# them off in batches and hands them to the Exchange, in the order they were queued. It
+# is the only thread that changes the books and the accounts, so it does not take the
+# locks of the symbols (Exchange.handle_request instead of handle_trader_request), and the
+# order in which the requests are handled is the order of the queue.
+#
+# The queue is a deque: appending and taking from it does not take a lock. The matching
+# thread only waits on an Event when the queue is empty, and a handler thread only waits
+# when the queue is full (capacity), so a slow matching thread slows the traders down
+# instead of using up the memory.
+#
+# While it handles a batch the matching thread holds Exchange.matching_lock, which the
+# snapshots of the journal and of the market data take instead of the symbol locks.
+# With the metrics on, the time every request spent on the queue is measured.
+
+logger = logging.getLogger("exchange.sequencer")
+
+
+class Sequencer(threading.Thread):
+    capacity = 65536 # requests waiting on the queue
+    max_batch = 1024 # requests handled without looking at the queue again
+
+    def __init__(self, exchange):
+        super().__init__(daemon=True)
+        self.exchange = exchange
+        self.inbound = deque()
+        self.ready = threading.Event() # set when there may be something on the queue
+        self.space = threading.Condition() # notified when a full queue got room
+        self.full = False
+        self.stopped = False
+        self.queue_time = None # a Histogram, see enable_metrics
+        self.handled = 0
+        self.batches = 0
+        exchange.matching_lock = threading.Lock()
+
+    def submit(self, request, clock=time.perf_counter):
+        # called by the handler threads
+        inbound = self.inbound
+        if len(inbound) >= self.capacity:
+            with self.space:
+                while len(inbound) >= self.capacity and not self.stopped:
+                    self.full = True
+                    self.space.wait(0.1)
+        inbound.append((request, clock()))
+        if not self.ready.is_set():
+            self.ready.set()
+
+    def enable_metrics(self, metrics):
+        self.queue_time = metrics.histogram("exchange_stage_seconds", "Seconds spent in each stage of handling the requests",
+                                            stage="queue")
+        metrics.gauge("exchange_inbound_queue", "Requests waiting for the matching thread",
+                      lambda: [({}, len(self.inbound))])
+
+    def run(self):
+        inbound = self.inbound
+        ready = self.ready
+        handle_request = self.exchange.handle_request
+        matching_lock = self.exchange.matching_lock
+        clock = time.perf_counter
+        popleft = inbound.popleft
+        while not self.stopped:
+            if not inbound:
+                ready.clear()
+                # a request appended before the clear is seen here, one appended after it sets ready again
+                if not inbound:
+                    ready.wait()
+                continue
+            n = min(len(inbound), self.max_batch)
+            queue_time = self.queue_time
+            with matching_lock:
+                for _ in range(n):
+                    request, queued = popleft()
+                    if queue_time is not None:
+                        queue_time.observe(clock() - queued)
+                    try:
+                        handle_request(request)
+                    except Exception:
+                        # a bad request must not stop the matching for everybody
+                        logger.exception("Failed to handle %s", request)
+            self.handled += n
+            self.batches += 1
+            if self.full:
+                with self.space:
+                    self.full = False
+                    self.space.notify_all()
+
+    def stop(self):
+        self.stopped = True
+        self.ready.set()
+        with self.space:
+            self.space.notify_all()
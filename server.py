@@ -1,127 +1,47 @@
 
 import socket
 import threading
+from contextlib import ExitStack, nullcontext
 from threading import Thread
 import socketserver
 import time
+import datetime
 from collections import deque
 import json
-from enum import Enum
-
-trader_sockets = {}
-exchange_lock = threading.Lock()
-trader_sockets_lock = threading.Lock()
-print_lock = threading.Lock()
-
-class OrderType(Enum):
-    LIMIT = 1
-    MARKET = 2
-    IOC = 3
-
-
-class OrderSide(Enum):
-    BUY = 1
-    SELL = 2
-
-
-class NonPositiveQuantity(Exception):
-    pass
-
-
-class NonPositivePrice(Exception):
-    pass
-
-
-class InvalidSide(Exception):
-    pass
-
-
-class UndefinedOrderType(Exception):
-    pass
-
-
-class UndefinedOrderSide(Exception):
-    pass
-
-
-class NewQuantityNotSmaller(Exception):
-    pass
-
-
-
-class UndefinedTraderAction(Exception):
-    pass
-
-
-class UndefinedResponse(Exception):
-    pass
-
-
-from abc import ABC
-
-
-class Order(ABC):
-    def __init__(self, id, symbol, quantity, side, time):
-        self.id = id
-        self.symbol = symbol
-        if quantity > 0:
-            self.quantity = quantity
-        else:
-            raise NonPositiveQuantity("Quantity Must Be Positive!")
-        if side in [OrderSide.BUY, OrderSide.SELL]:
-            self.side = side
-        else:
-            raise InvalidSide(
-                "Side Must Be Either \"Buy\" or \"OrderSide.SELL\"!")
-        self.time = time
-
-
-class LimitOrder(Order):
-    def __init__(self, id, symbol, quantity, price, side, time):
-        super().__init__(id, symbol, quantity, side, time)
-        if price > 0:
-            self.price = price
-        else:
-            raise NonPositivePrice("Price Must Be Positive!")
-        self.type = OrderType.LIMIT
-
-
-
-class MarketOrder(Order):
-    def __init__(self, id, symbol, quantity, side, time):
-        super().__init__(id, symbol, quantity, side, time)
-        self.type = OrderType.MARKET
-
-
-class IOCOrder(Order):
-    def __init__(self, id, symbol, quantity, price, side, time):
-        super().__init__(id, symbol, quantity, side, time)
-        if price > 0:
-            self.price = price
-        else:
-            raise NonPositivePrice("Price Must Be Positive!")
-        self.type = OrderType.IOC
-
-class FilledOrder(Order):
-    def __init__(self, id, symbol, quantity, price, side, time, limit=False):
-        super().__init__(id, symbol, quantity, side, time)
-        if price > 0:
-            self.price = price
-        else:
-            raise NonPositivePrice("Price Must Be Positive!")
-        self.limit = limit
-
-
-
-class NoOrderWithThisIDInOrderBook(Exception):
-    pass
+import argparse
+import logging
+from orders import *
+from order_book import BookSide
+from framing import *
+from connections import *
+import binary_protocol
+from exchange_logging import *
+from reporting import BalanceReporter, StatusServer
+from accounts import AccountStore
+from metrics import Metrics, TimedLock, timed
+from risk import RiskManager, RiskLimitBreached
+from pnl import PnLEngine
+from timer_wheel import TimerWheel, Expirer
+
+# for the checks of every placed order (set_day_expiry), as module globals instead of
+# attributes of the Enum classes
+LIMIT_ORDER = OrderType.LIMIT
+DAY = TimeInForce.DAY
+
+trader_connections = {}
+trader_connections_lock = threading.Lock()
+logger = logging.getLogger("exchange")
 
 
 class MatchingEngine():
     def __init__(self):
-        self.bid_book = []
-        self.ask_book = []
-        # These are the order books you are given and expected to use for matching the orders below
+        # price levels with a FIFO queue of orders on each level, see order_book.py
+        self.bid_book = BookSide(is_bid=True)
+        self.ask_book = BookSide(is_bid=False)
+        # (trader id, order id) -> (order, PriceLevel) for every order resting in the books
+        self.orders = {}
+        # TimerWheel of the orders with an expire time, made when the first one rests
+        self.expiries = None
 
     # Note: As you implement the following functions keep in mind that these enums are available:
     #     class OrderType(Enum):
@@ -147,38 +67,44 @@ class MatchingEngine():
             # You need to raise the following error if the type of order is ambiguous
             raise UndefinedOrderType("Undefined Order Type!")
 
-    def handle_transaction(self,filled_orders,o_book,order,quantity,price):
-        filled_orders.append(FilledOrder(o_book.id, o_book.symbol, quantity, price, o_book.side, time.time(), o_book.type == OrderType.LIMIT))
+    def handle_transaction(self,filled_orders,o_book,order,quantity,price,now,limit):
+        # o_book rests in the book, so it is a limit order; limit tells whether order is one
+        filled_orders.append(FilledOrder(o_book.id, o_book.symbol, quantity, price, o_book.side, now,
+                                         True, o_book.order_id))
         filled_orders.append(FilledOrder(order.id, order.symbol, quantity, price, order.side,
-                                         time.time(), order.type == OrderType.LIMIT))
+                                         now, limit, order.order_id))
 
 
-    def handle_limit_order(self, order):
-        if order.side not in OrderSide:
-            raise UndefinedOrderSide("Undefined Order Side!")
-        # Implement this function
-        # Keep in mind what happens to the orders in the limit order books when orders get filled
-        # or if there are no crosses from this order
-        # in other words, handle_limit_order accepts an arbitrary limit order that can either be
-        # filled if the limit order price crosses the book, or placed in the book. If the latter,
-        # pass the order to insert_limit_order below.
-        filled_orders = []
-        # The orders that are filled from the market order need to be inserted into the above list
+    def match_order(self, order, filled_orders, limit=True):
+        # fills order against the opposite side of the book in price-time priority
+        # limit=False is used for market orders, which match at any price
         order_side_is_sell = order.side == OrderSide.SELL
         book = self.bid_book if order_side_is_sell else self.ask_book
-        while order.quantity and len(book):
-            o = book[0]
-            if (o.price < order.price) == order_side_is_sell:
+        # all the fills of one order have the same time
+        now = time.time()
+        is_limit = order.type == OrderType.LIMIT
+        while order.quantity:
+            level = book.best
+            if level is None:
                 break
-            elif o.quantity > order.quantity:
-                self.handle_transaction(filled_orders,o,order,order.quantity,o.price)
-                o.quantity-=order.quantity
+            if limit and (level.price < order.price) == order_side_is_sell:
                 break
-            else: #order_from_book.quantity <= order.quantity
-                self.handle_transaction(filled_orders,o,order,o.quantity,o.price)
-                order.quantity -= o.quantity
-                book.remove(o)
+            o = level.head()
+            quantity = min(o.quantity, order.quantity)
+            self.handle_transaction(filled_orders, o, order, quantity, o.price, now, is_limit)
+            order.quantity -= quantity
+            if quantity == o.quantity:
+                del self.orders[(o.id, o.order_id)]
+            book.fill(level, o, quantity)
 
+    def handle_limit_order(self, order):
+        if order.side not in OrderSide:
+            raise UndefinedOrderSide("Undefined Order Side!")
+        # handle_limit_order accepts an arbitrary limit order that can either be
+        # filled if the limit order price crosses the book, or placed in the book. If the latter,
+        # the order is passed to insert_limit_order below.
+        filled_orders = []
+        self.match_order(order, filled_orders)
         if order.quantity:
             self.insert_limit_order(order)
         return filled_orders
@@ -186,180 +112,457 @@ class MatchingEngine():
     def handle_market_order(self, order):
         if order.side not in OrderSide:
             raise UndefinedOrderSide("Undefined Order Side!")
-        # Implement this function
-        # Keep in mind what happens to the orders in the limit order books when orders get filled
-        # or if there are no crosses from this order
-        # in other words, handle_limit_order accepts an arbitrary limit order that can either be
-        # filled if the limit order price crosses the book, or placed in the book. If the latter,
-        # pass the order to insert_limit_order below.
         filled_orders = []
-        # The orders that are filled from the market order need to be inserted into the above list
-        order_side_is_sell = order.side == OrderSide.SELL
-        book = self.bid_book if order_side_is_sell else self.ask_book
-        while order.quantity and len(book):
-            o = book[0]
-            if o.quantity > order.quantity:
-                self.handle_transaction(filled_orders, o, order, order.quantity, o.price)
-                o.quantity-=order.quantity
-                break
-            else: #order_from_book.quantity < order.quantity
-                self.handle_transaction(filled_orders, o, order, o.quantity, o.price)
-                order.quantity -= o.quantity
-                book.remove(o)
-
+        self.match_order(order, filled_orders, limit=False)
         return filled_orders
 
     def handle_ioc_order(self, order):
         if order.side not in OrderSide:
             raise UndefinedOrderSide("Undefined Order Side!")
-        # Implement this function
         filled_orders = []
-        # The orders that are filled from the ioc order need to be inserted into the above list
-        order_side_is_sell = order.side == OrderSide.SELL
-        book = self.bid_book if order_side_is_sell else self.ask_book
-        while order.quantity and len(book):
-            o = book[0]
-            if (o.price < order.price) == order_side_is_sell:
-                break
-            elif o.quantity > order.quantity:
-                self.handle_transaction(filled_orders, o, order, order.quantity, o.price)
-                o.quantity-=order.quantity
-                break
-            else: #order_from_book.quantity < order.quantity
-                self.handle_transaction(filled_orders, o, order, o.quantity, o.price)
-                order.quantity -= o.quantity
-                book.remove(o)
-        # The filled orders are expected to be the return variable (list)
+        # whatever is not filled immediately is dropped
+        self.match_order(order, filled_orders)
         return filled_orders
 
     def insert_limit_order(self, order):
         assert order.type == OrderType.LIMIT
-        # Implement this function
         # this function's sole puporse is to place limit orders in the book that are guaranteed
         # to not immediately fill
         if order.side not in OrderSide:
             # You need to raise the following error if the side the order is for is ambiguous
             raise UndefinedOrderSide("Undefined Order Side!")
-        order_side_is_sell = order.side == OrderSide.SELL
-        book = self.ask_book if order_side_is_sell else self.bid_book
-        sign = 1 if order_side_is_sell else -1
-        i = 0
-        for o in book:
-            if (sign*o.price, o.time)>(sign*order.price,order.time):
-                break
-            i+=1
-        book.insert(i,order)
-
-    def find_order(self,id):
-        for o in self.ask_book:
-            if o.id==id:
-                return o
-        for o in self.bid_book:
-            if o.id==id:
-                return o
-        raise NoOrderWithThisIDInOrderBook
-
-    def amend_quantity(self, id, quantity):
-        # Implement this function
-        # Hint: Remember that there are two order books, one on the bid side and one on the ask side
+        book = self.ask_book if order.side == OrderSide.SELL else self.bid_book
+        self.orders[(order.id, order.order_id)] = (order, book.insert(order))
+        if order.expires:
+            if self.expiries is None:
+                self.expiries = TimerWheel()
+            self.expiries.schedule(order.expires, order)
+
+    def expired_orders(self, now):
+        # the resting orders whose expire time has come by now; the caller cancels them
+        if self.expiries is None:
+            return []
+        orders = self.orders
+        expired = []
+        for o in self.expiries.advance(now):
+            # the ones cancelled or filled in the meantime are still in the wheel
+            entry = orders.get((o.id, o.order_id))
+            if entry is not None and entry[0] is o:
+                expired.append(o)
+        return expired
+
+    def find_order(self,id,order_id=0):
+        try:
+            return self.orders[(id, order_id)][0]
+        except KeyError:
+            raise NoOrderWithThisIDInOrderBook
+
+    def amend_quantity(self, id, quantity, order_id=0):
         if quantity<=0:
             raise NonPositiveQuantity("New quantity cannot be zero or negative. For zero use Cancel order.")
 
-        order = self.find_order(id)
+        try:
+            order, level = self.orders[(id, order_id)]
+        except KeyError:
+            raise NoOrderWithThisIDInOrderBook
 
         if order.quantity<=quantity:
         # You need to raise the following error if the user attempts to modify an order
         # with a quantity that's greater than given in the existing order
             raise NewQuantityNotSmaller("Amendment Must Reduce Quantity!")
         else:
-            order.quantity=quantity
+            book = self.bid_book if order.side == OrderSide.BUY else self.ask_book
+            book.amend(order, level, quantity)
 
-    def cancel_order(self, id):
-        # Implement this function
-        # Think about the changes you need to make in the order book based on the parameters given
-        o = self.find_order(id)
+    def cancel_order(self, id, order_id=0):
+        try:
+            o, level = self.orders.pop((id, order_id))
+        except KeyError:
+            raise NoOrderWithThisIDInOrderBook
         if o.side == OrderSide.BUY:
-            self.bid_book.remove(o)
+            self.bid_book.remove(o, level)
         else:
-            self.ask_book.remove(o)
+            self.ask_book.remove(o, level)
+
+    # Views of the book from the level aggregates of the BookSides (see order_book.py),
+    # they do not look at the orders. The caller holds the lock of the symbol.
+
+    def top_of_book(self):
+        # ((best bid, quantity), (best ask, quantity)), None for an empty side
+        return self.bid_book.top(), self.ask_book.top()
+
+    def depth(self, n=None):
+        # ([(price, quantity) of the best n bid levels], [... ask levels]), best first
+        return self.bid_book.depth(n), self.ask_book.depth(n)
+
+    def cumulative_volume(self, side, price):
+        # the quantity resting on side at price or better
+        return (self.bid_book if side == OrderSide.BUY else self.ask_book).volume_to(price)
+
+    def sweep_vwap(self, side, quantity):
+        # (average price, quantity filled) of a market order of side for quantity,
+        # without matching it; (None, 0) if the other side is empty
+        filled, paid = (self.ask_book if side == OrderSide.BUY else self.bid_book).sweep(quantity)
+        return (paid / filled if filled else None), filled
+
+    def imbalance(self, n=None):
+        # (bid volume - ask volume) / (bid volume + ask volume) of the best n levels, from -1 to 1
+        bids = self.bid_book.volume(n)
+        asks = self.ask_book.volume(n)
+        return (bids - asks) / (bids + asks) if bids + asks else 0.0
 
 
-class ActionType(Enum):
-    PLACE=1
-    AMEND=2
-    CANCEL=3
-    BALANCE=4
 class Exchange():
     def __init__(self):
         super().__init__()
-        self.balance = [1000000 for _ in range(100)]
-        self.position = [0 for _ in range(100)]# in my understangind these are numbers of position owned by the traders.
-        self.matching_engine = MatchingEngine()
+        # balances and positions (numbers of shares owned) of the traders, by trader id
+        self.accounts = AccountStore()
+        self.accounts_lock = threading.Lock()
+        self.pnl = PnLEngine() # realized and unrealized P&L of the traders, under the accounts lock
+        self.tape = None # a trade_tape.TradeTape, records the trades under the accounts lock
+        # every symbol has its own MatchingEngine, created when the symbol is first traded,
+        # and its own lock, so that orders for different symbols can be matched in parallel.
+        # place_new_order, amend_quantity and cancel_order expect the caller to hold the lock
+        # of the symbol (see handle_trader_request)
+        self.matching_engines = {}
+        self.symbol_locks = {}
+        self.engines_lock = threading.Lock() # only taken when a new symbol appears
+        # trader id -> {order id: symbol} of the orders of the trader resting in the books
+        self.trader_orders = {}
+        self.metrics = None # see enable_metrics
+        self.journal = None # a journal.JournalWriter, the requests changing the state are appended to it
+        self.market_data = None # a market_data.MarketDataPublisher
+        self.risk = None # a risk.RiskManager, checks the orders before they are matched
+        # held by the matching thread of the sequencer mode (see sequencer.py) instead of
+        # the symbol locks; what needs the whole exchange to stand still takes it too
+        self.matching_lock = None
+        # (hour, minute) of the local time the DAY orders expire at, and the session
+        # [day_start, day_end) end_of_day last found
+        self.session_end = (0, 0)
+        self.day_start = self.day_end = 0
+
+    def get_matching_engine(self, symbol):
+        engine = self.matching_engines.get(symbol)
+        if engine is None:
+            with self.engines_lock:
+                engine = self.matching_engines.get(symbol)
+                if engine is None:
+                    self.symbol_locks[symbol] = threading.Lock()
+                    engine = MatchingEngine()
+                    if self.metrics is not None:
+                        self.instrument_engine(symbol, engine)
+                    self.matching_engines[symbol] = engine
+        return engine
+
+    def enable_metrics(self, metrics=None):
+        # Replaces the methods of this exchange (and of its matching engines) that handle the
+        # requests by versions that measure them. Without this call nothing is measured and
+        # nothing is added to the path of the requests.
+        metrics = metrics or Metrics()
+        stages = "Seconds spent in each stage of handling the requests"
+        self.stage_times = dict((stage, metrics.histogram("exchange_stage_seconds", stages, stage=stage))
+                                for stage in ("decode", "lock_wait", "risk", "match", "accounting", "send"))
+        self.order_counts = dict((t, metrics.counter("exchange_orders_total", "Orders matched", type=t.name.lower()))
+                                 for t in OrderType)
+        self.trade_count = metrics.counter("exchange_trades_total", "Trades, every one has two fills")
+        self.reject_counts = dict((a, metrics.counter("exchange_rejects_total", "Rejected requests", action=a.name.lower()))
+                                  for a in (ActionType.PLACE, ActionType.AMEND, ActionType.CANCEL))
+        metrics.gauge("exchange_resting_orders", "Orders resting in the books", self.book_depth)
+        metrics.gauge("exchange_price_levels", "Price levels in the books", self.book_levels)
+        metrics.gauge("exchange_connected_traders", "Traders connected to the exchange",
+                      lambda: [({}, sum(1 for c in list(trader_connections.values()) if not c.closed))])
+
+        self.decode_request = timed(self.decode_request, self.stage_times["decode"])
+        self.apply_fills = timed(self.apply_fills, self.stage_times["accounting"])
+        if self.risk is not None:
+            self.risk.reserve = timed(self.risk.reserve, self.stage_times["risk"])
+        self.send_to_trader = timed(self.send_to_trader, self.stage_times["send"])
+        place_new_order, amend_quantity, cancel_order = self.place_new_order, self.amend_quantity, self.cancel_order
+        rejects = self.reject_counts
+        def counted_place_new_order(order):
+            results = place_new_order(order)
+            if results and results[0][1][2]:
+                rejects[ActionType.PLACE].inc()
+            return results
+        def counted_amend_quantity(*args):
+            response = amend_quantity(*args)
+            if not response[1]:
+                rejects[ActionType.AMEND].inc()
+            return response
+        def counted_cancel_order(*args):
+            response = cancel_order(*args)
+            if not response[1]:
+                rejects[ActionType.CANCEL].inc()
+            return response
+        self.place_new_order = counted_place_new_order
+        self.amend_quantity = counted_amend_quantity
+        self.cancel_order = counted_cancel_order
+        with self.engines_lock:
+            self.metrics = metrics
+            for symbol, engine in self.matching_engines.items():
+                self.instrument_engine(symbol, engine)
+        return metrics
+
+    def instrument_engine(self, symbol, engine):
+        handle_order = timed(engine.handle_order, self.stage_times["match"])
+        order_counts = self.order_counts
+        trade_count = self.trade_count
+        def counted_handle_order(order):
+            filled_orders = handle_order(order)
+            order_counts[order.type].inc()
+            if filled_orders:
+                trade_count.inc(len(filled_orders) // 2)
+            return filled_orders
+        engine.handle_order = counted_handle_order
+        self.symbol_locks[symbol] = TimedLock(self.symbol_locks[symbol], self.stage_times["lock_wait"])
+
+    def book_depth(self):
+        return [({"symbol": symbol, "side": side}, len(book))
+                for symbol, engine in list(self.matching_engines.items())
+                for side, book in (("bid", engine.bid_book), ("ask", engine.ask_book))]
+
+    def book_levels(self):
+        return [({"symbol": symbol, "side": side}, len(book.levels))
+                for symbol, engine in list(self.matching_engines.items())
+                for side, book in (("bid", engine.bid_book), ("ask", engine.ask_book))]
+
+    def symbol_lock(self, symbol):
+        self.get_matching_engine(symbol)
+        return self.symbol_locks[symbol]
+
+    def order_symbol(self, trader_id, order_id=0):
+        # the symbol the order rests in, None if there is no such order
+        orders = self.trader_orders.get(trader_id)
+        return None if orders is None else orders.get(order_id)
+
+    def order_lock(self, trader_id, order_id=0):
+        # the lock of the symbol the order rests in, if there is such an order
+        symbol = self.order_symbol(trader_id, order_id)
+        return nullcontext() if symbol is None else self.symbol_locks[symbol]
+
+    def batch_lock(self, requests):
+        # the locks of all the symbols the requests of a batch can touch, taken in the order
+        # of the symbols so that two batches cannot wait for each other
+        symbols = set()
+        for r in requests:
+            if r[0] == ActionType.PLACE:
+                symbols.add(r[2].symbol)
+            elif r[0] in (ActionType.AMEND, ActionType.CANCEL):
+                symbol = self.order_symbol(r[1], r[-1])
+                if symbol is not None:
+                    symbols.add(symbol)
+        symbols = sorted(symbols)
+        # the engines (and their locks) of new symbols are made before any symbol lock is
+        # held, take_snapshot takes engines_lock before the symbol locks
+        for symbol in symbols:
+            self.get_matching_engine(symbol)
+        stack = ExitStack()
+        for symbol in symbols:
+            stack.enter_context(self.symbol_locks[symbol])
+        return stack
+
+    def handle_batch(self, trader_id, requests):
+        # handles the requests of a batch one after the other (the caller holds batch_lock);
+        # returns the responses for trader_id, the other traders get theirs as usual
+        for r in requests:
+            if r[0] not in (ActionType.PLACE, ActionType.AMEND, ActionType.CANCEL, ActionType.BALANCE):
+                # checked before anything in the batch is done
+                raise UndefinedTraderAction("Undefined Trader Action In A Batch!")
+        responses = []
+        for r in requests:
+            actionType = r[0]
+            if actionType==ActionType.PLACE:
+                self.set_day_expiry(r[2])
+                if self.journal is not None:
+                    self.journal.append(r)
+                results = self.place_new_order(r[2])
+            elif actionType==ActionType.AMEND:
+                if self.journal is not None:
+                    self.journal.append(r)
+                results = [(r[1],self.amend_quantity(r[1],r[2],r[3]))]
+            elif actionType==ActionType.CANCEL:
+                if self.journal is not None:
+                    self.journal.append(r)
+                results = [(r[1],self.cancel_order(r[1],r[2]))]
+            else: # actionType==ActionType.BALANCE, see above
+                results = [(r[1],self.balance_and_position(r[1]))]
+            for res in results:
+                if res[0] == trader_id:
+                    response = res[1]
+                    o = response[1] if response[0] == ActionType.PLACE else None
+                    if isinstance(o, LimitOrder) and not response[2]:
+                        # a resting order can still change in the rest of the batch, the
+                        # response is about it as it is now
+                        o = LimitOrder(o.id, o.symbol, o.quantity, o.price, o.side, o.time, o.order_id,
+                                       o.time_in_force, o.expires)
+                        response = (ActionType.PLACE, o, False)
+                    responses.append(response)
+                else:
+                    self.send_to_trader(res[0],res[1])
+        return responses
 
     def place_new_order(self, order):
-        try:
-            self.matching_engine.find_order(order.id)
+        # the order ids of one trader must be unique among its resting orders, whatever the symbol
+        if self.order_symbol(order.id, order.order_id) is not None:
             return [(order.id,(ActionType.PLACE,order,True))]
-        except NoOrderWithThisIDInOrderBook:
-            pass
-        results = []
-        filled_orders = self.matching_engine.handle_order(order)
-        for o in filled_orders:
-            results.append((o.id,(ActionType.PLACE,o,False)))
-            pos_delta = o.quantity if o.side==OrderSide.BUY else -o.quantity
-            bal_delta = -o.price*pos_delta
-            self.balance[o.id]+=bal_delta
-            self.position[o.id]+=pos_delta
+        engine = self.get_matching_engine(order.symbol)
+        if order.type is LIMIT_ORDER and order.time_in_force is DAY and not order.expires:
+            # not placed through handle_request, e.g. replayed flow: the session of its own time
+            order.expires = self.end_of_day(order.time)
+        reserved = None
+        if self.risk is not None:
+            with self.accounts_lock:
+                try:
+                    reserved = self.risk.reserve(order, engine, self.accounts)
+                except RiskLimitBreached as e:
+                    logger.debug("Order %s of trader %s rejected, %s", order.order_id, order.id, e)
+                    return [(order.id,(ActionType.PLACE,order,True))]
+        filled_orders = engine.handle_order(order)
+        if (order.id, order.order_id) in engine.orders:
+            self.trader_orders.setdefault(order.id, {})[order.order_id] = order.symbol
+        if self.market_data is not None:
+            self.market_data.orders_matched(order.symbol, engine, order, filled_orders)
+        results = self.apply_fills(engine, order, filled_orders, reserved)
         if order.quantity:
             results.append((order.id,(ActionType.PLACE,order,False)))
         return results
 
-    def amend_quantity(self, order_id, quantity):
+    def set_day_expiry(self, order):
+        # a DAY order expires at the end of the session it arrives in; set before the order
+        # is journaled, so that the recovery gives it the same expiry
+        if order.type is LIMIT_ORDER and order.time_in_force is DAY and not order.expires:
+            order.expires = self.end_of_day(time.time())
+
+    def end_of_day(self, now):
+        # the end of the session now is in
+        if not self.day_start <= now < self.day_end:
+            hour, minute = self.session_end
+            end = datetime.datetime.fromtimestamp(now).replace(hour=hour, minute=minute, second=0, microsecond=0)
+            if end.timestamp() <= now:
+                end += datetime.timedelta(days=1)
+            self.day_end = end.timestamp()
+            self.day_start = (end - datetime.timedelta(days=1)).timestamp()
+        return self.day_end
+
+    def expire_orders(self, now=None):
+        # cancels the orders whose expire time has come, like CANCEL requests of their
+        # traders: they are journaled and the traders get the responses of the cancels
+        now = time.time() if now is None else now
+        for symbol, engine in list(self.matching_engines.items()):
+            if engine.expiries is None:
+                continue
+            with self.matching_lock or self.symbol_locks[symbol]:
+                # the due orders are out of the wheel already, one failing must not keep
+                # the others in the book
+                for o in engine.expired_orders(now):
+                    try:
+                        self.handle_request((ActionType.CANCEL, o.id, o.order_id))
+                    except Exception:
+                        logger.exception("Failed to expire order %s of trader %s", o.order_id, o.id)
+
+    def apply_fills(self, engine, order, filled_orders, reserved=None):
+        # updates the accounts of the traders and returns the responses for the fills;
+        # reserved is what the risk checks counted for order
+        results = []
+        accounts = self.accounts
+        pnl_fill = self.pnl.fill
+        with self.accounts_lock:
+            if reserved is not None:
+                resting = order.quantity if (order.id, order.order_id) in engine.orders else 0
+                self.risk.matched(order, filled_orders, reserved, resting)
+            for o in filled_orders:
+                results.append((o.id,(ActionType.PLACE,o,False)))
+                pos_delta = o.quantity if o.side==OrderSide.BUY else -o.quantity
+                bal_delta = -o.price*pos_delta
+                accounts.apply_fill(o.id, bal_delta, pos_delta)
+                pnl_fill(o.id, o.symbol, pos_delta, o.price)
+                key = (o.id, o.order_id)
+                if key not in engine.orders and key != (order.id, order.order_id):
+                    # the resting order was filled completely
+                    self.trader_orders[o.id].pop(o.order_id, None)
+            if self.tape is not None:
+                self.tape.record(filled_orders)
+        return results
+
+    def amend_quantity(self, trader_id, quantity, order_id=0):
         amended_successfully = False
         try:
-            self.matching_engine.amend_quantity(order_id,quantity)
+            symbol = self.order_symbol(trader_id, order_id)
+            if symbol is None:
+                raise NoOrderWithThisIDInOrderBook
+            engine = self.matching_engines[symbol]
+            o = engine.find_order(trader_id, order_id)
+            old_quantity = o.quantity
+            engine.amend_quantity(trader_id,quantity,order_id)
             amended_successfully = True
+            if self.risk is not None:
+                with self.accounts_lock:
+                    self.risk.release(trader_id, o.side, (old_quantity - quantity) * o.price, old_quantity - quantity)
+            if self.market_data is not None:
+                self.market_data.levels_changed(symbol, engine, [(o.side, o.price)])
         except (NoOrderWithThisIDInOrderBook,NonPositiveQuantity,NewQuantityNotSmaller) as e:
             amended_successfully = False
-        return (ActionType.AMEND,amended_successfully,quantity)#I added quantity to response to be able to adjust book_position on the trader's side
+        return (ActionType.AMEND,amended_successfully,quantity,order_id)#I added quantity to response to be able to adjust book_position on the trader's side
 
-    def cancel_order(self, order_id):
+    def cancel_order(self, trader_id, order_id=0):
         canceled_successfully = False
         try:
-            self.matching_engine.cancel_order(order_id)
+            symbol = self.order_symbol(trader_id, order_id)
+            if symbol is None:
+                raise NoOrderWithThisIDInOrderBook
+            engine = self.matching_engines[symbol]
+            o = engine.find_order(trader_id, order_id)
+            engine.cancel_order(trader_id, order_id)
+            del self.trader_orders[trader_id][order_id]
             canceled_successfully = True
+            if self.risk is not None:
+                with self.accounts_lock:
+                    self.risk.release(trader_id, o.side, o.quantity * o.price, o.quantity)
+            if self.market_data is not None:
+                self.market_data.levels_changed(symbol, engine, [(o.side, o.price)])
         except NoOrderWithThisIDInOrderBook:
             canceled_successfully = False
-        return (ActionType.CANCEL,canceled_successfully)
+        return (ActionType.CANCEL,canceled_successfully,order_id)
 
     def balance_and_position(self, trader_id):
+        # book_position is the quantity of all the orders of the trader resting in the books
         book_position = 0
-        o = None
-        try:
-            o = self.matching_engine.find_order(trader_id)
-            book_position = o.quantity
-        except NoOrderWithThisIDInOrderBook:
-            book_position = 0
-        return (ActionType.BALANCE,(self.balance[trader_id],self.position[trader_id],book_position))
+        for order_id, symbol in list(self.trader_orders.get(trader_id, {}).items()):
+            o = self.matching_engines[symbol].orders.get((trader_id, order_id))
+            if o is not None:
+                book_position += o[0].quantity
+        with self.accounts_lock:
+            balance, position = self.accounts.get(trader_id)
+            realized, unrealized = self.pnl.get(trader_id)
+        return (ActionType.BALANCE,(balance,position,book_position,realized,unrealized))
 
     def convert_dic_from_trader_to_tuple_request(self,dic):
         actionType  = ActionType(dic["ActionType"])
-        trader_id = dic["TraderID"]
+        trader_id = check_trader_id(dic["TraderID"])
         if actionType==ActionType.PLACE:
             orderType = OrderType(dic["OrderType"])
+            # OrderID is optional, the old clients only have one order at a time
+            order_id = dic.get("OrderID", 0)
+            quantity = check_quantity(dic["Quantity"])
             if orderType==OrderType.LIMIT:
-                o = LimitOrder(trader_id,dic["Symbol"],dic["Quantity"],dic["Price"],OrderSide(dic["Side"]),dic["Time"])
+                # GTC unless TimeInForce says otherwise, GTD orders have an ExpireTime
+                o = LimitOrder(trader_id,dic["Symbol"],quantity,dic["Price"],OrderSide(dic["Side"]),dic["Time"],order_id,
+                               TimeInForce(dic.get("TimeInForce", 0)),dic.get("ExpireTime", 0))
             elif orderType==OrderType.MARKET:
-                o = MarketOrder(trader_id,dic["Symbol"],dic["Quantity"],OrderSide(dic["Side"]),dic["Time"])
+                o = MarketOrder(trader_id,dic["Symbol"],quantity,OrderSide(dic["Side"]),dic["Time"],order_id)
             elif orderType==OrderType.IOC:
-                o = IOCOrder(trader_id, dic["Symbol"],dic["Price"], dic["Quantity"], OrderSide(dic["Side"]), dic["Time"])
+                o = IOCOrder(trader_id, dic["Symbol"], quantity, dic["Price"], OrderSide(dic["Side"]), dic["Time"], order_id)
             return (actionType,trader_id,o)
         elif actionType==ActionType.AMEND:
-            return (actionType,trader_id,dic["Quantity"])
+            return (actionType,trader_id,check_quantity(dic["Quantity"]),dic.get("OrderID", 0))
         elif actionType==ActionType.CANCEL:
-            return (actionType,trader_id)
+            return (actionType,trader_id,dic.get("OrderID", 0))
         elif actionType==ActionType.BALANCE:
             return (actionType,trader_id)
+        elif actionType==ActionType.BATCH:
+            # the actions of a batch are for the trader of the batch
+            return (actionType,trader_id,[self.convert_dic_from_trader_to_tuple_request(dict(d, TraderID=trader_id))
+                                          for d in dic["Actions"]])
         else:
             raise UndefinedTraderAction
 
@@ -368,6 +571,7 @@ class Exchange():
         if t[0] == ActionType.PLACE:
             o = t[1]
             dic["TraderID"] = o.id
+            dic["OrderID"] = o.order_id
             dic["Symbol"] = o.symbol
             dic["Quantity"] = o.quantity
             dic["Side"] = o.side.value
@@ -378,64 +582,100 @@ class Exchange():
             dic["OrderPresent"] = int(t[2])
             if not dic["IsFilledOrder"]:
                 dic["OrderType"] = o.type.value
+                if o.type == OrderType.LIMIT and o.time_in_force != TimeInForce.GTC:
+                    dic["TimeInForce"] = o.time_in_force.value
+                    dic["ExpireTime"] = o.expires
             else:
                 dic["IsLimit"] = int(o.limit)
         elif t[0] == ActionType.AMEND:
             dic["Successfully"] = int(t[1])
             dic["Quantity"] = t[2]
+            dic["OrderID"] = t[3]
         elif t[0] == ActionType.CANCEL:
             dic["Successfully"] = int(t[1])
+            dic["OrderID"] = t[2]
         elif t[0] == ActionType.BALANCE:
             dic["Balance"] = t[1][0]
             dic["Position"] = t[1][1]
             dic["BookPosition"] = t[1][2]
+            dic["RealizedPnL"] = t[1][3]
+            dic["UnrealizedPnL"] = t[1][4]
+        elif t[0] == ActionType.BATCH:
+            dic["Responses"] = [self.convert_tuple_from_exchange_to_dic(r) for r in t[1]]
         return dic
 
-    def send_to_trader(self,trader_id,r):
-        print_lock.acquire()
-        print("Sending the following message to trader with id = {}".format(trader_id))
-        print(r)
-        print_lock.release()
-        send_fixed_len(trader_sockets[trader_id], r)
+    def decode_request(self, data, codec=JSON_CODEC):
+        if codec == BINARY_CODEC:
+            return binary_protocol.decode_request(data)
+        return self.convert_dic_from_trader_to_tuple_request(json.loads(data))
+
+    def encode_response(self, response, codec=JSON_CODEC):
+        if codec == BINARY_CODEC:
+            return binary_protocol.encode_response(response)
+        return json.dumps(self.convert_tuple_from_exchange_to_dic(response))
+
+    def send_to_trader(self,trader_id,response):
+        connection = trader_connections.get(trader_id)
+        if connection is None:
+            # not connected (yet), e.g. the owner of an order recovered from the journal;
+            # what the response tells has already happened
+            return
+        r = self.encode_response(response, connection.codec)
+        logger.debug("Sending the following message to trader with id = %s: %s", trader_id, r)
+        connection.send(r)
+
+    def request_lock(self, request):
+        # the locks of the symbols the request can touch
+        actionType = request[0]
+        if actionType==ActionType.PLACE:
+            return self.symbol_lock(request[2].symbol)
+        elif actionType==ActionType.AMEND or actionType==ActionType.CANCEL:
+            return self.order_lock(request[1], request[-1])
+        elif actionType==ActionType.BATCH:
+            return self.batch_lock(request[2])
+        return nullcontext()
 
     def handle_trader_request(self, request):
+        with self.request_lock(request):
+            self.handle_request(request)
+
+    def handle_request(self, request):
+        # the caller holds request_lock(request), or is the only thread that handles
+        # requests (see sequencer.py)
         actionType = request[0]
         if actionType not in ActionType:
             raise UndefinedTraderAction("Undefined Trader Action!")
         elif actionType==ActionType.PLACE:
-            order = request[2]
-            results =  self.place_new_order(order)
+            self.set_day_expiry(request[2])
+            if self.journal is not None:
+                self.journal.append(request)
+            results =  self.place_new_order(request[2])
             for res in results:
                 trader_id = res[0]
                 response = res[1]
-                r = json.dumps(self.convert_tuple_from_exchange_to_dic(response))
-                self.send_to_trader(trader_id,r)
+                self.send_to_trader(trader_id,response)
         elif actionType==ActionType.AMEND:
-            order_id = request[1]
+            trader_id = request[1]
             quantity = request[2]
-            r  =json.dumps(self.convert_tuple_from_exchange_to_dic(self.amend_quantity(order_id,quantity)))
-            self.send_to_trader(order_id,r)
+            order_id = request[3]
+            if self.journal is not None:
+                self.journal.append(request)
+            self.send_to_trader(trader_id,self.amend_quantity(trader_id,quantity,order_id))
 
         elif actionType==ActionType.CANCEL:
-            order_id = request[1]
-            r = json.dumps(self.convert_tuple_from_exchange_to_dic(self.cancel_order(order_id)))
-            self.send_to_trader(order_id,r)
-
-        else: # actionType==ActionType.BALANCE:
             trader_id = request[1]
-            r = json.dumps(self.convert_tuple_from_exchange_to_dic(self.balance_and_position(trader_id)))
-            self.send_to_trader(trader_id,r)
-
-# I always send messages 1024 bytes long
-msg_len = 1024
-def my_send(data):
-    return bytes(data+" ".join([""]*(msg_len-len(data)+1)),"utf-8")
-def send_fixed_len(sock,msg):
-    return sock.sendall(my_send(msg))
-def recv_fixed_len(sock):
-    return sock.recv(msg_len).strip().decode("utf-8")
+            order_id = request[2]
+            if self.journal is not None:
+                self.journal.append(request)
+            self.send_to_trader(trader_id,self.cancel_order(trader_id,order_id))
 
+        elif actionType==ActionType.BATCH:
+            trader_id = request[1]
+            self.send_to_trader(trader_id,(ActionType.BATCH,self.handle_batch(trader_id,request[2])))
 
+        else: # actionType==ActionType.BALANCE:
+            trader_id = request[1]
+            self.send_to_trader(trader_id,self.balance_and_position(trader_id))
 
 exchange  = Exchange()
 
@@ -443,37 +683,123 @@ exchange  = Exchange()
 class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
 
     def handle(self):
-        trader_sockets_lock.acquire()
-        tr_id = int(recv_fixed_len(self.request))
-        trader_sockets[tr_id] = self.request
-        trader_sockets_lock.release()
-        print_lock.acquire()
-        print("Got connection from {}  id = {}".format(self.client_address[0], tr_id))
-        print_lock.release()
-        send_fixed_len(self.request, str(tr_id))
+        # self.request is the TCP socket connected to the client
+        reader = FrameReader(self.request)
+        sequencer = self.server.sequencer
+        tr_id, framing, codec, reply = parse_handshake(reader.recv())
+        connection = TraderConnection(self.request, framing, codec)
+        trader_connections_lock.acquire()
+        trader_connections[tr_id] = connection
+        trader_connections_lock.release()
+        logger.info("Got connection from %s  id = %s", self.client_address[0], tr_id)
+        send_fixed_len(self.request, reply)
+        reader.framing = framing
         time.sleep(5)
-        while True:
-            # self.request is the TCP socket connected to the client
-            rec_data = recv_fixed_len(self.request)
-            print_lock.acquire()
-            print("Trader with id = {} and ip adress {} wrote:".format(tr_id,self.client_address[0]))
-            print(rec_data)
-            print_lock.release()
-            exchange_lock.acquire()
-            t = exchange.convert_dic_from_trader_to_tuple_request(json.loads(rec_data))
-            exchange.handle_trader_request(t)
-            exchange_lock.release()
+        try:
+            while True:
+                try:
+                    rec_data = reader.read_frame()
+                except (ConnectionClosed, OSError):
+                    # the trader left, or its connection was closed because it did not keep up
+                    break
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Trader with id = %s and ip adress %s wrote: %s", tr_id, self.client_address[0],
+                                 rec_data.decode("utf-8") if codec == JSON_CODEC else rec_data)
+                try:
+                    t = exchange.decode_request(rec_data, codec)
+                except Exception:
+                    # a malformed frame is skipped, the connection goes on
+                    logger.exception("Failed to decode %s", rec_data)
+                    continue
+                # the exchange takes the locks of the symbols it needs itself, or the
+                # sequencer's matching thread handles the request
+                if sequencer is None:
+                    exchange.handle_trader_request(t)
+                else:
+                    sequencer.submit(t)
+        finally:
+            # also stops the writer thread when the handler ends with an error
+            connection.close()
 
 class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     daemon_threads = True
     request_queue_size = 100
     allow_reuse_address = True
-    pass
+    sequencer = None # a sequencer.Sequencer in the sequencer mode
 
 if __name__=="__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=("threaded", "asyncio", "sequencer"), default="threaded",
+                        help="a thread per trader, one event loop with a single matching task, or a thread per "
+                             "trader reading the requests for a single matching thread")
+    parser.add_argument("--slow-clients", choices=SLOW_CLIENT_POLICIES, default=DISCONNECT,
+                        help="what to do with a trader that does not read its messages fast enough")
+    parser.add_argument("--report-interval", type=float, default=5,
+                        help="seconds between the reports of the balances")
+    parser.add_argument("--status-port", type=int, default=None,
+                        help="serve the latest balances at http://localhost:<port>/balances")
+    parser.add_argument("--journal", default=None,
+                        help="directory of the journal and the snapshots, the state is recovered from it on start")
+    parser.add_argument("--snapshot-interval", type=float, default=60,
+                        help="seconds between the snapshots of the books and the accounts")
+    parser.add_argument("--market-data-port", type=int, default=None,
+                        help="publish the trades and the changes of the books to the subscribers of this port")
+    parser.add_argument("--risk-limits", default=None,
+                        help="JSON file with the limits of the pre-trade risk checks, see risk.py")
+    parser.add_argument("--trade-tape", default=None,
+                        help="directory of the trade tape to append the trades to, see trade_tape.py")
+    parser.add_argument("--session-end", default="00:00",
+                        help="local time (HH:MM) the DAY orders expire at")
+    parser.add_argument("--metrics", action="store_true",
+                        help="measure the stages of the requests, served at http://localhost:<status port>/metrics")
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    if args.metrics and not args.status_port:
+        # measuring costs time on every request, only worth it when /metrics is served
+        parser.error("--metrics needs --status-port")
+    log_listener = setup_logging(args.log, args.log_file)
     HOST,PORT = "localhost",9999
 
-    server = ThreadedTCPServer((HOST, PORT), ThreadedTCPRequestHandler)
+    TraderConnection.slow_client_policy = args.slow_clients
+    exchange.session_end = tuple(int(x) for x in args.session_end.split(":"))
+    if args.risk_limits:
+        # before the recovery, the journal has the orders that were rejected too
+        exchange.risk = RiskManager.from_file(args.risk_limits)
+    if args.journal:
+        import journal
+        start = time.perf_counter()
+        last_sequence = journal.recover(exchange, args.journal)
+        logger.info("Recovery took %.3f s", time.perf_counter() - start)
+        exchange.journal = journal.JournalWriter(args.journal, last_sequence)
+        exchange.journal.start()
+        snapshotter = journal.Snapshotter(exchange, exchange.journal, args.snapshot_interval)
+        snapshotter.start()
+    if args.trade_tape:
+        # after the recovery, the trades replayed from the journal are on the tape already
+        from trade_tape import TradeTape, Flusher
+        exchange.tape = TradeTape(args.trade_tape)
+        Flusher(exchange.tape).start()
+    if args.market_data_port:
+        from market_data import MarketDataPublisher, MarketDataServer
+        exchange.market_data = MarketDataPublisher(exchange)
+        exchange.market_data.start()
+        market_data_server = MarketDataServer((HOST, args.market_data_port), exchange.market_data)
+        market_data_server.start()
+    routes = {}
+    if args.metrics:
+        metrics = exchange.enable_metrics()
+        routes["/metrics"] = metrics.prometheus
+    if args.mode == "asyncio":
+        from async_server import AsyncExchangeServer
+        server = AsyncExchangeServer(exchange, trader_connections, (HOST, PORT), slow_client_policy=args.slow_clients)
+    else:
+        server = ThreadedTCPServer((HOST, PORT), ThreadedTCPRequestHandler)
+        if args.mode == "sequencer":
+            from sequencer import Sequencer
+            server.sequencer = Sequencer(exchange)
+            if args.metrics:
+                server.sequencer.enable_metrics(metrics)
+            server.sequencer.start()
     with server:
         ip, port = server.server_address
         try:
@@ -483,24 +809,27 @@ if __name__=="__main__":
             # Exit the server thread when the main thread terminates
             server_thread.daemon = True
             server_thread.start()
-            print_lock.acquire()
-            print("Server loop running in thread:", server_thread.name)
-            print_lock.release()
-            time.sleep(1)
-            while True:
-                exchange_lock.acquire()
-                bal_sum =  sum(exchange.balance)
-                print_lock.acquire()
-                print("Sum of balances of all traders at the moment = {}".format(bal_sum))
-                print("Their balances are:")
-                print("("+", ".join([str(b) for b in exchange.balance])+")")
-                time.sleep(2)
-                print_lock.release()
-                exchange_lock.release()
-                time.sleep(5)
+            logger.info("Server loop running in thread: %s", server_thread.name)
+            reporter = BalanceReporter(exchange, args.report_interval)
+            reporter.start()
+            if args.mode != "asyncio":
+                # the asyncio server expires the orders on its event loop
+                expirer = Expirer(exchange)
+                expirer.start()
+            if args.status_port:
+                routes["/balances"] = reporter.balances_json
+                status_server = StatusServer((HOST, args.status_port), routes)
+                status_server.start()
+            while server_thread.is_alive():
+                server_thread.join(1)
 
         except KeyboardInterrupt:
-            print("KeyboardInterrupt.")
+            logger.info("KeyboardInterrupt.")
             server.shutdown()
+            if exchange.journal is not None:
+                exchange.journal.stop()
+            if exchange.tape is not None:
+                exchange.tape.flush()
+            log_listener.stop()
 
 
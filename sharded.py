@@ -0,0 +1,393 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import zlib
+from orders import *
+from framing import *
+from connections import DISCONNECT, SLOW_CLIENT_POLICIES
+from async_server import AsyncExchangeServer, AsyncTraderConnection, read_frame
+from exchange_logging import *
+from server import Exchange
+import binary_protocol
+
+# Sharded deployment of the exchange, for more than one core. A gateway process accepts
+# the connections of the traders (like the asyncio server, same port and protocol) and
+# routes every request by its symbol to one of N worker processes, the shards. Every shard
+# has its own Exchange with the matching engines of its symbols, and handles its requests
+# one after the other in a single thread, so nothing is locked. The requests go to the
+# shards encoded with binary_protocol, in one message per pass of the gateway's event
+# loop, and the shards send back the responses already encoded for the traders.
+#
+# Every shard also has its own accounts, the balances of a trader are settled per shard:
+# a BALANCE request goes to all the shards and the gateway adds up their answers (all
+# of them start with the initial balance). The gateway remembers in which shard every
+# order id of a trader may rest, for the AMEND and CANCEL requests, and the shards tell it
+# when an order stops resting, so an order id used in one shard cannot be used for a
+# symbol of another shard until the gateway has heard that. A BATCH is split between the
+# shards it touches, every shard handles its part at once, but the parts of different
+# shards are not handled at the same moment.
+#
+# Every shard expires the GTD and DAY orders of its symbols itself, between its messages.
+#
+# There is no journal, market data or metrics endpoint in this mode.
+#
+#   python sharded.py --shards 4
+
+logger = logging.getLogger("exchange.sharded")
+
+# messages from the gateway to a shard: (kind, tag, payload)
+REQUEST = 0 # a PLACE, AMEND or CANCEL request encoded with binary_protocol
+TRADER = 1 # tag is a trader id, payload the codec of its connection
+BATCH = 2 # tag identifies the batch in the gateway, payload is (trader id, [encoded requests])
+
+
+def shard_of(symbol, shards):
+    # the same in every process, unlike hash()
+    return zlib.crc32(symbol.encode("utf-8")) % shards
+
+
+class ShardExchange(Exchange):
+    # The Exchange of a shard. The responses are collected, encoded, for the gateway
+    # instead of being sent, and so are the keys of the orders that are not resting
+    # any more: one for every PLACE request, once its order is done.
+    def __init__(self):
+        super().__init__()
+        self.codecs = {} # trader id -> codec of its connection to the gateway
+        self.outputs = [] # (trader id, encoded response)
+        self.released = [] # (trader id, order id)
+
+    def send_to_trader(self, trader_id, response):
+        self.outputs.append((trader_id, self.encode_response(response, self.codecs.get(trader_id, JSON_CODEC))))
+
+    def place_new_order(self, order):
+        key = (order.id, order.order_id)
+        if self.order_symbol(order.id, order.order_id) is not None:
+            # rejected, the order id belongs to a resting order
+            self.released.append(key)
+            return super().place_new_order(order)
+        results = super().place_new_order(order)
+        orders = self.matching_engines[order.symbol].orders
+        released = self.released
+        for trader_id, response in results:
+            o = response[1]
+            if isinstance(o, FilledOrder):
+                filled_key = (o.id, o.order_id)
+                if filled_key != key and filled_key not in orders:
+                    released.append(filled_key)
+        if key not in orders:
+            released.append(key)
+        return results
+
+    def cancel_order(self, trader_id, order_id=0):
+        response = super().cancel_order(trader_id, order_id)
+        if response[1]:
+            self.released.append((trader_id, order_id))
+        return response
+
+
+def run_shard(shard, requests, replies, expiry_interval=0.1):
+    # the main function of a worker process
+    exchange = ShardExchange()
+    decode_request = binary_protocol.decode_request
+    # the only thread of the shard, nothing to lock
+    handle_request = exchange.handle_request
+    expired = time.time()
+    try:
+        while True:
+            try:
+                messages = requests.get(timeout=expiry_interval)
+            except queue.Empty:
+                messages = []
+            if messages is None:
+                break
+            now = time.time()
+            if now - expired >= expiry_interval:
+                expired = now
+                exchange.expire_orders(now)
+            if not messages and not exchange.outputs and not exchange.released:
+                continue
+            answers = []
+            for kind, tag, payload in messages:
+                if kind == REQUEST:
+                    try:
+                        handle_request(decode_request(payload))
+                    except Exception:
+                        logger.exception("Shard %s failed to handle %s", shard, payload)
+                elif kind == TRADER:
+                    exchange.codecs[tag] = payload
+                else: # kind == BATCH
+                    # the responses of every request separately, the gateway puts them in order
+                    trader_id, items = payload
+                    responses = []
+                    for item in items:
+                        try:
+                            responses.append(exchange.handle_batch(trader_id, [decode_request(item)]))
+                        except Exception:
+                            logger.exception("Shard %s failed to handle %s", shard, item)
+                            responses.append([])
+                    answers.append((tag, responses))
+            replies.put((shard, exchange.outputs, exchange.released, answers))
+            exchange.outputs = []
+            exchange.released = []
+    except KeyboardInterrupt:
+        pass
+
+
+class PendingBatch():
+    # a BATCH (or BALANCE) request waiting for the answers of the shards
+    def __init__(self, trader_id, size, wrap):
+        self.trader_id = trader_id
+        self.wrap = wrap # False for a BALANCE request on its own
+        self.slots = [[] for _ in range(size)] # the responses of every request of the batch
+        self.balances = set() # indexes of the BALANCE requests, every shard answers them
+        self.indexes = {} # shard -> indexes of the requests it got
+        self.remaining = 0 # shards still to answer
+
+
+class Gateway(AsyncExchangeServer):
+    def __init__(self, server_address, shards=None, trading_delay=5, slow_client_policy=DISCONNECT):
+        # the Exchange is only used for the conversions of the JSON messages
+        super().__init__(Exchange(), {}, server_address, trading_delay, slow_client_policy)
+        self.shards = shards or os.cpu_count()
+        self.initial_balance = self.exchange.accounts.initial_balance
+        context = multiprocessing.get_context("spawn")
+        self.requests = [context.Queue() for _ in range(self.shards)]
+        self.replies = context.Queue()
+        self.workers = [context.Process(target=run_shard, args=(shard, self.requests[shard], self.replies), daemon=True)
+                        for shard in range(self.shards)]
+        self.outbox = [[] for _ in range(self.shards)] # messages for the shards, sent by flush
+        self.flush_scheduled = False
+        self.symbol_shards = {}
+        # (trader id, order id) -> [shard, PLACE requests with this key that may still rest]
+        self.order_shards = {}
+        self.pending = {} # tag -> PendingBatch
+        self.next_tag = 0
+
+    def symbol_shard(self, symbol):
+        shard = self.symbol_shards.get(symbol)
+        if shard is None:
+            shard = self.symbol_shards[symbol] = shard_of(symbol, self.shards)
+        return shard
+
+    def forward(self, shard, message):
+        self.outbox[shard].append(message)
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon(self.flush)
+
+    def flush(self):
+        # what was routed in one pass of the event loop goes to a shard in one message
+        self.flush_scheduled = False
+        for shard, messages in enumerate(self.outbox):
+            if messages:
+                self.requests[shard].put(messages)
+                self.outbox[shard] = []
+
+    def request_shard(self, request):
+        # the shard of a PLACE, AMEND or CANCEL request, None if it fails anyway: an AMEND
+        # or CANCEL of an order that rests nowhere, or a PLACE with the order id of an order
+        # that can still rest in another shard
+        actionType = request[0]
+        if actionType == ActionType.PLACE:
+            order = request[2]
+            shard = self.symbol_shard(order.symbol)
+            key = (order.id, order.order_id)
+            entry = self.order_shards.get(key)
+            if entry is None:
+                self.order_shards[key] = [shard, 1]
+            elif entry[0] != shard:
+                return None
+            else:
+                entry[1] += 1
+            return shard
+        elif actionType == ActionType.AMEND or actionType == ActionType.CANCEL:
+            entry = self.order_shards.get((request[1], request[-1]))
+            return None if entry is None else entry[0]
+        raise UndefinedTraderAction("Undefined Trader Action!")
+
+    def rejected(self, request):
+        # the response of the Exchange to a request that fails
+        if request[0] == ActionType.PLACE:
+            return (ActionType.PLACE, request[2], True)
+        elif request[0] == ActionType.AMEND:
+            return (ActionType.AMEND, False, request[2], request[3])
+        return (ActionType.CANCEL, False, request[2])
+
+    def send_to_trader(self, trader_id, response):
+        connection = self.trader_connections.get(trader_id)
+        if connection is not None:
+            connection.send(self.exchange.encode_response(response, connection.codec))
+
+    def route(self, request, data=None):
+        # data is the request encoded with binary_protocol, if the trader sent it so
+        actionType = request[0]
+        if actionType == ActionType.BALANCE:
+            self.route_batch(request[1], [request], wrap=False)
+        elif actionType == ActionType.BATCH:
+            self.route_batch(request[1], request[2])
+        else:
+            shard = self.request_shard(request)
+            if shard is None:
+                self.send_to_trader(request[1], self.rejected(request))
+            else:
+                self.forward(shard, (REQUEST, 0, data or binary_protocol.encode_request(request)))
+
+    def route_batch(self, trader_id, requests, wrap=True):
+        for r in requests:
+            if r[0] not in (ActionType.PLACE, ActionType.AMEND, ActionType.CANCEL, ActionType.BALANCE):
+                # checked before anything in the batch is done
+                raise UndefinedTraderAction("Undefined Trader Action In A Batch!")
+        batch = PendingBatch(trader_id, len(requests), wrap)
+        items = {}
+        for i, r in enumerate(requests):
+            if r[0] == ActionType.BALANCE:
+                batch.balances.add(i)
+                shards = range(self.shards)
+            else:
+                shard = self.request_shard(r)
+                if shard is None:
+                    batch.slots[i].append(self.rejected(r))
+                    continue
+                shards = (shard,)
+            data = binary_protocol.encode_request(r)
+            for shard in shards:
+                items.setdefault(shard, []).append(data)
+                batch.indexes.setdefault(shard, []).append(i)
+        if not items:
+            self.complete(batch)
+            return
+        tag = self.next_tag
+        self.next_tag += 1
+        self.pending[tag] = batch
+        batch.remaining = len(items)
+        for shard, data in items.items():
+            self.forward(shard, (BATCH, tag, (trader_id, data)))
+
+    def combined_balance(self, responses):
+        # the shards have their own accounts, every one starts with the initial balance
+        balance = sum(r[1][0] for r in responses) - (len(responses) - 1) * self.initial_balance
+        position = sum(r[1][1] for r in responses)
+        book_position = sum(r[1][2] for r in responses)
+        # the symbols of one shard are not in another, their P&L adds up
+        realized = sum(r[1][3] for r in responses)
+        unrealized = sum(r[1][4] for r in responses)
+        return (ActionType.BALANCE, (balance, position, book_position, realized, unrealized))
+
+    def complete(self, batch):
+        responses = []
+        for i, slot in enumerate(batch.slots):
+            if i in batch.balances:
+                responses.append(self.combined_balance(slot))
+            else:
+                responses.extend(slot)
+        self.send_to_trader(batch.trader_id, (ActionType.BATCH, responses) if batch.wrap else responses[0])
+
+    def deliver(self, reply):
+        # called on the event loop with what a shard sent back
+        shard, outputs, released, answers = reply
+        connections = self.trader_connections
+        for trader_id, data in outputs:
+            connection = connections.get(trader_id)
+            if connection is not None:
+                connection.send(data)
+        order_shards = self.order_shards
+        for key in released:
+            entry = order_shards[key]
+            entry[1] -= 1
+            if not entry[1]:
+                del order_shards[key]
+        for tag, responses in answers:
+            batch = self.pending[tag]
+            for i, r in zip(batch.indexes[shard], responses):
+                batch.slots[i].extend(r)
+            batch.remaining -= 1
+            if not batch.remaining:
+                del self.pending[tag]
+                self.complete(batch)
+
+    def read_replies(self):
+        # a thread, so that the gateway never waits for a shard on the event loop
+        replies = self.replies
+        call_soon_threadsafe = self.loop.call_soon_threadsafe
+        deliver = self.deliver
+        while True:
+            reply = replies.get()
+            if reply is None:
+                return
+            call_soon_threadsafe(deliver, reply)
+
+    async def handle_connection(self, reader, writer):
+        try:
+            tr_id, framing, codec, reply = parse_handshake((await read_frame(reader)).decode("utf-8"))
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            writer.close()
+            return
+        connection = AsyncTraderConnection(writer, framing, codec, self.slow_client_policy, self.congested)
+        self.trader_connections[tr_id] = connection
+        for shard in range(self.shards):
+            self.forward(shard, (TRADER, tr_id, codec))
+        logger.info("Got connection from %s  id = %s", writer.get_extra_info("peername")[0], tr_id)
+        writer.write(frame(reply))
+        await asyncio.sleep(self.trading_delay)
+        decode_request = self.exchange.decode_request
+        route = self.route
+        congested = self.congested
+        try:
+            while True:
+                data = await read_frame(reader, framing)
+                try:
+                    route(decode_request(data, codec), data if codec == BINARY_CODEC else None)
+                except Exception:
+                    # a bad request must not stop the trading of this trader
+                    logger.exception("Failed to handle %s", data)
+                if congested:
+                    # BLOCK: the requests wait until the slow traders have read their messages
+                    for c in list(congested):
+                        try:
+                            await c.writer.drain()
+                        except ConnectionError:
+                            c.close()
+                    congested.clear()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            connection.close()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        for worker in self.workers:
+            worker.start()
+        reader = threading.Thread(target=self.read_replies, daemon=True)
+        reader.start()
+        host, port = self.server_address
+        server = await asyncio.start_server(self.handle_connection, host, port, reuse_address=True)
+        logger.info("Gateway listening on %s:%s with %s shards", host, port, self.shards)
+        async with server:
+            await self.stopped.wait()
+        for requests in self.requests:
+            requests.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.replies.put(None)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="the exchange with the symbols split between worker processes")
+    parser.add_argument("--shards", type=int, default=os.cpu_count(),
+                        help="number of matching processes, the default is the number of cores")
+    parser.add_argument("--slow-clients", choices=SLOW_CLIENT_POLICIES, default=DISCONNECT,
+                        help="what to do with a trader that does not read its messages fast enough")
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    log_listener = setup_logging(args.log, args.log_file)
+    HOST,PORT = "localhost",9999
+    gateway = Gateway((HOST, PORT), args.shards, slow_client_policy=args.slow_clients)
+    try:
+        gateway.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("KeyboardInterrupt.")
+    log_listener.stop()
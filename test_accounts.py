@@ -0,0 +1,64 @@
+import json
+import unittest
+from orders import *
+from framing import parse_handshake
+from accounts import AccountStore
+from pnl import PnLEngine
+from risk import RiskManager
+from server import Exchange
+
+# Tests of the trader ids the exchange takes: the accounts, the risk checks and the P&L
+# index their arrays by trader id, so a negative one is rejected with the request, before
+# the matching, and by the stores themselves.
+#
+#   python -m pytest test_accounts.py
+
+
+def request(trader_id, action=ActionType.PLACE):
+    return json.dumps({"ActionType": action.value, "TraderID": trader_id, "OrderID": 1, "OrderType": 1,
+                       "Symbol": "AAPL", "Quantity": 5, "Price": 100, "Side": OrderSide.BUY.value, "Time": 0})
+
+
+class TraderIDTest(unittest.TestCase):
+    def test_negative_and_non_integer_ids_are_rejected_when_decoded(self):
+        exchange = Exchange()
+        for trader_id in (-1, 1.0, "1", None):
+            for action in ActionType:
+                with self.assertRaises(InvalidTraderID):
+                    exchange.decode_request(request(trader_id, action))
+
+    def test_negative_id_does_not_reach_the_book(self):
+        exchange = Exchange()
+        exchange.place_new_order(LimitOrder(2, "AAPL", 5, 100, OrderSide.SELL, 0, 1))
+        with self.assertRaises(InvalidTraderID):
+            exchange.decode_request(request(-1))
+        self.assertEqual(exchange.get_matching_engine("AAPL").depth(), ([], [(100, 5)]))
+        self.assertEqual(exchange.accounts.get(2), (1000000, 0))
+
+    def test_negative_id_is_rejected_in_the_handshake(self):
+        self.assertEqual(parse_handshake("7")[0], 7)
+        with self.assertRaises(ValueError):
+            parse_handshake("-1 length json")
+
+    def test_stores_reject_negative_ids(self):
+        accounts = AccountStore()
+        accounts.apply_fill(3, -500.0, 5)
+        with self.assertRaises(ValueError):
+            accounts.apply_fill(-1, 500.0, -5)
+        self.assertEqual(accounts.sum_of_balances(), 4 * 1000000 - 500.0)
+        pnl = PnLEngine()
+        pnl.fill(3, "AAPL", 5, 100)
+        with self.assertRaises(ValueError):
+            pnl.fill(-1, "AAPL", -5, 100)
+        with self.assertRaises(ValueError):
+            RiskManager().reserve(LimitOrder(-1, "AAPL", 5, 100, OrderSide.BUY, 0), None, accounts)
+
+    def test_failed_fill_leaves_the_account_as_it_was(self):
+        accounts = AccountStore()
+        with self.assertRaises(TypeError):
+            accounts.apply_fill(1, -250.0, 2.5)
+        self.assertEqual(accounts.get(1), (1000000, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
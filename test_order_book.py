@@ -0,0 +1,86 @@
+import json
+import unittest
+from orders import *
+from order_book import BookSide
+from server import Exchange
+
+# Tests of the price levels of the book sides and of the quantities the exchange takes
+# from the traders: a quantity the arrays of the levels do not take must not leave the
+# keys and the quantities of the levels out of step.
+#
+#   python -m pytest test_order_book.py
+
+
+def limit(quantity, price, side=OrderSide.BUY, trader_id=1, order_id=0):
+    return LimitOrder(trader_id, "AAPL", quantity, price, side, 0, order_id)
+
+
+def place(quantity, order_type=OrderType.LIMIT, action=ActionType.PLACE):
+    return {"ActionType": action.value, "TraderID": 1, "OrderID": 1, "OrderType": order_type.value,
+            "Symbol": "AAPL", "Quantity": quantity, "Price": 100, "Side": OrderSide.BUY.value, "Time": 0}
+
+
+class BookSideTest(unittest.TestCase):
+    def assertLevels(self, side, levels):
+        self.assertEqual(side.depth(), levels)
+        self.assertEqual(len(side.keys), len(side.quantities))
+        self.assertEqual(sorted(side.levels), sorted(price for price, quantity in levels))
+
+    def test_failed_insert_of_a_new_level_leaves_the_side_as_it_was(self):
+        side = BookSide(True)
+        side.insert(limit(5, 99))
+        for price in (100, 98):
+            with self.assertRaises(TypeError):
+                side.insert(limit(10.5, price))
+        self.assertLevels(side, [(99, 5)])
+        self.assertIs(side.best, side.levels[99])
+        side.insert(limit(3, 100))
+        self.assertLevels(side, [(100, 3), (99, 5)])
+
+    def test_failed_fill_leaves_the_order_and_its_level_as_they_were(self):
+        side = BookSide(False)
+        order = limit(5, 100, OrderSide.SELL)
+        level = side.insert(order)
+        with self.assertRaises(TypeError):
+            side.fill(level, order, 2.5)
+        self.assertEqual((order.quantity, level.quantity), (5, 5))
+        self.assertLevels(side, [(100, 5)])
+
+    def test_failed_amend_leaves_the_order_and_its_level_as_they_were(self):
+        side = BookSide(True)
+        order = limit(5, 100)
+        level = side.insert(order)
+        with self.assertRaises(TypeError):
+            side.amend(order, level, 2.5)
+        self.assertEqual((order.quantity, level.quantity), (5, 5))
+        self.assertLevels(side, [(100, 5)])
+
+
+class RequestQuantityTest(unittest.TestCase):
+    def decode(self, dic):
+        return Exchange().decode_request(json.dumps(dic))
+
+    def test_non_integer_quantities_are_rejected(self):
+        for order_type in (OrderType.LIMIT, OrderType.MARKET, OrderType.IOC):
+            for quantity in (10.5, 10.0, "10", True):
+                with self.assertRaises(InvalidQuantity):
+                    self.decode(place(quantity, order_type))
+        with self.assertRaises(InvalidQuantity):
+            self.decode(place(2.5, action=ActionType.AMEND))
+
+    def test_non_positive_quantities_are_rejected(self):
+        for action in (ActionType.PLACE, ActionType.AMEND):
+            for quantity in (0, -3):
+                with self.assertRaises(NonPositiveQuantity):
+                    self.decode(place(quantity, action=action))
+
+    def test_rejected_order_does_not_reach_the_book(self):
+        exchange = Exchange()
+        with self.assertRaises(InvalidQuantity):
+            exchange.decode_request(json.dumps(place(10.5)))
+        exchange.place_new_order(exchange.decode_request(json.dumps(place(10)))[2])
+        self.assertEqual(exchange.get_matching_engine("AAPL").depth(), ([(100, 10)], []))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+import unittest
+from orders import *
+from server import MatchingEngine
+from timer_wheel import TimerWheel
+
+# Tests of the timer wheel and of the expiry of the orders in the matching engine.
+# The small wheels (tick of 1 second, 4 slots per level) reach the level boundaries and
+# the end of the top level with a few ticks.
+#
+#   python -m pytest test_timer_wheel.py
+
+
+def small_wheel(now=0, levels=3):
+    # level 0 covers 4 ticks, level 1 16 and level 2 64
+    return TimerWheel(now, tick=1, bits=2, levels=levels)
+
+
+def due_ticks(wheel, until):
+    # advances one tick at a time; item -> the tick it came out at
+    out = {}
+    for t in range(wheel.current + 1, until + 1):
+        for item in wheel.advance(t):
+            out[item] = t
+    return out
+
+
+class TimerWheelTest(unittest.TestCase):
+    def test_deadline_in_the_past_comes_out_at_the_next_tick(self):
+        wheel = small_wheel(10)
+        wheel.schedule(3, "past")
+        wheel.schedule(10, "now")
+        self.assertEqual(wheel.advance(10), [])
+        self.assertEqual(sorted(wheel.advance(11)), ["now", "past"])
+        self.assertEqual(len(wheel), 0)
+
+    def test_deadline_rounded_up_to_a_tick(self):
+        wheel = TimerWheel(0, tick=0.5, bits=2, levels=3)
+        wheel.schedule(1.2, "a")
+        self.assertEqual(wheel.advance(1.4), [])
+        self.assertEqual(wheel.advance(1.5), ["a"])
+
+    def test_deadlines_across_level_1_boundaries(self):
+        wheel = small_wheel(2)
+        deadlines = [3, 4, 5, 7, 8, 9, 15, 16, 17]
+        for d in deadlines:
+            wheel.schedule(d, d)
+        self.assertEqual(due_ticks(wheel, 20), dict((d, d) for d in deadlines))
+
+    def test_deadlines_across_level_2_boundaries(self):
+        wheel = small_wheel(13)
+        deadlines = [16, 17, 31, 32, 47, 63, 64, 65, 70]
+        for d in deadlines:
+            wheel.schedule(d, d)
+        self.assertEqual(due_ticks(wheel, 80), dict((d, d) for d in deadlines))
+
+    def test_deadlines_beyond_the_top_level(self):
+        wheel = small_wheel(5, levels=2)
+        deadlines = [20, 21, 37, 100, 257]
+        for d in deadlines:
+            wheel.schedule(d, d)
+        self.assertEqual(due_ticks(wheel, 300), dict((d, d) for d in deadlines))
+        self.assertEqual(len(wheel), 0)
+
+    def test_advance_over_many_ticks_at_once(self):
+        wheel = small_wheel(0)
+        for d in (1, 6, 30, 90, 200):
+            wheel.schedule(d, d)
+        self.assertEqual(sorted(wheel.advance(50)), [1, 6, 30])
+        self.assertEqual(sorted(wheel.advance(1000)), [90, 200])
+
+    def test_wheel_without_a_start_starts_at_the_first_advance(self):
+        wheel = TimerWheel(tick=1, bits=2, levels=3)
+        wheel.schedule(100, "late")
+        wheel.schedule(5, "early")
+        self.assertEqual(wheel.advance(50), ["early"])
+        self.assertEqual(due_ticks(wheel, 120), {"late": 100})
+
+
+class ExpiredOrdersTest(unittest.TestCase):
+    def order(self, trader_id, order_id, side, expires, price=100):
+        return LimitOrder(trader_id, "AAPL", 10, price, side, 0, order_id, TimeInForce.GTD, expires)
+
+    def test_cancelled_and_filled_orders_are_skipped(self):
+        engine = MatchingEngine()
+        for order_id in (1, 2, 3):
+            engine.handle_order(self.order(1, order_id, OrderSide.BUY, 10, price=100 - order_id))
+        engine.cancel_order(1, 2)
+        # fills order 1, the best bid
+        engine.handle_order(self.order(2, 1, OrderSide.SELL, 0, price=99))
+        expired = engine.expired_orders(11)
+        self.assertEqual([(o.id, o.order_id) for o in expired], [(1, 3)])
+
+    def test_order_that_rests_again_under_the_same_id(self):
+        engine = MatchingEngine()
+        engine.handle_order(self.order(1, 1, OrderSide.BUY, 10))
+        engine.cancel_order(1, 1)
+        engine.handle_order(self.order(1, 1, OrderSide.BUY, 50))
+        # the first order is due, the one resting now is not
+        self.assertEqual(engine.expired_orders(11), [])
+        self.assertEqual([(o.id, o.order_id) for o in engine.expired_orders(51)], [(1, 1)])
+
+
+if __name__ == "__main__":
+    unittest.main()
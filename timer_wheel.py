@@ -0,0 +1,114 @@
+import logging
+import threading
+
+# Hierarchical timer wheel, for the expiry of the GTD and DAY orders (see
+# MatchingEngine.insert_limit_order). Time is counted in ticks; level 0 has a slot for each
+# of the next 256 ticks, level 1 a slot for each of the next 256 blocks of 256 ticks, and
+# so on. Scheduling puts the item in the slot of its tick at the lowest level that reaches
+# that far, and every tick the wheel moves on to takes the items of one level 0 slot out,
+# after moving the items of the higher level slots that start at this tick down a level.
+# Scheduling and expiring an item are O(1) whatever the number of items, and an item is
+# moved down at most once per level.
+#
+# Items are not removed from the wheel when their order goes away before its time (a
+# cancel or a fill), the engine skips them when they come out.
+
+logger = logging.getLogger("exchange.expiry")
+
+
+class TimerWheel():
+    def __init__(self, now=None, tick=0.1, bits=8, levels=4):
+        # without now the wheel starts at the first advance, what is scheduled before it
+        # waits in pending; replay.py advances it by the times of the recorded orders
+        self.tick = tick
+        self.bits = bits
+        self.mask = (1 << bits) - 1
+        self.slots = [[[] for _ in range(1 << bits)] for _ in range(levels)]
+        self.current = None if now is None else int(now // tick) # the last tick done, everything up to it is out
+        self.pending = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, deadline, item):
+        # item comes out of advance once the time is deadline or later
+        ticks = -int(-deadline // self.tick) # rounded up, never early
+        if self.current is None:
+            self.pending.append((ticks, item))
+            self.count += 1
+            return
+        if ticks <= self.current:
+            ticks = self.current + 1
+        self.insert(ticks, item)
+        self.count += 1
+
+    def insert(self, ticks, item):
+        delta = ticks - self.current
+        bits = self.bits
+        level = 0
+        top = len(self.slots) - 1
+        while level < top and delta >> (bits * (level + 1)):
+            level += 1
+        # beyond the top level the item goes round again, it is placed anew when its slot comes
+        self.slots[level][(ticks >> (bits * level)) & self.mask].append((ticks, item))
+
+    def advance(self, now):
+        # the items whose time has come by now, taken out of the wheel
+        target = int(now // self.tick)
+        slots = self.slots
+        bits = self.bits
+        mask = self.mask
+        levels = len(slots)
+        due = []
+        if self.current is None:
+            self.current = target
+            for ticks, item in self.pending:
+                if ticks <= target:
+                    due.append(item)
+                    self.count -= 1
+                else:
+                    self.insert(ticks, item)
+            self.pending = []
+        while self.current < target:
+            if not self.count:
+                # nothing to move down or take out on the way
+                self.current = target
+                break
+            self.current += 1
+            t = self.current
+            for level in range(1, levels):
+                if t & ((1 << (bits * level)) - 1):
+                    break
+                slot = slots[level][(t >> (bits * level)) & mask]
+                if slot:
+                    entries = slot[:]
+                    slot.clear()
+                    for ticks, item in entries:
+                        self.insert(ticks, item)
+            slot = slots[0][t & mask]
+            if slot:
+                due.extend(item for ticks, item in slot)
+                self.count -= len(slot)
+                slot.clear()
+        return due
+
+
+class Expirer(threading.Thread):
+    # expires the orders whose time has come every interval seconds, see
+    # Exchange.expire_orders
+    def __init__(self, exchange, interval=0.1):
+        super().__init__(daemon=True)
+        self.exchange = exchange
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.exchange.expire_orders()
+            except Exception:
+                logger.exception("Failed to expire the orders")
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,272 @@
+import argparse
+import json
+import logging
+import mmap
+import os
+import threading
+from orders import *
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Append-only store of the trades of the exchange, by column: every column is a file of
+# fixed size numbers (time, price, quantity, buyer, seller, side of the aggressor, symbol
+# as a small number) that is memory-mapped, and a trade is written straight into the
+# mappings, no object is kept for it. The number of trades is in its own mapped file and
+# is written after the columns, so a trade is in the tape once it is counted.
+#
+# The files grow by doubling. A bigger file gets a new mapping, the old one stays valid
+# for as long as something uses it, so the numpy views given out (column) can be kept;
+# they only see the trades that were there when they were made.
+#
+# The queries (vwap, ohlcv, trader_volume) work on those views and need numpy: a filter
+# by symbol or time makes one pass over the columns, everything else is done on the
+# arrays as a whole. The trades are in the order they were recorded, which is their time
+# order for one symbol and nearly so for all of them.
+#
+# Exchange.apply_fills records the trades when Exchange.tape is set:
+#
+#   python server.py --trade-tape tape_dir
+#   python trade_tape.py tape_dir --bars 60 --symbol AAPL
+#
+# The server flushes the mappings to the disk every second (Flusher); what the OS has not
+# written yet when the machine stops is lost, a stop of the server alone loses nothing.
+
+COLUMNS = (("time", "d"), ("price", "d"), ("quantity", "q"), ("buyer", "q"), ("seller", "q"),
+           ("side", "b"), ("symbol", "i"))
+SIZES = {"d": 8, "q": 8, "b": 1, "i": 4}
+if np is not None:
+    DTYPES = {"d": np.float64, "q": np.int64, "b": np.int8, "i": np.int32}
+
+logger = logging.getLogger("exchange.tape")
+
+# record compares the side of every aggressor with BUY and writes the values of the
+# sides, bound here so that it does not go through OrderSide for them
+BUY = OrderSide.BUY
+BUY_VALUE = OrderSide.BUY.value
+SELL_VALUE = OrderSide.SELL.value
+
+
+class TradeTape():
+    def __init__(self, directory, capacity=1 << 20):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.lock = threading.Lock() # for the symbols, the trades are recorded under the accounts lock
+        self.files = {}
+        self.maps = {}
+        self.views = {}
+        self.columns = () # the views in the order of COLUMNS
+        self.meta_file = open(os.path.join(directory, "count"), "a+b")
+        if os.fstat(self.meta_file.fileno()).st_size < 8:
+            self.meta_file.truncate(8)
+        self.meta_map = mmap.mmap(self.meta_file.fileno(), 8)
+        self.meta = memoryview(self.meta_map).cast("q")
+        self.count = self.meta[0]
+        self.symbols_path = os.path.join(directory, "symbols.json")
+        self.symbols = []
+        if os.path.exists(self.symbols_path):
+            with open(self.symbols_path) as f:
+                self.symbols = json.load(f)
+        self.symbol_codes = dict((symbol, i) for i, symbol in enumerate(self.symbols))
+        for name, code in COLUMNS:
+            f = open(os.path.join(directory, name + ".col"), "a+b")
+            self.files[name] = f
+            capacity = max(capacity, os.fstat(f.fileno()).st_size // SIZES[code])
+        self.capacity = 0
+        self.resize(capacity)
+
+    def resize(self, capacity):
+        for name, code in COLUMNS:
+            f = self.files[name]
+            size = capacity * SIZES[code]
+            if os.fstat(f.fileno()).st_size < size:
+                f.truncate(size)
+            # the old mapping is not closed, the views made from it may still be in use
+            self.maps[name] = mmap.mmap(f.fileno(), size)
+            self.views[name] = memoryview(self.maps[name]).cast(code)
+        self.columns = tuple(self.views[name] for name, code in COLUMNS)
+        self.capacity = capacity
+
+    def symbol_code(self, symbol):
+        code = self.symbol_codes.get(symbol)
+        if code is None:
+            with self.lock:
+                code = self.symbol_codes.get(symbol)
+                if code is None:
+                    code = len(self.symbols)
+                    self.symbols.append(symbol)
+                    with open(self.symbols_path + ".tmp", "w") as f:
+                        json.dump(self.symbols, f)
+                    os.replace(self.symbols_path + ".tmp", self.symbols_path)
+                    self.symbol_codes[symbol] = code
+        return code
+
+    def append(self, time, price, quantity, buyer, seller, side, symbol):
+        # side is the side of the aggressor, as OrderSide values
+        n = self.count
+        if n == self.capacity:
+            self.resize(self.capacity * 2)
+        times, prices, quantities, buyers, sellers, sides, symbols = self.columns
+        times[n] = time
+        prices[n] = price
+        quantities[n] = quantity
+        buyers[n] = buyer
+        sellers[n] = seller
+        sides[n] = side
+        symbols[n] = self.symbol_code(symbol)
+        self.count = self.meta[0] = n + 1
+
+    def record(self, filled_orders):
+        # the fills of one order from the matching engine: the resting order and the order
+        # that matched it for every trade
+        if not filled_orders:
+            return
+        n = self.count
+        if n + len(filled_orders) // 2 > self.capacity:
+            self.resize(max(self.capacity * 2, n + len(filled_orders) // 2))
+        times, prices, quantities, buyers, sellers, sides, symbols = self.columns
+        aggressor = filled_orders[1]
+        symbol = self.symbol_codes.get(aggressor.symbol)
+        if symbol is None:
+            symbol = self.symbol_code(aggressor.symbol)
+        is_buy = aggressor.side is BUY
+        side = BUY_VALUE if is_buy else SELL_VALUE
+        for i in range(0, len(filled_orders), 2):
+            resting = filled_orders[i]
+            times[n] = resting.time
+            prices[n] = resting.price
+            quantities[n] = resting.quantity
+            if is_buy:
+                buyers[n] = filled_orders[i + 1].id
+                sellers[n] = resting.id
+            else:
+                buyers[n] = resting.id
+                sellers[n] = filled_orders[i + 1].id
+            sides[n] = side
+            symbols[n] = symbol
+            n += 1
+        self.count = self.meta[0] = n
+
+    def __len__(self):
+        return self.count
+
+    def flush(self):
+        for m in self.maps.values():
+            m.flush()
+        self.meta_map.flush()
+
+    def column(self, name, count=None):
+        # the first count trades (all so far by default) of a column, without copying it
+        if np is None:
+            raise ImportError("numpy is needed for the queries of the trade tape")
+        if count is None:
+            count = self.count
+        return np.frombuffer(self.maps[name], dtype=DTYPES[dict(COLUMNS)[name]], count=count)
+
+    def select(self, names, symbol=None, start=None, end=None):
+        # the columns of the trades of symbol with start <= time < end; views when there is no filter.
+        # The number of trades is read once, trades recorded meanwhile do not change the lengths
+        count = self.count
+        columns = [self.column(name, count) for name in names]
+        mask = None
+        if symbol is not None:
+            mask = self.column("symbol", count) == self.symbol_codes.get(symbol, -1)
+        if start is not None or end is not None:
+            t = self.column("time", count)
+            if start is not None:
+                mask = t >= start if mask is None else mask & (t >= start)
+            if end is not None:
+                mask = t < end if mask is None else mask & (t < end)
+        if mask is None:
+            return columns
+        return [c[mask] for c in columns]
+
+    def vwap(self, symbol=None, start=None, end=None):
+        price, quantity = self.select(("price", "quantity"), symbol, start, end)
+        volume = quantity.sum()
+        return float(price @ quantity / volume) if volume else None
+
+    def ohlcv(self, interval, symbol=None, start=None, end=None):
+        # bars of interval seconds: dict of arrays of the same length, time is the start of the bar
+        t, price, quantity = self.select(("time", "price", "quantity"), symbol, start, end)
+        if not len(t):
+            empty = np.zeros(0)
+            return {"time": empty, "open": empty, "high": empty, "low": empty, "close": empty,
+                    "volume": np.zeros(0, dtype=np.int64), "trades": np.zeros(0, dtype=np.int64)}
+        bars = np.floor(t / interval)
+        if (bars[1:] < bars[:-1]).any():
+            order = np.argsort(bars, kind="stable")
+            bars, price, quantity = bars[order], price[order], quantity[order]
+        starts = np.flatnonzero(np.concatenate(([True], bars[1:] != bars[:-1])))
+        ends = np.append(starts[1:], len(bars)) - 1
+        return {"time": bars[starts] * interval, "open": price[starts],
+                "high": np.maximum.reduceat(price, starts), "low": np.minimum.reduceat(price, starts),
+                "close": price[ends], "volume": np.add.reduceat(quantity, starts), "trades": ends - starts + 1}
+
+    def trader_volume(self, symbol=None, start=None, end=None):
+        # quantity traded by every trader, bought and sold, indexed by trader id
+        buyer, seller, quantity = self.select(("buyer", "seller", "quantity"), symbol, start, end)
+        if not len(quantity):
+            return np.zeros(0, dtype=np.int64)
+        size = int(max(buyer.max(), seller.max())) + 1
+        return (np.bincount(buyer, quantity, size) + np.bincount(seller, quantity, size)).astype(np.int64)
+
+    def close(self):
+        # the mappings stay for as long as the views given out by column use them
+        self.flush()
+        self.views.clear()
+        self.columns = ()
+        self.maps.clear()
+        self.meta.release()
+        self.meta_map.close()
+        for f in self.files.values():
+            f.close()
+        self.meta_file.close()
+
+
+class Flusher(threading.Thread):
+    # writes the mappings of the tape to the disk every interval seconds
+    def __init__(self, tape, interval=1):
+        super().__init__(daemon=True)
+        self.tape = tape
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.tape.flush()
+            except Exception:
+                logger.exception("Failed to flush the trade tape")
+
+    def stop(self):
+        self.stopped.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="queries of a trade tape")
+    parser.add_argument("directory")
+    parser.add_argument("--symbol")
+    parser.add_argument("--start", type=float)
+    parser.add_argument("--end", type=float)
+    parser.add_argument("--bars", type=float, help="print the bars of this many seconds")
+    parser.add_argument("--traders", type=int, default=0, help="print the volume of the top traders")
+    args = parser.parse_args()
+    tape = TradeTape(args.directory)
+    print("%d trades of %d symbols" % (len(tape), len(tape.symbols)))
+    print("VWAP %s" % tape.vwap(args.symbol, args.start, args.end))
+    if args.bars:
+        bars = tape.ohlcv(args.bars, args.symbol, args.start, args.end)
+        for i in range(len(bars["time"])):
+            print("%.3f %s %s %s %s %d %d" % tuple(bars[k][i] for k in ("time", "open", "high", "low", "close",
+                                                                          "volume", "trades")))
+    if args.traders:
+        volume = tape.trader_volume(args.symbol, args.start, args.end)
+        for trader_id in np.argsort(volume)[::-1][:args.traders]:
+            print("trader %d: %d" % (trader_id, volume[trader_id]))
+
+
+if __name__ == "__main__":
+    main()